@@ -7,6 +7,10 @@ from sqlalchemy import MetaData
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import config, Config
+from .cache import LRUCache
+from .last_seen import LastSeenBuffer
+from . import metrics, query_stats
+from .rendering import renderer
 from flask_login import LoginManager
 from flask_pagedown import PageDown
 
@@ -36,6 +40,43 @@ def create_app(config_name):
     db.init_app(app)
     login_manager.init_app(app)
     pagedown.init_app(app)
+    # Before the blueprints, so their before_request functions are counted too
+    query_stats.init_app(app)
+    # After query_stats, so it records the SQL time of the request before query_stats reports it
+    metrics.init_app(app)
+    LastSeenBuffer(app.config["BLOGGING_LAST_SEEN_GRANULARITY"],
+                   app.config["BLOGGING_LAST_SEEN_FLUSH_INTERVAL"]).init_app(app, db)
+    from .models import role_cache
+    # In-process caches, see cache.py. They are created per app so every app (e.g. in each unit test) starts empty.
+    app.extensions["caches"] = {
+        "post_fragments": LRUCache(app.config["BLOGGING_FRAGMENT_CACHE_SIZE"]),
+        # Shared by all apps in the process; it is keyed by a hash of the markdown so it can't go stale
+        "markdown": renderer.cache,
+        # Successful email/password checks of the API, see api/authentication.py
+        "credentials": LRUCache(app.config["BLOGGING_CREDENTIAL_CACHE_SIZE"],
+                                ttl = app.config["BLOGGING_CREDENTIAL_CACHE_TTL"]),
+        # The roles table, shared by all apps in the process and refreshed when a role changes, see models.py
+        "roles": role_cache,
+        # Snapshots of logged-in users for current_user, see identity.py
+        "identities": LRUCache(app.config["BLOGGING_IDENTITY_CACHE_SIZE"],
+                               ttl = app.config["BLOGGING_IDENTITY_CACHE_TTL"])
+    }
+    # When the snapshots of users were last forgotten, shared by the workers, see identity.py
+    from .page_cache import TagVersions
+    app.extensions["identity_tags"] = TagVersions(app.config["BLOGGING_IDENTITY_TAG_DIR"])
+    # Whole pages for anonymous visitors. Before the blueprints, so a cached page is served before anything of theirs runs.
+    from .page_cache import PageCache
+    page_cache = PageCache(app.config["BLOGGING_PAGE_CACHE_SIZE"], app.config["BLOGGING_PAGE_CACHE_TTL"],
+                           app.config["BLOGGING_PAGE_CACHE_TAG_DIR"])
+    page_cache.init_app(app)
+    app.extensions["caches"]["pages"] = page_cache.pages
+    # Who follows whom, see social_graph.py
+    from .social_graph import SocialGraph
+    social_graph = SocialGraph(app.config["BLOGGING_SOCIAL_GRAPH_SIZE"], app.config["BLOGGING_SOCIAL_GRAPH_TTL"],
+                               app.config["BLOGGING_SOCIAL_GRAPH_MAX_FOLLOWING"],
+                               app.config["BLOGGING_SOCIAL_GRAPH_TAG_DIR"])
+    social_graph.init_app(app)
+    app.extensions["caches"]["social_graph"] = social_graph.following_ids
     # Define the routes for the app using blueprint library of flask
     
     # Importing the blueprint main is put here, so that clients that only import create_app will also create the blueprint.
@@ -1,4 +1,6 @@
-from flask import g, jsonify
+import hashlib, hmac, os
+
+from flask import current_app, g, jsonify
 from flask_httpauth import HTTPBasicAuth
 from ..models import User
 from . import api
@@ -31,7 +33,27 @@ def verify_password(email_or_token, password):
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    # check_password_hash is slow on purpose, so remember the credentials that passed it for a while.
+    # The key includes the stored password hash and the confirmed flag, so changing the password or
+    # unconfirming the account makes it miss, in every worker.
+    credentials = current_app.extensions["caches"]["credentials"]
+    key = credentials_digest(user, password)
+    if credentials.get(key):
+        return True
+    if not user.verify_password(password):
+        return False
+    if user.confirmed:
+        credentials.set(key, True)
+    return True
+
+
+# Key of the credentials cache. It is an HMAC with a random key of this process, so the cache
+# never holds the password, nor anything that could be used to guess it outside of this process.
+_credentials_key = os.urandom(32)
+
+def credentials_digest(user: User, password: str) -> bytes:
+    message = "\0".join([user.email, user.password_hash or "", str(user.confirmed), password])
+    return hmac.new(_credentials_key, message.encode("utf-8"), hashlib.sha256).digest()
 
 
 @auth.error_handler
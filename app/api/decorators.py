@@ -1,5 +1,6 @@
+import hashlib, json
 from functools import wraps
-from flask import abort, g
+from flask import abort, g, make_response, request
 
 from app.api.errors import forbidden
 
@@ -11,4 +12,39 @@ def permission_required(permission):
                 return forbidden("Insufficient permissions to access this endpoint!")
             return f(*args, **kwargs)
         return decorated_function
-    return decorator
\ No newline at end of file
+    return decorator
+
+# Conditional GET. Polling clients send back the ETag of the response they already have in If-None-Match;
+# if nothing changed, they get an empty 304 Not Modified instead of the whole response.
+# validator is called with the arguments of the view, before it, and returns what the response depends on,
+# read with a cheap query (e.g. the ids and versions of the posts on the page, not the posts themselves),
+# or None if it can't tell (e.g. the resource doesn't exist, so the view returns 404).
+# That is hashed into a strong ETag. If the client has it, 304 is returned without running the view at all;
+# otherwise the view runs and the ETag is added to its response.
+# Bump REPRESENTATION_VERSION when the JSON of a resource changes shape, so that clients don't keep the old one.
+REPRESENTATION_VERSION = 1
+
+def etag_of(parts) -> str:
+    data = json.dumps([REPRESENTATION_VERSION, parts], default = str, separators = (",", ":"))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+def conditional(validator):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            parts = validator(*args, **kwargs)
+            if parts is None:
+                return f(*args, **kwargs)
+            etag = etag_of(parts)
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Clients (and any proxy) must check with the server before reusing the response
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return decorated_function
+    return decorator
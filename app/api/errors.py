@@ -41,6 +41,11 @@ def forbidden(message):
     resp.status_code = 403
     return resp
 
+def payload_too_large(message):
+    response = jsonify({'error': 'payload too large', 'message': message})
+    response.status_code = 413
+    return response
+
 def unauthorized(message):
     response = jsonify({'error': 'unauthorized', 'message': message})
     response.status_code = 401
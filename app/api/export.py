@@ -0,0 +1,33 @@
+from datetime import datetime
+from flask import Response, abort, request, stream_with_context
+from ..exceptions import ValidationError
+from ..export import EXPORTS, export_ndjson
+from ..models import Permission
+from . import api
+from .decorators import permission_required
+
+# The ?since= of an export: an ISO 8601 timestamp (UTC, like all timestamps of the API), or None if not given
+def since_arg():
+    since = request.args.get('since')
+    if not since:
+        return None
+    try:
+        return datetime.fromisoformat(since)
+    except ValueError:
+        raise ValidationError("since must be an ISO 8601 timestamp, e.g. 2024-01-31T12:00:00")
+
+# All posts, comments or votes (with ?since=, only those from then on) as NDJSON, streamed as the rows are read
+# (see app/export.py). Gzipped if the client accepts it. For admins only.
+@api.route('/export/<kind>')
+@permission_required(Permission.ADMIN)
+def export(kind):
+    if kind not in EXPORTS:
+        abort(404)
+    since = since_arg()
+    compress = "gzip" in request.accept_encodings
+    response = Response(stream_with_context(export_ndjson(kind, since, compress = compress)),
+                        mimetype = "application/x-ndjson")
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
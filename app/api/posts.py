@@ -1,9 +1,42 @@
-from flask import Response, jsonify, request, g, url_for, current_app
+import io, json
+from flask import Response, jsonify, redirect, request, g, url_for, current_app
 from .. import db
-from ..models import Post, Permission
+from ..exceptions import ValidationError
+from ..main.feeds import feed_query
+from ..models import Post, Permission, TimelineEntry
+from ..pagination import keyset_paginate
 from . import api
-from .decorators import permission_required
-from .errors import forbidden
+from .decorators import conditional, permission_required
+from .errors import forbidden, payload_too_large
+
+# The ids of ?ids=1,2,3 of a batch request, without duplicates, in the order given.
+# Raises ValidationError if they aren't integers or there are more than BLOGGING_API_BATCH_LIMIT of them.
+def requested_ids() -> list:
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.args.get('ids', '').split(',') if id.strip()))
+    except ValueError:
+        raise ValidationError("ids must be a comma separated list of integers")
+    if not ids:
+        raise ValidationError("No ids given")
+    limit = current_app.config["BLOGGING_API_BATCH_LIMIT"]
+    if len(ids) > limit:
+        raise ValidationError(f"At most {limit} ids can be fetched at once")
+    return ids
+
+# Many posts by id at once, e.g. /posts?ids=1,2,3, in one query instead of one request per post.
+# The posts are returned in the order of the ids, each with its id; an id without a post gets
+# {"id": ..., "error": "not found"} instead.
+# It has to be added before the /posts/ routes: werkzeug tries the rules in the order they were added, and
+# /posts/ would redirect /posts to itself. Without ids it still does that redirect, so /posts keeps leading to the
+# list of all posts.
+@api.route('/posts')
+def get_posts_by_id():
+    if 'ids' not in request.args:
+        return redirect(url_for('api.get_posts', **request.args), code = 308)
+    ids = requested_ids()
+    posts = {post.id: post for post in feed_query().filter(Post.id.in_(ids))}
+    return jsonify({"posts": [dict(posts[id].to_json(), id = id) if id in posts else {"id": id, "error": "not found"}
+                              for id in ids]})
 
 @api.route('/posts/', methods=['POST'])
 @permission_required(Permission.WRITE)
@@ -11,32 +44,132 @@ def new_post():
     post = Post.from_json(request.json)
     post.author = g.current_user
     db.session.add(post)
+    db.session.flush()
+    TimelineEntry.fan_out(post)
     db.session.commit()
     return jsonify(post.to_json()), 201, \
         {'Location': url_for('api.get_post', id=post.id)}
 
+# Many new posts at once, e.g. for an import: a JSON array of posts like the ones of new_post, or NDJSON (one post per
+# line, with Content-Type: application/x-ndjson). At most BLOGGING_API_BULK_LIMIT of them, in at most
+# MAX_CONTENT_LENGTH bytes, or the request is refused with 413. The valid ones are inserted
+# in one transaction with Post.bulk_insert(); the result has an item per post sent, in the same order, with either
+# the id and url of the new post or the reason it was rejected.
+# Rendering the markdown is most of the cost of creating a post. With ?render=deferred the posts of the request are
+# rendered after the response has been sent (see Post.render_pending()); until then they show their markdown as
+# plain text. That is still done by the worker that handled the request, for at most BLOGGING_API_BULK_LIMIT posts.
+@api.route('/posts/bulk', methods=['POST'])
+@permission_required(Permission.WRITE)
+def new_posts():
+    # Neither the body nor the posts in it are read past the limits, so they bound the memory and time it takes
+    max_length = current_app.config["MAX_CONTENT_LENGTH"]
+    limit = current_app.config["BLOGGING_API_BULK_LIMIT"]
+    too_many = f"At most {limit} posts can be created at once"
+    if request.content_length is not None and request.content_length > max_length:
+        return payload_too_large(f"The body can be at most {max_length} bytes")
+    data = request.stream.read(max_length + 1)
+    if len(data) > max_length:
+        return payload_too_large(f"The body can be at most {max_length} bytes")
+    if request.mimetype == "application/x-ndjson":
+        items = []
+        for line in io.BytesIO(data):
+            if not line.strip():
+                continue
+            if len(items) == limit:
+                return payload_too_large(too_many)
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(ValidationError("Invalid JSON"))
+    else:
+        try:
+            items = json.loads(data) if request.is_json else None
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise ValidationError("Send a JSON array of posts, or NDJSON with Content-Type: application/x-ndjson")
+        if len(items) > limit:
+            return payload_too_large(too_many)
+    results, valid = [], []
+    for item in items:
+        try:
+            if isinstance(item, ValidationError):
+                raise item
+            valid.append(Post.fields_from_json(item))
+            results.append(None)
+        except ValidationError as e:
+            results.append({"error": e.args[0]})
+    deferred = request.args.get('render') == 'deferred'
+    ids = iter(Post.bulk_insert(g.current_user, valid, render = not deferred))
+    db.session.commit()
+    for index, result in enumerate(results):
+        if result is None:
+            id = next(ids)
+            results[index] = {"id": id, "url": url_for('api.get_post', id = id)}
+    response = jsonify({"posts": results,
+                        "created": len(valid),
+                        "rejected": len(results) - len(valid)})
+    response.status_code = 201 if valid else 400
+    if deferred and valid:
+        response.call_on_close(render_pending_posts(current_app._get_current_object(), [row["id"] for row in results
+                                                                                         if "id" in row]))
+    return response
+
+# A function rendering the posts of ids, to run once the response has been sent (when there is no app context
+# anymore). Only the posts of the request are rendered, so two bulk requests don't render the same posts.
+# Whatever it doesn't get to (e.g. if the worker is stopped) is rendered by flask renderposts.
+def render_pending_posts(app, ids: list):
+    def render():
+        with app.app_context():
+            try:
+                Post.render_pending(ids = ids)
+            finally:
+                db.session.remove()
+    return render
+
+# Validators of the conditional GETs (see decorators.py). The JSON of a post changes when it is edited (its version)
+# or its comments change (comment_count and last_comment_at), so that is what they read, without loading or
+# serializing the posts.
+
+# The page of query that keyset_paginate() will give for the request's cursor, as what the posts' JSON depends on,
+# plus the cursors to the neighbouring pages
+def page_validator(query):
+    page = keyset_paginate(query.with_entities(Post.id, Post.timestamp, Post.version, Post.comment_count,
+                                               Post.last_comment_at),
+                           (Post.timestamp, Post.id),
+                           cursor = request.args.get('cursor'),
+                           per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
+    return [[list(row) for row in page.items], page.prev_cursor, page.next_cursor]
+
+def post_validator(id):
+    row = db.session.query(Post.version, Post.comment_count, Post.last_comment_at).filter(Post.id == id).first()
+    if row is None:
+        return None
+    return [id, list(row)]
+
+# Collections are paginated with cursors (see pagination.py): follow url_next/url_prev
+# to get the neighbouring pages, they are None at either end of the collection.
 @api.route('/posts/')
+@conditional(lambda: page_validator(db.session.query(Post)))
 def get_posts():
-    page = request.args.get('page', 1, type = int)
-    paginate = db.session.query(Post).paginate(
-        page, per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"],
-        error_out = False
-    )
+    paginate = keyset_paginate(feed_query(), (Post.timestamp, Post.id),
+                               cursor = request.args.get('cursor'),
+                               per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
     posts = paginate.items
     prev = None
     next = None
     if paginate.has_prev:
-        prev = url_for("api.get_posts", page = page - 1)
+        prev = url_for("api.get_posts", cursor = paginate.prev_cursor)
     if paginate.has_next:
-        next = url_for("api.get_posts", page = page + 1)
+        next = url_for("api.get_posts", cursor = paginate.next_cursor)
     return jsonify({"posts": [post.to_json() for post in posts],
                     "url_prev": prev,
-                    "url_next": next,
-                    'total_posts': paginate.total})
+                    "url_next": next})
 
 @api.route('/posts/<int:id>')
+@conditional(post_validator)
 def get_post(id):
-    post = db.session.query(Post).get_or_404(id)
+    post = feed_query().filter(Post.id == id).first_or_404()
     return jsonify(post.to_json())
 
 @api.route('/posts/<int:id>/get_post_comments/')
@@ -64,14 +197,14 @@ def get_post_comments(id):
 def edit_post(id):
     post = db.session.query(Post).get_or_404(id)
     # Check permission!
-    if post.author != g.current_user._get_current_object() and \
-        not g.current_user._get_current_object().can(Permission.ADMIN):
+    # g.current_user is the User itself (see authentication.py), not a proxy like flask_login's current_user
+    if post.author != g.current_user and not g.current_user.can(Permission.ADMIN):
         return forbidden("You are not allowed to edit this post!")
     # .get() below attempts to get the value for key 'body', otherwise
     # use the default value, defined as post.body (so no changes made)
     new_body = request.json.get('body', post.body)
     post.body = new_body
-    db.session.add(post.body)
+    db.session.add(post)
     db.session.commit()
     return jsonify(post.to_json()), 201, \
         {'Location': url_for('api.get_post', id=post.id)}
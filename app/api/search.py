@@ -0,0 +1,31 @@
+from flask import jsonify, request, url_for, current_app
+from ..exceptions import ValidationError
+from ..main.feeds import feed_query
+from ..models import Comment, Post
+from ..search import search, words_of
+from . import api
+
+# Full-text search (see app/search.py), best matches first. ?kind=comments searches the comments instead
+# of the posts. Paginated with cursors like the other collections: follow url_next/url_prev.
+@api.route('/search')
+def search_content():
+    query = request.args.get('q', '')
+    kind = request.args.get('kind', 'posts')
+    if not words_of(query):
+        raise ValidationError("Nothing to search for")
+    if kind not in ('posts', 'comments'):
+        raise ValidationError("kind must be posts or comments")
+    model = Post if kind == 'posts' else Comment
+    paginate = search(model, query,
+                      cursor = request.args.get('cursor'),
+                      per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"],
+                      base_query = feed_query() if model is Post else None)
+    prev = None
+    next = None
+    if paginate.has_prev:
+        prev = url_for("api.search_content", q = query, kind = kind, cursor = paginate.prev_cursor)
+    if paginate.has_next:
+        next = url_for("api.search_content", q = query, kind = kind, cursor = paginate.next_cursor)
+    return jsonify({kind: [item.to_json() for item in paginate.items],
+                    "url_prev": prev,
+                    "url_next": next})
@@ -1,11 +1,39 @@
 from flask import current_app, jsonify, request, url_for
 
-from app.api.decorators import permission_required
+from app.api.decorators import conditional, permission_required
 from . import api
 from .. import db
-from ..models import User, Permission
+from ..main.feeds import feed_query
+from ..models import Post, User, Permission
+from ..pagination import keyset_paginate
+from .posts import page_validator, requested_ids
+
+# Validators of the conditional GETs (see decorators.py). Users have no version column, so the columns shown
+# in their JSON are read directly, which is still far cheaper than loading and serializing the user.
+def user_validator(id):
+    row = db.session.query(User.username, User.role_id, User.name, User.location, User.about_me,
+                           User.member_since, User.last_seen, User.post_count, User.follower_count,
+                           User.following_count).filter(User.id == id).first()
+    if row is None:
+        return None
+    return [id, list(row)]
+
+def user_posts_validator(id):
+    if db.session.query(User.id).filter(User.id == id).scalar() is None:
+        return None
+    return page_validator(db.session.query(Post).filter(Post.author_id == id))
+
+# Many users by id at once, e.g. /users?ids=1,2,3, like /posts?ids= (see posts.py)
+@api.route("/users")
+def get_users_by_id():
+    ids = requested_ids()
+    users = {user.id: user for user in db.session.query(User).filter(User.id.in_(ids))}
+    return jsonify({"users": [dict(users[id].to_json(), id = id) if id in users
+                              else {"id": id, "error": "not found"}
+                              for id in ids]})
 
 @api.route("/users/<int:id>")
+@conditional(user_validator)
 def get_user(id):
     user = db.session.query(User).get_or_404(id)
     return jsonify(user.to_json())
@@ -13,21 +41,20 @@ def get_user(id):
 # Remember that URLs that return a collection of resources need to have a forward slash
 # at the end
 @api.route("/users/<int:id>/posts/")
+@conditional(user_posts_validator)
 def get_user_posts(id):
-    page = request.args.get('page', 1, type=int)
     user = db.session.query(User).get_or_404(id)
     # paginate the posts since there's a lot of them
-    paginate = user.posts.paginate(page,
-                                    per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"],
-                                    error_out = False)
+    paginate = keyset_paginate(feed_query().filter(Post.author_id == user.id), (Post.timestamp, Post.id),
+                               cursor = request.args.get('cursor'),
+                               per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
     posts = paginate.items
     next = None
     prev = None
     if paginate.has_prev:
-        prev = url_for("api.get_user_posts", page = page - 1)
+        prev = url_for("api.get_user_posts", id = id, cursor = paginate.prev_cursor)
     if paginate.has_next:
-        next = url_for("api.get_user_posts", page = page + 1)
+        next = url_for("api.get_user_posts", id = id, cursor = paginate.next_cursor)
     return jsonify({"posts": [post.to_json() for post in posts],
                     "url_prev": prev,
-                    "url_next": next,
-                    "total_posts": paginate.total})
\ No newline at end of file
+                    "url_next": next})
\ No newline at end of file
@@ -2,7 +2,7 @@ from flask_login import current_user, login_required, login_user, logout_user
 
 from app.main.views import user
 from . import auth
-from flask import redirect, flash, render_template, url_for, request
+from flask import current_app, redirect, flash, render_template, url_for, request
 from .forms import LoginForm, RegistrationForm
 from .. import db
 from ..models import User
@@ -13,8 +13,10 @@ from ..models import User
 @auth.before_app_request
 def before_request():
     # current_user can also be an anonymous user!!! So need to check authentication
+    # The last seen time is buffered and written in batches, instead of committing an UPDATE
+    # on every request like current_user.ping() would (see last_seen.py)
     if current_user.is_authenticated:
-        current_user.ping()
+        current_app.extensions["last_seen"].record(current_user.id)
 
 @auth.route('/login', methods=["GET","POST"])
 def login():
@@ -0,0 +1,96 @@
+# Small in-process caches.
+#
+# Each gunicorn worker has its own copy of these, so anything cached here must either be safe to be a bit stale
+# in other workers, or be keyed by something that changes when the cached value does (e.g. a version column
+# read from the database), so that other workers simply miss instead of serving an outdated value.
+#
+# The caches of an app are created in create_app() and kept in app.extensions["caches"], by name.
+# /admin/cache shows their statistics.
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic, perf_counter
+
+_missing = object()
+
+# A dict with at most maxsize entries; when full, the least recently used entry is dropped to make room.
+# Counts hits and misses, and the time spent creating the values in get_or_create(), so we can see if a cache
+# is worth it.
+# If ttl is given, entries also expire that many seconds after they were set.
+class LRUCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expiry time or None, value)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.create_seconds = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default = None):
+        with self._lock:
+            expires, value = self._entries.get(key, (None, _missing))
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                value = _missing
+            if value is _missing:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            expires = monotonic() + self.ttl if self.ttl is not None else None
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+
+    # Replace the value of key with function(value) if it is cached, keeping when it expires, or drop it if
+    # function returns None. Doesn't count as a hit or a miss.
+    def update(self, key, function) -> None:
+        with self._lock:
+            expires, value = self._entries.get(key, (None, _missing))
+            if value is _missing:
+                return
+            value = function(value) if expires is None or expires > monotonic() else None
+            if value is None:
+                del self._entries[key]
+            else:
+                self._entries[key] = (expires, value)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    # Get the value of key, or if it isn't cached, create it by calling creator() and cache it.
+    def get_or_create(self, key, creator):
+        value = self.get(key, _missing)
+        if value is _missing:
+            start = perf_counter()
+            value = creator()
+            self.create_seconds += perf_counter() - start
+            self.set(key, value)
+        return value
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        average_create_seconds = self.create_seconds / self.misses if self.misses else 0.0
+        return {"size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "create_seconds": self.create_seconds,
+                # Rough time saved by the hits, assuming each would have cost as much as an average miss
+                "estimated_seconds_saved": self.hits * average_create_seconds}
@@ -1,8 +1,9 @@
 '''This script is used to help developing the blog further. These are meant to be used
-by importing in a flask shell session'''
+by importing in a flask shell session.
+For datasets of more than a few hundred rows, use flask seed (see seeding.py) instead'''
 from flask import current_app
 from . import db
-from .models import User, Role
+from .models import User, Role, role_cache
 from random import randint
 from sqlalchemy.exc import IntegrityError
 from faker import Faker
@@ -58,8 +59,8 @@ def resetUserRoles():
         if user is None:
             continue
         if user.email ==  current_app.get("BLOGGING_ADMIN"):
-            user.role = Role.query.filter_by(name="Administrator").first()
+            user.role_id = role_cache.by_name("Administrator").id
         else:
-            user.role = Role.query.filter_by(default=True).first()
+            user.role_id = role_cache.default().id
         db.session.add(user)
         db.session.commit()
@@ -0,0 +1,65 @@
+# Bulk export of posts, comments and votes as NDJSON (one JSON object per line), for analytics jobs.
+#
+# Scraping /api/v1/posts/ takes a request per page of BLOGGING_POSTS_PER_PAGE posts. Instead, the whole table (or the
+# rows since a timestamp, for incremental exports) is read with one query and written out row by row as it is read:
+#   - the rows are fetched in chunks of chunk_size (yield_per), with stream_results so that MySQL uses a server-side
+#     cursor instead of loading the whole result into the client first
+#   - plain rows of the table are read, not ORM objects, so nothing piles up in a session
+#   - lines are joined into blocks of about BLOCK_SIZE bytes and handed out as they are made, optionally gzipped
+#     with a streaming compressor
+# so the memory used doesn't depend on the size of the table.
+#
+# Served by /api/v1/export/<kind> (see api/export.py) and written to a file by flask export (see blogging.py).
+
+import json, zlib
+from datetime import datetime
+from . import db
+from .models import Comment, Post, Vote
+
+BLOCK_SIZE = 64 * 1024
+
+# kind -> (table, columns exported, columns ordered by)
+EXPORTS = {
+    "posts": (Post.__table__, ("id", "author_id", "title", "body", "timestamp", "upvote_count", "downvote_count",
+                               "version", "comment_count", "last_comment_at"), ("id",)),
+    "comments": (Comment.__table__, ("id", "post_id", "author_id", "body", "timestamp", "disabled"), ("id",)),
+    "votes": (Vote.__table__, ("post_id", "voter_id", "vote_type", "timestamp"), ("post_id", "voter_id")),
+}
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+# The rows of kind (a key of EXPORTS) with a timestamp at or after since (all if None), as dicts
+def export_rows(kind: str, since: datetime = None, chunk_size: int = 1000):
+    table, columns, order = EXPORTS[kind]
+    query = db.select(*[table.c[name] for name in columns]).order_by(*[table.c[name] for name in order])
+    if since is not None:
+        query = query.where(table.c.timestamp >= since)
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results = True).execute(query).yield_per(chunk_size)
+        for row in result:
+            yield dict(row._mapping)
+
+# The NDJSON of the rows, in blocks of bytes, gzipped if compress
+def export_ndjson(kind: str, since: datetime = None, compress: bool = False, chunk_size: int = 1000):
+    # wbits 31 makes a gzip stream (with header and trailer) rather than a raw zlib one
+    compressor = zlib.compressobj(wbits = 31) if compress else None
+    block = []
+    size = 0
+    for row in export_rows(kind, since, chunk_size):
+        line = json.dumps(row, default = _default, separators = (",", ":")) + "\n"
+        block.append(line)
+        size += len(line)
+        if size >= BLOCK_SIZE:
+            data = "".join(block).encode("utf-8")
+            block, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = "".join(block).encode("utf-8")
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
@@ -7,7 +7,7 @@ fake = Faker()
 class ModeratorUser(User):
     def __init__(self,**kwargs):
         super().__init__(**kwargs)
-        self.role = db.session.query(Role).filter_by(name = "Moderator").first() 
+        self.role_id = role_cache.by_name("Moderator").id
    
     __mapper_args__ = {
         "polymorphic_identity": "ModeratorUser",
@@ -16,7 +16,7 @@ class ModeratorUser(User):
 class AdminUser(User):
     def __init__(self,**kwargs):
         super().__init__(**kwargs)
-        self.role = db.session.query(Role).filter_by(name = "Administrator").first() 
+        self.role_id = role_cache.by_name("Administrator").id
 
     __mapper_args__ = {
         "polymorphic_identity": "AdministratorUser",
@@ -25,7 +25,7 @@ class AdminUser(User):
 class GenericUser(User):
     def __init__(self,**kwargs):
         super().__init__(**kwargs)
-        self.role = db.session.query(Role).filter_by(name = "User").first() 
+        self.role_id = role_cache.by_name("User").id
 
     __mapper_args__ = {
         "polymorphic_identity": "GenericUser",
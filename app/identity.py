@@ -0,0 +1,149 @@
+# The logged-in user, as served to Flask-Login's current_user.
+#
+# Loading the User (and then its role, for every current_user.can()) from the database on every request is
+# two queries before a view does anything. Most requests only need a handful of the user's fields, so
+# load_identity() keeps a snapshot of those in a bounded, TTL'd cache (app.extensions["caches"]["identities"])
+# and serves current_user from it.
+#
+# Anything not in the snapshot (e.g. current_user.follow(), current_user.following_posts) is read from the full
+# User, which is loaded from the database the first time it's needed in a request.
+# Views that change the user, or give it to the ORM (e.g. as the author of a post), must use current_user.user,
+# which is that full User.
+#
+# The snapshot of a user is dropped with forget_identity() when the fields in it change (see edit_profile and
+# edit_profile_admin) or the user is deleted, and all snapshots are dropped when a role changes.
+# The other gunicorn workers learn about it from the modification time of a file per user ("user:<id>", and "roles"
+# for all of them) in BLOGGING_IDENTITY_TAG_DIR, with TagVersions like the page cache (see page_cache.py): a snapshot
+# taken before its file was touched is not served, but taken again. With the directory set to None (e.g. in the tests)
+# the times are kept in memory, for this process only.
+
+import time
+from collections import namedtuple
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from . import db
+from .models import Permission, Role, User
+
+# taken_at is in nanoseconds since the epoch, to compare with the tags
+IdentitySnapshot = namedtuple("IdentitySnapshot", ["id", "username", "permissions", "confirmed", "avatar_hash",
+                                                   "taken_at"])
+
+def snapshot_of(user: User, taken_at: int = 0) -> IdentitySnapshot:
+    return IdentitySnapshot(user.id, user.username, user.permissions, user.confirmed, user.avatar_hash, taken_at)
+
+def _tags(user_id: int):
+    return (f"user:{user_id}", "roles")
+
+# A new one is made for every request, around the (shared) snapshot, so the User loaded by one request
+# is never seen by another.
+class CurrentUser(UserMixin):
+    def __init__(self, snapshot: IdentitySnapshot, user: User = None):
+        self._snapshot = snapshot
+        self._user = user
+
+    id = property(lambda self: self._snapshot.id)
+    username = property(lambda self: self._snapshot.username)
+    confirmed = property(lambda self: self._snapshot.confirmed)
+    avatar_hash = property(lambda self: self._snapshot.avatar_hash)
+
+    # The full User, for anything that isn't in the snapshot
+    @property
+    def user(self) -> User:
+        if self._user is None:
+            self._user = db.session.get(User, self._snapshot.id)
+        return self._user
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't defined above
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def can(self, permission: int) -> bool:
+        return self._snapshot.permissions & permission == permission
+    def is_administrator(self) -> bool:
+        return self.can(Permission.ADMIN)
+
+    # Only use avatar_hash and the id, so they don't need the full User
+    gravatar = User.gravatar
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+
+    # UserMixin compares users by id, so current_user == post.author works both ways
+    __eq__ = UserMixin.__eq__
+    __ne__ = UserMixin.__ne__
+    def __hash__(self):
+        return hash(self._snapshot.id)
+
+    def __repr__(self):
+        return '<CurrentUser %r>' % self._snapshot.username
+
+# Used by Flask-Login's user_loader, see models.py
+def load_identity(user_id: int):
+    identities = current_app.extensions["caches"]["identities"]
+    snapshot = identities.get(user_id)
+    if snapshot is not None and not current_app.extensions["identity_tags"].stale(_tags(user_id), snapshot.taken_at):
+        return CurrentUser(snapshot)
+    taken_at = time.time_ns()
+    user = db.session.get(User, user_id)
+    if user is None:
+        identities.delete(user_id)
+        return None
+    snapshot = snapshot_of(user, taken_at)
+    identities.set(user_id, snapshot)
+    return CurrentUser(snapshot, user)
+
+# Call after the change to the user is committed, or a worker could take the snapshot again before it is
+def forget_identity(user_id: int) -> None:
+    if has_app_context() and "identity_tags" in current_app.extensions:
+        current_app.extensions["identity_tags"].invalidate(_tags(user_id)[:1])
+        current_app.extensions["caches"]["identities"].delete(user_id)
+
+def forget_all_identities() -> None:
+    if has_app_context() and "identity_tags" in current_app.extensions:
+        current_app.extensions["identity_tags"].invalidate(["roles"])
+        current_app.extensions["caches"]["identities"].clear()
+
+# The mapper events below run before the commit, so they only note what to forget once it's done.
+# None stands for all identities.
+def _forget_on_commit(target, user_id) -> None:
+    session = object_session(target)
+    if session is None:
+        forget_all_identities() if user_id is None else forget_identity(user_id)
+    else:
+        session.info.setdefault("forgotten_identities", set()).add(user_id)
+
+@event.listens_for(Session, "after_commit")
+def _forget_committed(session):
+    user_ids = session.info.pop("forgotten_identities", None)
+    if not user_ids:
+        return
+    if None in user_ids:
+        forget_all_identities()
+    else:
+        for user_id in user_ids:
+            forget_identity(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def _keep_rolled_back(session):
+    session.info.pop("forgotten_identities", None)
+
+# The permissions of a role are in the snapshots of all its users, so forget them all. The "roles" tag also makes the
+# other workers read the roles again (see RoleCache in models.py), so this is for any change to the roles.
+@db.event.listens_for(Role, 'after_insert')
+@db.event.listens_for(Role, 'after_delete')
+def forget_identities_on_role_change(mapper, connection, target):
+    _forget_on_commit(target, None)
+
+@db.event.listens_for(Role, 'after_update')
+def forget_identities_on_role_update(mapper, connection, target):
+    if any(attr.history.has_changes() for attr in sqlalchemy.inspect(target).attrs):
+        _forget_on_commit(target, None)
+
+# A deleted user must not stay logged in from its cached identity
+@db.event.listens_for(User, 'after_delete', propagate = True)
+def forget_deleted_user_identity(mapper, connection, target):
+    _forget_on_commit(target, target.id)
@@ -0,0 +1,117 @@
+# Write-behind buffering of users' last_seen times.
+#
+# Every request from a logged-in user updates users.last_seen. Committing that UPDATE on every request
+# (what User.ping() does) costs an extra write transaction per page view and per /vote call, and on SQLite
+# every write takes the database-wide write lock.
+# Instead, the time is only recorded in memory here:
+#   - a user seen again within BLOGGING_LAST_SEEN_GRANULARITY seconds of the last recorded time is skipped,
+#     since last_seen doesn't need to be more precise than that
+#   - the recorded times are written to the database together, in one executemany UPDATE, at the end of
+#     a request once BLOGGING_LAST_SEEN_FLUSH_INTERVAL seconds have passed since the last flush, and when
+#     the process exits
+#   - if no request comes to do that, a daemon timer started at the end of the request that left times pending
+#     writes them when the interval is over, so even an idle worker writes every time within about
+#     BLOGGING_LAST_SEEN_FLUSH_INTERVAL seconds (unless it is killed before, e.g. with SIGKILL)
+# Each gunicorn worker has its own buffer. The UPDATE only ever moves last_seen forward
+# (WHERE last_seen < the new time), so workers flushing in any order can't overwrite a newer time with an older one.
+
+import atexit
+from datetime import datetime, timedelta
+from threading import Lock, Timer
+from time import monotonic
+from sqlalchemy import bindparam, or_
+
+class LastSeenBuffer:
+    def __init__(self, granularity: float = 60, flush_interval: float = 10):
+        self.granularity = timedelta(seconds = granularity)
+        self.flush_interval = flush_interval
+        self._recorded = {} # user id -> last time recorded, to skip the ones within granularity
+        self._pending = {}  # user id -> time not written to the database yet
+        self._lock = Lock()
+        self._last_flush = monotonic()
+        self._timer = None
+
+    # Record that the user with id user_id was seen now. Returns whether it will be written.
+    def record(self, user_id: int, now: datetime = None) -> bool:
+        now = now or datetime.utcnow()
+        with self._lock:
+            last = self._recorded.get(user_id)
+            if last is not None and now - last < self.granularity:
+                return False
+            self._recorded[user_id] = now
+            self._pending[user_id] = now
+            return True
+
+    def flush_due(self) -> bool:
+        return bool(self._pending) and monotonic() - self._last_flush >= self.flush_interval
+
+    # Write the pending times with one UPDATE statement, in a transaction of its own.
+    # Returns the number of users written. If it fails, the times stay pending for the next flush.
+    def flush(self, engine) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = monotonic()
+            # Times older than the granularity wouldn't skip anything any more, so forget them to keep this small
+            cutoff = datetime.utcnow() - self.granularity
+            self._recorded = {user_id: seen for user_id, seen in self._recorded.items() if seen >= cutoff}
+        if not pending:
+            return 0
+        from .models import User
+        users = User.__table__
+        update = users.update()\
+                    .where(users.c.id == bindparam("user_id"))\
+                    .where(or_(users.c.last_seen == None, users.c.last_seen < bindparam("seen")))\
+                    .values(last_seen = bindparam("seen"))
+        try:
+            with engine.begin() as connection:
+                connection.execute(update, [{"user_id": user_id, "seen": seen} for user_id, seen in pending.items()])
+        except Exception:
+            with self._lock:
+                for user_id, seen in pending.items():
+                    # Unless the user was seen again meanwhile
+                    if self._pending.get(user_id, seen) <= seen:
+                        self._pending[user_id] = seen
+            raise
+        return len(pending)
+
+    # Flush in a daemon thread once the flush interval is over, unless that is already planned
+    def flush_later(self, app, db) -> None:
+        with self._lock:
+            if self._timer is not None or not self._pending:
+                return
+            delay = max(0, self.flush_interval - (monotonic() - self._last_flush))
+            self._timer = Timer(delay, self._flush_from_timer, args = (app, db))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_from_timer(self, app, db) -> None:
+        with self._lock:
+            self._timer = None
+        with app.app_context():
+            self._flush_or_log(app, db)
+
+    # A failed write must not fail the request it runs after (or kill the timer); the times are tried again later
+    def _flush_or_log(self, app, db) -> None:
+        try:
+            self.flush(db.engine)
+        except Exception:
+            app.logger.exception("Writing last_seen failed")
+            self.flush_later(app, db)
+
+    # Set up the buffer for app: flush at the end of requests when due (or later from a timer), and when the
+    # process exits.
+    def init_app(self, app, db) -> None:
+        app.extensions["last_seen"] = self
+
+        @app.teardown_request
+        def flush_last_seen(exc):
+            if self.flush_due():
+                self._flush_or_log(app, db)
+            else:
+                self.flush_later(app, db)
+
+        def flush_at_exit():
+            if self._pending:
+                with app.app_context():
+                    self.flush(db.engine)
+        atexit.register(flush_at_exit)
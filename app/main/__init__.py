@@ -7,10 +7,16 @@ from app.models import Permission
 # The blueprint function below takes in the name of the blueprint, and the module where the blueprint is located (i.e. __name__, which means in this folder)
 main = Blueprint('main', __name__)
 from . import views, errors
+from .fragments import render_post_fragment
 
 # The context processor below is added so that every render_template() call will make Permission available for jinja2.
 # Thus you don't have to do render_template(yourOtherArguments, Permission=Permission) everytime you want to render a page that
 # requires Permission
 @main.app_context_processor
 def inject_permissions():
-    return dict(Permission=Permission)
\ No newline at end of file
+    return dict(Permission=Permission)
+
+# post_fragment(post) gives the cached, viewer-independent HTML of a post for _posts.html, see fragments.py
+@main.app_context_processor
+def inject_post_fragment():
+    return dict(post_fragment=render_post_fragment)
\ No newline at end of file
@@ -1,9 +1,16 @@
 from . import main
-from flask import render_template
+from flask import flash, redirect, render_template, request
+from app.exceptions import ValidationError
 
 @main.errorhandler(404)
 def page_not_found(e):
     return render_template("404.html"), 404
 @main.errorhandler(500)
 def internal_server_error(e):
-    return render_template("500.html"), 500
\ No newline at end of file
+    return render_template("500.html"), 500
+# Raised e.g. when a ?cursor= in the URL is not a valid page cursor (see pagination.py).
+# Start from the first page of the same list instead.
+@main.errorhandler(ValidationError)
+def validation_error(e):
+    flash(e.args[0])
+    return redirect(request.path)
@@ -0,0 +1,35 @@
+# Queries used to build the lists of posts shown in the feeds (index, user and post pages) and
+# returned by the API.
+#
+# Rendering a post needs its author. Loaded lazily, that is one extra query per post (the N+1 problem), so a
+# page of 50 posts would cost 50+ queries. feed_query() instead loads them for the whole page at once, so a page
+# costs the same small number of queries no matter how many posts are on it:
+#   1. the posts themselves
+#   2. the authors of those posts (selectinload, i.e. SELECT ... WHERE users.id IN (...))
+# The authors' roles are not loaded: permission checks read them from role_cache (see models.py).
+# Vote tallies and comment counts don't need anything extra since they are columns on the posts table.
+
+from sqlalchemy.orm import selectinload
+from .. import db
+from ..models import Post
+
+# Start a feed query from query (e.g. current_user.following_posts), or from all posts if not given.
+# Filter, order and paginate the result like any other query on Post.
+def feed_query(query = None):
+    if query is None:
+        query = db.session.query(Post)
+    return query.options(selectinload(Post.author))
+
+# The following feed of user (the posts of the users they follow), for keyset_paginate().
+# Returns the query and the columns to order it by. These are the columns of the user's timeline
+# (see User.timeline) rather than of posts, so that the database reads the feed as a range scan
+# of the timelines index.
+def following_feed(user):
+    timeline = user.timeline()
+    query = feed_query(db.session.query(Post).join(timeline, timeline.c.id == Post.id))
+    return query, (timeline.c.timestamp, timeline.c.id)
+
+# The "recently active" feed: the posts with comments, the most recently commented on first, for keyset_paginate().
+# Returns the query and the columns to order it by, which the ix_posts_last_comment_at index covers.
+def active_feed():
+    return feed_query().filter(Post.last_comment_at != None), (Post.last_comment_at, Post.id)
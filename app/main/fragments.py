@@ -0,0 +1,36 @@
+# Cache of the rendered HTML of posts.
+#
+# Most of what _posts.html renders for a post is the same for every viewer: the author's name and gravatar,
+# the title and the body. Rendering that (url_for calls, gravatar URLs, moment, the HTML of title and body)
+# for every post on every request is wasted work, so that part is rendered from _post_fragment.html once
+# and cached by render_post_fragment() below. _posts.html puts the parts that depend on the viewer
+# (the vote arrows and count, the edit buttons) around the cached fragment.
+#
+# The cache key contains everything the fragment is rendered from that can change:
+#   - post.version, which is incremented whenever the title or body is edited (see Post.bump_version)
+#   - the author's username and avatar hash, which change when their profile is edited
+# so an outdated fragment is never served, in any worker; it just stops being used and falls out of the cache.
+# Votes don't invalidate anything since the vote count is not part of the fragment; it is read from
+# the post's upvote_count/downvote_count columns, which is cheap.
+
+from collections import namedtuple
+from flask import current_app
+from markupsafe import Markup
+
+PostFragment = namedtuple("PostFragment", ["author", "title", "body"])
+
+def post_fragment_cache():
+    return current_app.extensions["caches"]["post_fragments"]
+
+def render_post_fragment(post) -> PostFragment:
+    author = post.author
+    key = (post.id, post.version, author.username if author else None, author.avatar_hash if author else None)
+    return post_fragment_cache().get_or_create(key, lambda: _render(post))
+
+def _render(post) -> PostFragment:
+    context = {"post": post}
+    current_app.update_template_context(context)
+    # The fragment template sets one variable per part ({% set author %}...{% endset %} etc.),
+    # which make_module() exposes as attributes.
+    fragment = current_app.jinja_env.get_template("_post_fragment.html").make_module(context)
+    return PostFragment(Markup(fragment.author), Markup(fragment.title), Markup(fragment.body))
@@ -1,3 +1,4 @@
+import hmac
 from datetime import datetime
 from flask import current_app, flash, jsonify, make_response, render_template, render_template_string, request, session, redirect, url_for, abort
 from flask_login import current_user, login_required
@@ -5,44 +6,73 @@ from sqlalchemy import and_
 from sqlalchemy.exc import SQLAlchemyError, DBAPIError
 # the below imports the blueprint called "main" from __init__.py
 from . import main
+from .feeds import active_feed, feed_query, following_feed
 from .forms import EditProfileAdminForm, EditProfileForm, PostForm, CommentForm
 from .. import db
-from ..models import Permission, Role, User, Post, Comment, Vote
+from ..models import Permission, Role, User, Post, Comment, Vote, Follow, TimelineEntry
 from ..decorators import admin_required, permission_required
+from ..identity import forget_identity
+from ..page_cache import post_tags, tag_page
+from ..pagination import keyset_paginate
+from ..search import search
+
+# Look up the current user's votes on the posts about to be rendered, in one query.
+# _posts.html uses the returned dict to decide which vote arrows to highlight.
+def vote_states_for(posts) -> dict:
+    if not current_user.is_authenticated:
+        return {}
+    return Vote.states_for(current_user.id, [post.id for post in posts])
 
 @main.route('/', methods=["GET","POST"])
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
-        post = Post(title = form.title.data, body = form.text.data, author = current_user._get_current_object())
+        post = Post(title = form.title.data, body = form.text.data, author = current_user.user)
         db.session.add(post)
+        # The post needs an id before it can be copied into the followers' timelines
+        db.session.flush()
+        TimelineEntry.fan_out(post)
         db.session.commit()
         return redirect(url_for("main.index"))
-    page = request.args.get('page', 1, type=int)
-    # type=int is so that if 'page' is not an integer, the default value 1 is returned
     only_following_posts = False
     if current_user.is_authenticated:
         only_following_posts = bool(request.cookies.get('only_following_posts', ''))
     if only_following_posts:
-        query = current_user.following_posts
+        query, order = following_feed(current_user)
     else:
-        query = Post.query
-    pagination: "flask_sqlalchemy.Pagination" = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["BLOGGING_POSTS_PER_PAGE"],
-        error_out = False
-    )
-    # all() is now replaced with paginate() method.
-    # error_out sets what happens if page that is out of range is returned. If True, we go to 404 page,
-    # if false, it will return an empty list.
-    # desc() orders the column entry in descending order
+        query, order = feed_query(), (Post.timestamp, Post.id)
+    # Pages are addressed by a ?cursor= token instead of a page number, so deep pages
+    # are as cheap as the first one (see pagination.py). Newest posts come first.
+    pagination: "KeysetPagination" = keyset_paginate(query, order,
+                                                     cursor = request.args.get('cursor'),
+                                                     per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
     posts = pagination.items
+    tag_page("posts", *post_tags(posts))
     return render_template("index.html",
                             current_time = datetime.utcnow(),
                             form = form,
                             posts = posts,
+                            vote_states = vote_states_for(posts),
                             only_following_posts = only_following_posts,
                             pagination = pagination)
 
+# The posts with the most recent comments first, for everyone. The post form of the page still posts to the index.
+@main.route('/active')
+def active():
+    query, order = active_feed()
+    pagination: "KeysetPagination" = keyset_paginate(query, order,
+                                                     cursor = request.args.get('cursor'),
+                                                     per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
+    posts = pagination.items
+    tag_page("active", *post_tags(posts))
+    return render_template("index.html",
+                            current_time = datetime.utcnow(),
+                            form = PostForm(),
+                            posts = posts,
+                            vote_states = vote_states_for(posts),
+                            recently_active = True,
+                            pagination = pagination)
+
 # /all and /following routes sets whether the posts to be shown is all or just those
 # of the users the currently logged in user follows. The set_cookie option makes it
 # so that the browser of the user remembers the choice.
@@ -67,19 +97,24 @@ def user(username):
     if user is None:
         flash(f"User {username} not found")
         abort(404)    
-    posts = user.posts.order_by(Post.timestamp.desc()).all()
-    return render_template("user.html", user = user, posts = posts)
+    posts = feed_query().filter(Post.author_id == user.id).order_by(Post.timestamp.desc()).all()
+    tag_page(f"user:{user.id}", f"posts-by:{user.id}", *post_tags(posts))
+    return render_template("user.html", user = user, posts = posts,
+                            vote_states = vote_states_for(posts))
 
 @main.route("/edit_profile", methods=["GET","POST"])
 @login_required
 def edit_profile():
     form = EditProfileForm()
     if form.validate_on_submit():
-       current_user.name = form.name.data
-       current_user.location = form.location.data
-       current_user.about_me = form.about_me.data
-       db.session.add(current_user)
+       # current_user is a cached snapshot of the user (see identity.py), so change the User itself
+       user = current_user.user
+       user.name = form.name.data
+       user.location = form.location.data
+       user.about_me = form.about_me.data
+       db.session.add(user)
        db.session.commit()
+       forget_identity(user.id)
        flash("Your profile has been successfully updated!")
        return redirect(url_for("main.user", username=current_user.username))
     form.name.data = current_user.name
@@ -104,6 +139,8 @@ def edit_profile_admin(id):
        user.role = db.session.query(Role).get(form.role.data)
        db.session.add(user)
        db.session.commit()
+       # The username, confirmed and role are in the user's cached identity
+       forget_identity(user.id)
        flash(f"Profile has been successfully updated!")
        return redirect(url_for("main.user", username=db.session.query(User).get(id)))
     form.name.data = user.name
@@ -123,23 +160,66 @@ def edit_profile_admin(id):
 def for_admins_only():
     return "For Administrators only!"
 
+# Hit/miss statistics of the in-process caches (see cache.py) of the worker that handles this request
+@main.route('/admin/cache')
+@login_required
+@admin_required
+def cache_stats():
+    return jsonify({name: cache.stats() for name, cache in current_app.extensions["caches"].items()})
+
+# Request metrics of all workers in the Prometheus text format (see metrics.py), for admins or a scraper
+# with the token of BLOGGING_METRICS_TOKEN
+@main.route('/metrics')
+def metrics():
+    token = current_app.config["BLOGGING_METRICS_TOKEN"]
+    sent = request.headers.get("Authorization", "")
+    if not (token and hmac.compare_digest(sent.encode(), f"Bearer {token}".encode())):
+        if not current_user.is_authenticated:
+            abort(401)
+        if not current_user.is_administrator():
+            abort(403)
+    response = make_response(current_app.extensions["metrics"].exposition())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+# Full-text search (see search.py) of posts or, with ?kind=comments, comments; best matches first
+@main.route('/search')
+def search_page():
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('kind', 'posts')
+    if kind not in ('posts', 'comments'):
+        kind = 'posts'
+    model = Post if kind == 'posts' else Comment
+    pagination: "KeysetPagination" = search(model, query,
+                                            cursor = request.args.get('cursor'),
+                                            per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"],
+                                            base_query = feed_query() if model is Post else None)
+    posts = pagination.items if model is Post else []
+    return render_template('search.html',
+                            query = query,
+                            kind = kind,
+                            posts = posts,
+                            vote_states = vote_states_for(posts),
+                            comments = pagination.items if model is Comment else [],
+                            pagination = pagination)
+
 @main.route('/post/<int:id>', methods=["GET","POST"])
 def post(id):
-    post = db.session.query(Post).get_or_404(id)
+    post = feed_query().filter(Post.id == id).first_or_404()
     form = CommentForm()
     if form.validate_on_submit():
-        comment = Comment(author = current_user._get_current_object(), post = post, body = form.text.data)
+        comment = Comment(author = current_user.user, post = post, body = form.text.data)
         db.session.add(comment)
         db.session.commit()
         return redirect(url_for('main.post', id = post.id))
-    page = request.args.get('page', 1, type=int)
-    pagination: "flask_sqlalchemy.Pagination" = post.comments.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config["BLOGGING_POSTS_PER_PAGE"],
-        error_out = False
-    ) 
+    pagination: "KeysetPagination" = keyset_paginate(post.comments, (Comment.timestamp, Comment.id),
+                                                     cursor = request.args.get('cursor'),
+                                                     per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
     comments = pagination.items
+    tag_page(*post_tags([post]), *[f"user:{comment.author_id}" for comment in comments])
     return render_template('post.html',
                             posts = [post], 
+                            vote_states = vote_states_for([post]),
                             form=form,
                             comments = comments,
                             pagination = pagination)
@@ -209,72 +289,39 @@ def unfollow(username):
         flash("You are already not following this user!")
     return redirect(url_for("main.user", username=user.username))
 
-@main.route("/followers/<username>")
-def followers(username: str):
-    # return all followers of the user
-    # also give pagination because there are many users!
-    if username is None:
-        flash("Invalid user input!")
-        return redirect(url_for("main.index"))
-    followersAsFollowInstance = db.session.query(User).filter_by(username=username).first().followers
-    page = request.args.get('page', 1, type=int)
-    pagination: "flask_sqlalchemy.Pagination" = followersAsFollowInstance.paginate(
-        page, per_page=current_app.config["BLOGGING_POSTS_PER_PAGE"],
-        error_out = False
-    )
-    followersCurrentPage = pagination.items
-    fols = [{"username": followerAsFollowInstance.follower.username,
-            "timestamp": followerAsFollowInstance.timestamp,
-            "last_seen": followerAsFollowInstance.follower.last_seen,
-            "about_me": followerAsFollowInstance.follower.about_me,
-            "gravatar": followerAsFollowInstance.follower.gravatar(size=40)}
-            for followerAsFollowInstance in followersCurrentPage]
-    return render_template("followers.html", 
-                            fols = fols,  
-                            page = page,
+# The followers or followings of a user, newest first. The rows come from Follow.listing(), so a page reads a few
+# columns of per_page users whatever the size of the list.
+def follow_list(username: str, followers: bool):
+    user_id = db.session.query(User.id).filter(User.username == username).scalar()
+    if user_id is None:
+        abort(404)
+    query, order = Follow.listing(user_id, followers = followers)
+    pagination: "KeysetPagination" = keyset_paginate(query, order,
+                                                     cursor = request.args.get('cursor'),
+                                                     per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
+    return render_template("followers.html",
+                            fols = pagination.items,
+                            gravatar_url = User.gravatar_url,
                             username = username,
                             pagination = pagination,
-                            title = "followers",
-                            endpoint = "main.followers")
+                            title = "followers" if followers else "followings",
+                            endpoint = "main.followers" if followers else "main.followings")
+
+@main.route("/followers/<username>")
+def followers(username: str):
+    return follow_list(username, followers = True)
 
 @main.route("/followings/<username>")
 def followings(username: str):
-    # return all followers of the user
-    # also give pagination because there are many users!
-    if username is None:
-        flash("Invalid user input!")
-        return redirect(url_for("main.index"))
-    followingsAsFollowInstance = db.session.query(User).filter_by(username=username).first().following
-    page = request.args.get('page', 1, type=int)
-    pagination: "flask_sqlalchemy.Pagination" = followingsAsFollowInstance.paginate(
-        page, per_page=current_app.config["BLOGGING_POSTS_PER_PAGE"],
-        error_out = False
-    )
-    followingsCurrentPage = pagination.items
-    fols = [{"username": followingAsFollowInstance.following.username,
-            "timestamp": followingAsFollowInstance.timestamp,
-            "last_seen": followingAsFollowInstance.following.last_seen,
-            "about_me": followingAsFollowInstance.following.about_me,
-            "gravatar": followingAsFollowInstance.following.gravatar(size=40)}
-            for followingAsFollowInstance in followingsCurrentPage]
-    return render_template("followers.html", 
-                            fols = fols,  
-                            page = page,
-                            username = username,
-                            pagination = pagination,
-                            title = "followings",
-                            endpoint = "main.followings")
+    return follow_list(username, followers = False)
 
 @main.route("/moderate")
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate():
-    page = request.args.get('page', 1, type=int)
-    pagination: "flask_sqlalchemy.Pagination" = db.session.query(Comment).\
-                                                order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config["BLOGGING_POSTS_PER_PAGE"],
-        error_out = False
-    ) 
+    pagination: "KeysetPagination" = keyset_paginate(db.session.query(Comment), (Comment.timestamp, Comment.id),
+                                                     cursor = request.args.get('cursor'),
+                                                     per_page = current_app.config["BLOGGING_POSTS_PER_PAGE"])
     comments = pagination.items
     return render_template("moderate.html", comments = comments, pagination = pagination)
 
@@ -312,6 +359,8 @@ def vote():
     vote_instance = db.session.query(Vote).filter(and_(Vote.post_id == post_id, Vote.voter_id == voter_id)).all()
     if len(vote_instance) > 1:
         raise Exception("something is wrong in vote database! There can't be multiple vote instances for the same post and voter!")
+    # The tallies on the post are updated by the mapper events of Vote (see models.py), in the same transaction
+    # as the vote itself, so they can never disagree with the votes table after a commit.
     if vote_instance:
         vote_instance = vote_instance[0]
         if current_vote != vote_instance.vote_type:
@@ -320,10 +369,7 @@ def vote():
         else:
             db.session.delete(vote_instance)
     else:
-        if current_vote:
-            new_vote = Vote(post_id = post_id, voter_id = voter_id, vote_type = True)
-        else:
-            new_vote = Vote(post_id = post_id, voter_id = voter_id, vote_type = False)
+        new_vote = Vote(post_id = post_id, voter_id = voter_id, vote_type = current_vote)
         db.session.add(new_vote)
     try:
         db.session.commit()
@@ -0,0 +1,174 @@
+# Request metrics in the Prometheus text format, served at /metrics (see main/views.py).
+#
+# For every request, by Flask endpoint (e.g. main.index, api.get_posts):
+#   blogging_http_requests_total                  counter of requests, also by method and status
+#   blogging_http_request_duration_seconds        histogram of the time to handle the request
+#   blogging_http_db_duration_seconds             histogram of the time spent in SQL (from query_stats.py)
+#   blogging_http_response_size_bytes             histogram of the size of the response body
+#
+# gunicorn runs several worker processes, and a scrape only reaches one of them, so the numbers of all workers have
+# to be added up. Without an external service (statsd, a push gateway) to collect them, every worker keeps its
+# numbers in memory and writes them to its own file, <BLOGGING_METRICS_DIR>/<pid>.json, at the end of a request at
+# most every BLOGGING_METRICS_FLUSH_INTERVAL seconds and when it exits. /metrics adds up all the files.
+# The files of workers that have exited are kept, so that the counters never go down; boot.sh empties the
+# directory when the server starts.
+# With BLOGGING_METRICS_DIR set to None (e.g. in the tests) nothing is written, and /metrics shows this process only.
+
+import atexit, json, math, os, threading
+from collections import defaultdict
+from time import monotonic, perf_counter
+from flask import g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# name -> (type, help, buckets of a histogram)
+METRICS = {
+    "blogging_http_requests_total": ("counter", "Requests handled, by endpoint, method and status.", None),
+    "blogging_http_request_duration_seconds": ("histogram", "Time to handle a request, by endpoint.", LATENCY_BUCKETS),
+    "blogging_http_db_duration_seconds": ("histogram", "Time spent executing SQL in a request, by endpoint.", LATENCY_BUCKETS),
+    "blogging_http_response_size_bytes": ("histogram", "Size of the response body, by endpoint.", SIZE_BUCKETS),
+}
+
+# Labels are kept as a tuple of (name, value) pairs, so they can be dict keys; in the files they are
+# written as "name=value,name=value" strings.
+def _labels_key(labels: tuple) -> str:
+    return ",".join(f"{name}={value}" for name, value in labels)
+
+def _labels_of(key: str) -> tuple:
+    return tuple(tuple(pair.split("=", 1)) for pair in key.split(",")) if key else ()
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+# The metrics of one process
+class Registry:
+    def __init__(self, directory: str = None, flush_interval: float = 1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._last_flush = monotonic()
+        # counter name -> labels -> value
+        self.counters = defaultdict(lambda: defaultdict(float))
+        # histogram name -> labels -> [count per bucket (not cumulative) + the +Inf one, sum]
+        self.histograms = defaultdict(dict)
+
+    def inc(self, name: str, labels: tuple, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[name][labels] += amount
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        buckets = METRICS[name][2]
+        with self._lock:
+            series = self.histograms[name].get(labels)
+            if series is None:
+                series = self.histograms[name][labels] = [0] * (len(buckets) + 1) + [0.0]
+            index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+            series[index] += 1
+            series[-1] += value
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"counters": {name: {_labels_key(labels): value for labels, value in series.items()}
+                                 for name, series in self.counters.items()},
+                    "histograms": {name: {_labels_key(labels): list(values) for labels, values in series.items()}
+                                   for name, series in self.histograms.items()}}
+
+    # Write this process' file, atomically so /metrics in another worker never reads half of it
+    def flush(self) -> None:
+        if self.directory is None:
+            return
+        self._last_flush = monotonic()
+        os.makedirs(self.directory, exist_ok = True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temporary, path)
+
+    def flush_due(self) -> bool:
+        return self.directory is not None and monotonic() - self._last_flush >= self.flush_interval
+
+    # The metrics of all processes, added up, in the Prometheus text format
+    def exposition(self) -> str:
+        snapshots = [self.to_dict()]
+        if self.directory is not None:
+            self.flush()
+            snapshots = []
+            for filename in sorted(os.listdir(self.directory)):
+                if not filename.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # a worker's file that disappeared or is being replaced; it'll be there next time
+        counters = defaultdict(lambda: defaultdict(float))
+        histograms = defaultdict(dict)
+        for snapshot in snapshots:
+            for name, series in snapshot.get("counters", {}).items():
+                for key, value in series.items():
+                    counters[name][key] += value
+            for name, series in snapshot.get("histograms", {}).items():
+                for key, values in series.items():
+                    total = histograms[name].setdefault(key, [0] * len(values))
+                    histograms[name][key] = [a + b for a, b in zip(total, values)]
+        lines = []
+        for name, (kind, help, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for key, value in sorted(counters[name].items()):
+                    lines.append(f"{name}{_format_labels(_labels_of(key))} {_format_value(value)}")
+                continue
+            for key, values in sorted(histograms[name].items()):
+                labels = _labels_of(key)
+                cumulative = 0
+                for bound, count in zip(buckets + (math.inf,), values):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(values[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def init_app(app) -> Registry:
+    registry = Registry(app.config["BLOGGING_METRICS_DIR"], app.config["BLOGGING_METRICS_FLUSH_INTERVAL"])
+    app.extensions["metrics"] = registry
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = perf_counter()
+
+    # Flask runs the after_request functions in the reverse order they were added. This one is added after
+    # query_stats', so it runs first and can still read the request's query stats.
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.pop("request_started", None)
+        if started is None:
+            return response
+        endpoint = (("endpoint", request.endpoint or "unmatched"),)
+        registry.inc("blogging_http_requests_total",
+                     endpoint + (("method", request.method), ("status", str(response.status_code))))
+        registry.observe("blogging_http_request_duration_seconds", endpoint, perf_counter() - started)
+        query_stats = g.get("query_stats")
+        if query_stats is not None:
+            registry.observe("blogging_http_db_duration_seconds", endpoint, query_stats.seconds)
+        size = response.calculate_content_length() if not response.direct_passthrough else response.content_length
+        registry.observe("blogging_http_response_size_bytes", endpoint, size or 0)
+        if registry.flush_due():
+            registry.flush()
+        return response
+
+    if registry.directory is not None:
+        atexit.register(registry.flush)
+    return registry
@@ -1,21 +1,23 @@
 # the import below imports db from __init__.py
+from collections import namedtuple
 from datetime import datetime
-import hashlib
-import bleach
-from flask import current_app, url_for
+import hashlib, time
+from flask import current_app, has_app_context, url_for
 from itsdangerous import Serializer
-from markdown import markdown
 import sqlalchemy
 from . import db, login_manager
+from .rendering import render_markdown
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import AnonymousUserMixin, UserMixin
 from app.exceptions import ValidationError
 
 # This decorator is used to help the login manager
 # to get info about the logged-in user.
+# The user is served from a cached snapshot where possible, see identity.py.
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, {"id": int(user_id)})
+    from .identity import load_identity
+    return load_identity(int(user_id))
 
 class Permission:
     FOLLOW = 1
@@ -37,6 +39,26 @@ class Follow(db.Model):
     following_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                             primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # The lists of followers and followings are read newest first, see listing() below
+    __table_args__ = (db.Index('ix_follows_following_id_timestamp', 'following_id', 'timestamp', 'follower_id'),
+                      db.Index('ix_follows_follower_id_timestamp', 'follower_id', 'timestamp', 'following_id'))
+
+    # Length of the about_me excerpt in the lists
+    ABOUT_ME_EXCERPT = 200
+
+    # The followers of user_id (or, with followers = False, the users user_id follows) for keyset_paginate(), as
+    # plain rows of only what the lists show: the timestamp of the follow, the other user's id, username, avatar_hash
+    # and last_seen, and the start of their about_me. No Follow or User objects are made, and a page is one range
+    # scan of one of the indexes above joined to users by primary key, however many followers the user has.
+    # Returns the query and the columns to order it by.
+    @staticmethod
+    def listing(user_id: int, followers: bool = True):
+        own, other = (Follow.following_id, Follow.follower_id) if followers else (Follow.follower_id, Follow.following_id)
+        query = db.session.query(Follow.timestamp, other, User.username, User.avatar_hash, User.last_seen,
+                                 sqlalchemy.func.substr(User.about_me, 1, Follow.ABOUT_ME_EXCERPT).label("about_me"))\
+                    .join(User, User.id == other)\
+                    .filter(own == user_id)
+        return query, (Follow.timestamp, other)
 
 class Vote(db.Model):
     __tablename__ = 'votes'
@@ -44,9 +66,126 @@ class Vote(db.Model):
                             primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'),
                             primary_key=True)
-    vote_type = db.Column(db.Boolean, unique = False) # True is upvote, False is downvote
+    # True is upvote, False is downvote. active_history, like Comment.disabled, so the tallies of the post can be moved
+    # when a vote is changed
+    vote_type = db.column_property(db.Column(db.Boolean, unique = False), active_history = True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Get how a voter voted on the given posts, as a dict of post_id -> vote_type (True for upvote,
+    # False for downvote). Posts the voter didn't vote on are not in the dict.
+    # This is one query on the primary key (voter_id, post_id) regardless of how many votes the voter
+    # has made in total, so use it to render a page of posts instead of User.upvoted_posts/downvoted_posts.
+    @staticmethod
+    def states_for(voter_id: int, post_ids) -> dict:
+        post_ids = list(post_ids)
+        if voter_id is None or not post_ids:
+            return {}
+        rows = db.session.query(Vote.post_id, Vote.vote_type)\
+                .filter(Vote.voter_id == voter_id, Vote.post_id.in_(post_ids))
+        return {post_id: vote_type for post_id, vote_type in rows}
+
+# The class TimelineEntry corresponds to the table "timelines", the materialized "following" feed of every user.
+# There is one row per (follower, post of someone they follow), so reading a user's following feed is a range scan
+# of the (user_id, timestamp, post_id) index, instead of joining posts to follows and sorting all the posts of everyone
+# they follow (see User.following_posts).
+# The rows are written when something changes instead of computed when the feed is read ("fan-out on write"):
+#   - a new post is copied into the timelines of its author's followers (fan_out, called by the views that create posts)
+#   - following someone copies their recent posts into the follower's timeline (backfill, called by User.follow)
+#   - unfollowing someone removes their posts from the follower's timeline (prune, called by User.unfollow)
+# Authors with more than BLOGGING_TIMELINE_FANOUT_LIMIT followers would make every post of theirs write that many rows,
+# so they are switched to "pull" instead (User.timeline_pull): their posts are not copied, but merged in when the feed
+# is read (see User.timeline).
+# If the table gets out of sync (e.g. after restoring a backup), rebuild it with flask rebuildtimelines.
+class TimelineEntry(db.Model):
+    __tablename__ = 'timelines'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    timestamp = db.Column(db.DateTime) # Copy of posts.timestamp, so the feed can be sorted without touching posts
+    __table_args__ = (db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp', 'post_id'),)
+
+    # Copy a newly created post into the timelines of the followers of its author.
+    # The post has to be flushed already (i.e. have an id); the caller commits.
+    @staticmethod
+    def fan_out(post) -> None:
+        author = post.author
+        if author is None or author.timeline_pull:
+            return
+        if (author.follower_count or 0) > current_app.config["BLOGGING_TIMELINE_FANOUT_LIMIT"]:
+            # From now on the posts of this author are pulled when reading; the ones already fanned out stay,
+            # User.timeline() removes the duplicates.
+            author.timeline_pull = True
+            db.session.add(author)
+            return
+        followers = db.session.query(Follow.follower_id,
+                                     sqlalchemy.literal(post.id),
+                                     sqlalchemy.literal(post.author_id),
+                                     sqlalchemy.literal(post.timestamp, sqlalchemy.DateTime))\
+                        .filter(Follow.following_id == post.author_id)
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            ["user_id", "post_id", "author_id", "timestamp"], followers))
+
+    # fan_out() for many new posts of one author, given by their ids, with one statement per chunk_size posts
+    @staticmethod
+    def fan_out_many(author, post_ids, chunk_size: int = 1000) -> None:
+        if author.timeline_pull or not post_ids:
+            return
+        if (author.follower_count or 0) > current_app.config["BLOGGING_TIMELINE_FANOUT_LIMIT"]:
+            author.timeline_pull = True
+            db.session.add(author)
+            return
+        for chunk in range(0, len(post_ids), chunk_size):
+            entries = db.session.query(Follow.follower_id, Post.id, Post.author_id, Post.timestamp)\
+                        .join(Post, Post.author_id == Follow.following_id)\
+                        .filter(Follow.following_id == author.id, Post.id.in_(post_ids[chunk:chunk + chunk_size]))
+            db.session.execute(TimelineEntry.__table__.insert().from_select(
+                ["user_id", "post_id", "author_id", "timestamp"], entries))
+
+    # Copy the most recent (up to BLOGGING_TIMELINE_BACKFILL) posts of author into the timeline of follower,
+    # for when follower starts following author.
+    @staticmethod
+    def backfill(follower, author) -> None:
+        if author.timeline_pull:
+            return
+        posts = db.session.query(sqlalchemy.literal(follower.id), Post.id, Post.author_id, Post.timestamp)\
+                    .filter(Post.author_id == author.id)\
+                    .order_by(Post.timestamp.desc())\
+                    .limit(current_app.config["BLOGGING_TIMELINE_BACKFILL"])
+        db.session.execute(TimelineEntry.__table__.insert().from_select(
+            ["user_id", "post_id", "author_id", "timestamp"], posts))
+
+    # Remove the posts of author from the timeline of follower, for when follower unfollows author.
+    @staticmethod
+    def prune(follower, author) -> None:
+        db.session.query(TimelineEntry)\
+            .filter(TimelineEntry.user_id == follower.id, TimelineEntry.author_id == author.id)\
+            .delete(synchronize_session = False)
+
+    # Throw away all timelines and build them again from the follows and posts tables, chunk_size followers
+    # at a time, with a commit per chunk. Returns the number of timeline entries written.
+    @staticmethod
+    def rebuild(chunk_size: int = 500) -> int:
+        db.session.query(TimelineEntry).delete(synchronize_session = False)
+        db.session.commit()
+        written = 0
+        last_id = 0
+        while True:
+            follower_ids = [follower_id for (follower_id,) in
+                            db.session.query(Follow.follower_id).filter(Follow.follower_id > last_id)
+                                      .group_by(Follow.follower_id).order_by(Follow.follower_id).limit(chunk_size)]
+            if not follower_ids:
+                break
+            last_id = follower_ids[-1]
+            entries = db.session.query(Follow.follower_id, Post.id, Post.author_id, Post.timestamp)\
+                        .join(Post, Post.author_id == Follow.following_id)\
+                        .join(User, User.id == Follow.following_id)\
+                        .filter(Follow.follower_id.in_(follower_ids), User.timeline_pull == False)
+            result = db.session.execute(TimelineEntry.__table__.insert().from_select(
+                ["user_id", "post_id", "author_id", "timestamp"], entries))
+            db.session.commit()
+            written += result.rowcount
+        return written
+
 # A comment belogns to one user, one user can have multiple comments (one to many)
 # A comment belongs to a post, one post can have multiple comments (one to many) 
 # Thus, a comment instance has 2 foreign and primary keys, one for the user making it and one for the post its in
@@ -59,16 +198,30 @@ class Comment(db.Model):
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    disabled = db.Column(db.Integer, default=0)
+    # active_history loads the old value when it is changed on an expired comment, so that the mapper events at the
+    # bottom of this file can tell whether it was shown before
+    disabled = db.column_property(db.Column(db.Integer, default=0), active_history = True)
     
+    # Filter for the comments that are shown, i.e. not disabled by a moderator
+    @staticmethod
+    def visible():
+        return sqlalchemy.or_(Comment.disabled == None, Comment.disabled == 0)
+
+    # See rendering.py on how the markdown is made safe to show
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        if value == oldvalue and target.body_html is not None:
+            return
+        target.body_html = render_markdown(value)
+
+    def to_json(self):
+        return {
+            "body": self.body,
+            "body_html": self.body_html,
+            "timestamp": self.timestamp,
+            "author_url": url_for("api.get_user", id=self.author_id),
+            "post_url": url_for("api.get_post", id=self.post_id)
+        }
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
 
@@ -93,9 +246,19 @@ class User(UserMixin, db.Model):
     # More info: https://docs.sqlalchemy.org/en/14/orm/inheritance.html
     __mapper_args__ = {"polymorphic_on": type, "polymorphic_identity": "user"}
     avatar_hash = db.Column(db.String(32)) #store avatar hash because computing hash is expensive
+    # True for authors with too many followers to copy each of their posts into every follower's timeline.
+    # Their posts are read from the posts table instead; see TimelineEntry.
+    timeline_pull = db.Column(db.Boolean, default = False, server_default = sqlalchemy.false(), nullable = False)
     # db.ForeignKey('roles.id') means the role_id gets its value from
     # id column of roles table.
     # More info on what index is: https://dataschool.com/sql-optimization/how-indexing-works/
+    # Number of posts the user wrote, of users following them and of users they follow, denormalized here so that
+    # showing a profile doesn't count the posts and follows tables. They are kept up to date by the mapper events of
+    # Post and Follow (see the bottom of this file), i.e. by follow()/unfollow(), creating and deleting posts and the
+    # cascades of deleting a user, and can be rebuilt with flask reconcileusers.
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    follower_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    following_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     posts: sqlalchemy.orm.Query = db.relationship('Post', backref = 'author', lazy = 'dynamic')
     # a db relationship to indicate one to many relationship i.e. one user can have
     # many posts, but one post can only belong to one person.
@@ -163,16 +326,29 @@ class User(UserMixin, db.Model):
         super(User,self).__init__(**kwargs)
         if self.email is not None and self.avatar_hash is None:
             self.avatar_hash = self.gravatar_hash()
-        if self.role is None:
+        # The role is looked up in role_cache, which saves a query per user created
+        if kwargs.get("role") is None and self.role_id is None:
+            role = None
             if(self.email == current_app.config["BLOGGING_ADMIN"]):
-                self.role = Role.query.filter_by(name="Administrator").first()
-            if self.role is None:
-                self.role = Role.query.filter_by(default=True).first()
+                role = role_cache.by_name("Administrator")
+            if role is None:
+                role = role_cache.default()
+            if role is not None:
+                self.role_id = role.id
     
     def __repr__(self):
         return '<User %r>' % self.username
-    def can(self, permission: str) -> bool:
-        return self.role is not None and self.role.has_permission(permission)
+    # The permission bits of the user's role. They are read from role_cache, so checking permissions doesn't
+    # load the role, unless a role was assigned to the user in this session and isn't flushed yet.
+    @property
+    def permissions(self) -> int:
+        role = self.__dict__.get("role")
+        if role is not None:
+            return role.permissions or 0
+        role = role_cache.get(self.role_id) if self.role_id is not None else None
+        return role.permissions if role is not None else 0
+    def can(self, permission: int) -> bool:
+        return self.permissions & permission == permission
     def is_administrator(self) -> bool:
         return self.can(Permission.ADMIN)
     
@@ -193,9 +369,13 @@ class User(UserMixin, db.Model):
         db.session.commit()
 
     def gravatar(self, size=100, default='retro', rating='g'):
+        return User.gravatar_url(self.avatar_hash or self.gravatar_hash(), size, default, rating)
+
+    # The gravatar of an avatar_hash, for rows that aren't a User (e.g. of Follow.listing())
+    @staticmethod
+    def gravatar_url(hash, size=100, default='retro', rating='g'):
         url = "https://www.gravatar.com/avatar"
-        hash = self.avatar_hash or self.gravatar_hash()
-        return f'{url}/{hash}?s={size}&d={default}&r={rating}'
+        return f'{url}/{hash or ""}?s={size}&d={default}&r={rating}'
 
     def gravatar_hash(self):
         return hashlib.md5(self.email.lower().encode('utf-8')).hexdigest()
@@ -204,23 +384,48 @@ class User(UserMixin, db.Model):
         if not self.is_following(user):
             f = Follow(following=user)
             self.following.append(f)
+            TimelineEntry.backfill(self, user)
 
     def unfollow(self, user):
-        f = self.following.filter_by(following_id=user.id).first()
+        if not self.is_following(user):
+            return
+        f = db.session.get(Follow, (self.id, user.id))
         if f:
             self.following.remove(f)
+            TimelineEntry.prune(self, user)
 
+    # These are answered from the in-process index of who follows whom (see social_graph.py), so usually
+    # without a query. They only use the ids of the users.
     def is_following(self, user):
-        if user.id is None:
+        if user.id is None or self.id is None:
             return False
-        return self.following.filter_by(
-            following_id=user.id).first() is not None
+        from .social_graph import follows
+        return follows(self.id, user.id)
 
     def is_followed_by(self, user):
-        if user.id is None:
+        if user.id is None or self.id is None:
             return False
-        return self.followers.filter_by(
-            follower_id=user.id).first() is not None
+        from .social_graph import follows
+        return follows(user.id, self.id)
+
+    # The following feed of this user as a subquery with an "id" (of the post) and a "timestamp" column, read from
+    # the user's materialized timeline (see TimelineEntry). If the user follows any "pull" authors, their posts are
+    # merged in from the posts table. Join it to posts to get the Post instances, and order/paginate it by its own
+    # (timestamp, id) columns so the database can walk the timelines index instead of sorting, e.g.:
+    #   timeline = user.timeline()
+    #   db.session.query(Post).join(timeline, timeline.c.id == Post.id).order_by(timeline.c.timestamp.desc())
+    def timeline(self):
+        entries = db.session.query(TimelineEntry.post_id.label("id"), TimelineEntry.timestamp.label("timestamp"))\
+                    .filter(TimelineEntry.user_id == self.id)
+        follows_pull_authors = db.session.query(Follow.following_id)\
+                                .join(User, User.id == Follow.following_id)\
+                                .filter(Follow.follower_id == self.id, User.timeline_pull == True)
+        if follows_pull_authors.first() is None:
+            return entries.subquery()
+        pulled = db.session.query(Post.id.label("id"), Post.timestamp.label("timestamp"))\
+                    .filter(Post.author_id.in_(follows_pull_authors))
+        # union (not union_all) since the pull authors can have posts in the timeline from before they became pull authors
+        return entries.union(pulled).subquery()
 
     # The below property gets the posts of those who follow this user. 
     # We could do [[post for post in follower.posts.all()] for follower in db.session.query(User).filter_by(user = self).followers.all()]
@@ -235,19 +440,22 @@ class User(UserMixin, db.Model):
     # SELECT posts.id AS posts_id, posts.body AS posts_body, posts.body_html AS posts_body_html, posts.timestamp AS posts_timestamp, posts.author_id AS posts_author_id 
     # FROM posts JOIN follows ON follows.following_id = posts.author_id
     # WHERE follows.follower_id = ?
+    # This is now read from the materialized timeline, see timeline() above; for a paginated feed, use
+    # app.main.feeds.following_feed() which also orders by the timeline's own columns.
     @property
     def following_posts(self):
-        return db.session.query(Post)\
-                .join(Follow, Follow.following_id == Post.author_id)\
-                .filter(Follow.follower_id == self.id)
+        timeline = self.timeline()
+        return db.session.query(Post).join(timeline, timeline.c.id == Post.id)
     
+    # These return the ids of every post the user has ever up/downvoted. To render a page of posts,
+    # use Vote.states_for() instead, which only looks up the posts on that page.
     @property
     def upvoted_posts(self):
-        return [vote_instance.post_id for vote_instance in self.voters if vote_instance.voter_id == self.id and vote_instance.vote_type == True]
+        return [post_id for (post_id,) in self.voters.filter_by(vote_type = True).with_entities(Vote.post_id)]
 
     @property
     def downvoted_posts(self):
-        return [vote_instance.post_id for vote_instance in self.voters if vote_instance.voter_id == self.id and vote_instance.vote_type == False]
+        return [post_id for (post_id,) in self.voters.filter_by(vote_type = False).with_entities(Vote.post_id)]
 
     # The token generators below are used by the API to authenticate a user
     # without a password, since sending passwords at every request is dangerous
@@ -265,26 +473,57 @@ class User(UserMixin, db.Model):
             return None
         return User.query.get(data['id'])
     
+    # Recount the posts and follows tables and fix any user whose post_count/follower_count/following_count drifted
+    # (or were never filled in, e.g. right after the migration that added the columns), chunk_size users at a time
+    # with a commit per chunk, like Post.reconcile_vote_counts(). Returns the number of users that were corrected.
+    @staticmethod
+    def reconcile_social_counts(chunk_size: int = 1000) -> int:
+        corrected = 0
+        last_id = 0
+        while True:
+            rows = db.session.query(User.id, User.post_count, User.follower_count, User.following_count)\
+                    .filter(User.id > last_id).order_by(User.id).limit(chunk_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            ids = [row.id for row in rows]
+            def counts(column):
+                return dict(db.session.query(column, sqlalchemy.func.count())
+                                      .filter(column.in_(ids)).group_by(column))
+            posts, followers, following = counts(Post.author_id), counts(Follow.following_id), counts(Follow.follower_id)
+            updates = []
+            for row in rows:
+                actual = (posts.get(row.id, 0), followers.get(row.id, 0), following.get(row.id, 0))
+                if (row.post_count, row.follower_count, row.following_count) != actual:
+                    updates.append({"user_id": row.id, "posts": actual[0], "followers": actual[1],
+                                    "following": actual[2]})
+            if updates:
+                db.session.execute(User.__table__.update()
+                                   .where(User.__table__.c.id == sqlalchemy.bindparam("user_id"))
+                                   .values(post_count = sqlalchemy.bindparam("posts"),
+                                           follower_count = sqlalchemy.bindparam("followers"),
+                                           following_count = sqlalchemy.bindparam("following")),
+                                   updates)
+            db.session.commit()
+            corrected += len(updates)
+        return corrected
+
     def to_json(self):
+        role = role_cache.get(self.role_id)
         return { 
             "username": self.username,
-            "role": self.role.name,
+            "role": role.name if role is not None else None,
             "name": self.name,
             "location": self.location,
             "about_me": self.about_me,
             "member_since": self.member_since,
             "last_seen": self.last_seen,
             "posts_url": url_for('api.get_user_posts', id=self.id),
-            "post_count": self.posts.count()
+            "post_count": self.post_count or 0,
+            "follower_count": self.follower_count or 0,
+            "following_count": self.following_count or 0
         }
     
-    @staticmethod
-    def from_json(json_post):
-        body = json_post.get('body')
-        if body is None or body == '':
-            raise ValidationError('Post does not have a body')
-        return Post(body=body)
-    
 # Flask-login has their own AnonymousUser class, but here we
 # override it with our own implementation, to also have can and is_admin methods
 class AnonymousUser(AnonymousUserMixin):
@@ -353,10 +592,11 @@ class Role(db.Model):
             'Administrator': [Permission.FOLLOW, Permission.COMMENT, Permission.WRITE, Permission.MODERATE, Permission.ADMIN]
         }
         default_role = 'User' 
+        # Get the existing roles in one query
+        existing = {role.name: role for role in Role.query.all()}
         for r in roles:
-            # Try to get the role row in the Role table in the database with name = r
-            # If it doesn't exist yet in the database, create the role
-            role = Role.query.filter_by(name=r).first()
+            # If the role with name = r doesn't exist yet in the database, create the role
+            role = existing.get(r)
             if role is None:
                 role = Role(name=r)
             # If it does exist, update the corresponding permissions for this role with what we have in roles
@@ -365,7 +605,62 @@ class Role(db.Model):
                 role.add_permission(perm)
             role.default = (True if role.name == default_role else False)
             db.session.add(role)
-            db.session.commit()
+        db.session.commit()
+
+# The roles table is tiny and hardly ever changes, but is needed whenever a user is created and whenever
+# permissions are checked. So every process keeps a copy of it here, read with one query.
+# The copy is dropped whenever a role is inserted, updated or deleted in this process (see the mapper events
+# below). Other processes drop theirs when the "roles" tag of the identities is touched after the commit, like the
+# snapshots of logged-in users (see identity.py), and it is reread after ttl seconds anyway, for changes not
+# written through the ORM.
+RoleInfo = namedtuple("RoleInfo", ["id", "name", "permissions", "default"])
+
+class RoleCache:
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._roles = None
+        self._loaded_at = 0 # In nanoseconds since the epoch, to compare with the tag
+        self.loads = 0
+        self.lookups = 0
+
+    def invalidate(self) -> None:
+        self._roles = None
+
+    def all(self) -> list:
+        self.lookups += 1
+        roles, loaded_at = self._roles, self._loaded_at
+        if roles is None or time.time_ns() - loaded_at > self.ttl * 1e9 or self._changed_since(loaded_at):
+            loaded_at = time.time_ns()
+            roles = [RoleInfo(*row) for row in db.session.query(Role.id, Role.name, Role.permissions, Role.default)]
+            self._roles, self._loaded_at = roles, loaded_at
+            self.loads += 1
+        return roles
+
+    @staticmethod
+    def _changed_since(loaded_at: int) -> bool:
+        if not has_app_context() or "identity_tags" not in current_app.extensions:
+            return False
+        return current_app.extensions["identity_tags"].invalidated_at("roles") >= loaded_at
+
+    def get(self, role_id: int):
+        return next((role for role in self.all() if role.id == role_id), None)
+
+    def by_name(self, name: str):
+        return next((role for role in self.all() if role.name == name), None)
+
+    def default(self):
+        return next((role for role in self.all() if role.default), None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._roles or []), "ttl": self.ttl, "lookups": self.lookups, "loads": self.loads}
+
+role_cache = RoleCache()
+
+@db.event.listens_for(Role, 'after_insert')
+@db.event.listens_for(Role, 'after_update')
+@db.event.listens_for(Role, 'after_delete')
+def invalidate_role_cache(mapper, connection, target):
+    role_cache.invalidate()
 
 class Post(db.Model):
     __tablename__ = "posts"
@@ -375,7 +670,23 @@ class Post(db.Model):
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # active_history, like Comment.disabled, so the post counts of the users can be moved when the author changes
+    author_id = db.column_property(db.Column(db.Integer, db.ForeignKey('users.id')), active_history = True)
+    # Vote tallies are denormalized here so that rendering a feed does not have to count
+    # the votes table for every post. They are kept up to date by the mapper events of Vote (see the bottom of
+    # this file), i.e. by whatever adds, changes or deletes a vote, and can be rebuilt with flask reconcilevotes.
+    upvote_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    downvote_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Incremented every time the title or body of the post is edited (see on_changed_body/on_changed_title),
+    # so anything derived from them can be cached by (id, version), see app/main/fragments.py
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    # Number of comments on the post that are not disabled, and when the newest of them was made (None without any),
+    # denormalized here so that listing posts doesn't count the comments table. They are kept up to date by the
+    # mapper events of Comment (see the bottom of this file), i.e. by whatever adds, disables, enables or deletes
+    # a comment, and can be rebuilt with flask reconcilecomments.
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Indexed for the "recently active" feed, see app/main/feeds.py
+    last_comment_at = db.Column(db.DateTime, index=True)
     comments: sqlalchemy.orm.Query = db.relationship('Comment',
                                 foreign_keys = [Comment.post_id],
                                 backref = db.backref('post', lazy = 'joined'),
@@ -390,45 +701,112 @@ class Post(db.Model):
 
     @property
     def upvotes(self):
-        return len(self.votes.filter_by(vote_type = True).all())
+        return self.upvote_count or 0
 
     @property
     def downvotes(self):
-        return len(self.votes.filter_by(vote_type = False).all())
+        return self.downvote_count or 0
     
     @property
     def net_votes(self):
         return int(self.upvotes) - int(self.downvotes)
 
+    # Recount the votes table and fix any post whose tallies drifted (or were never filled in, e.g. right
+    # after the migration that added the columns). Posts are processed in chunks of chunk_size ordered by id,
+    # with a commit per chunk, so this can run against a big live table without holding a long transaction.
+    # Returns the number of posts that were corrected.
+    @staticmethod
+    def reconcile_vote_counts(chunk_size: int = 1000) -> int:
+        corrected = 0
+        last_id = 0
+        while True:
+            rows = db.session.query(Post.id, Post.upvote_count, Post.downvote_count)\
+                    .filter(Post.id > last_id).order_by(Post.id).limit(chunk_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            tallies = dict((row.post_id, (row.up or 0, row.down or 0)) for row in
+                        db.session.query(Vote.post_id,
+                                         sqlalchemy.func.sum(sqlalchemy.case((Vote.vote_type == True, 1), else_ = 0)).label("up"),
+                                         sqlalchemy.func.sum(sqlalchemy.case((Vote.vote_type == False, 1), else_ = 0)).label("down"))\
+                                  .filter(Vote.post_id.in_([row.id for row in rows]))\
+                                  .group_by(Vote.post_id))
+            updates = []
+            for row in rows:
+                up, down = tallies.get(row.id, (0, 0))
+                if (row.upvote_count, row.downvote_count) != (up, down):
+                    updates.append({"post_id": row.id, "up": up, "down": down})
+            if updates:
+                db.session.execute(Post.__table__.update()
+                                   .where(Post.__table__.c.id == sqlalchemy.bindparam("post_id"))
+                                   .values(upvote_count = sqlalchemy.bindparam("up"),
+                                           downvote_count = sqlalchemy.bindparam("down")),
+                                   updates)
+            db.session.commit()
+            corrected += len(updates)
+        return corrected
+
+    # Recount the comments table and fix any post whose comment_count/last_comment_at drifted (or were never
+    # filled in, e.g. right after the migration that added the columns), chunk_size posts at a time with a commit
+    # per chunk, like reconcile_vote_counts(). Returns the number of posts that were corrected.
+    @staticmethod
+    def reconcile_comment_counts(chunk_size: int = 1000) -> int:
+        corrected = 0
+        last_id = 0
+        while True:
+            rows = db.session.query(Post.id, Post.comment_count, Post.last_comment_at)\
+                    .filter(Post.id > last_id).order_by(Post.id).limit(chunk_size).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            tallies = dict((row.post_id, (row.count, row.last)) for row in
+                        db.session.query(Comment.post_id,
+                                         sqlalchemy.func.count(Comment.id).label("count"),
+                                         sqlalchemy.func.max(Comment.timestamp).label("last"))\
+                                  .filter(Comment.post_id.in_([row.id for row in rows]), Comment.visible())\
+                                  .group_by(Comment.post_id))
+            updates = []
+            for row in rows:
+                count, last = tallies.get(row.id, (0, None))
+                if (row.comment_count, row.last_comment_at) != (count, last):
+                    updates.append({"post_id": row.id, "count": count, "last": last})
+            if updates:
+                db.session.execute(Post.__table__.update()
+                                   .where(Post.__table__.c.id == sqlalchemy.bindparam("post_id"))
+                                   .values(comment_count = sqlalchemy.bindparam("count"),
+                                           last_comment_at = sqlalchemy.bindparam("last")),
+                                   updates)
+            db.session.commit()
+            corrected += len(updates)
+        return corrected
+
     # The markdown input field can be dangerous, attackers can create markdown that generates
     # html code that can attack the server.
-    # To avoid this, the markdown input is filtered by the below staticmethod.
+    # To avoid this, the markdown input is filtered by render_markdown() (see rendering.py).
     # The db.event.listen listens to a db.session.add(post) event, that sets/edits the body column.
-    # When it happens, the Post.on_changed_body method is run
-    # First, the markdown input is turned to html by the markdown() method
-    # Second, the bleach.clean() removes any html tags not in allowed_tags
-    # Third, the bleach.linkify() is not a security feature; it's there to convert any URL into clickable
-    # format (i.e. add <a> tags to them)
-    # Finally, the output of this method is put inside body_html.
+    # When it happens, the Post.on_changed_body method is run, and the filtered html is put inside body_html.
+    # Setting the body to the value it already has skips all of this.
     # The _posts.html will look if body_html is not empty (should be). If it isn't, then this will be rendered. Otherwise,
     # the raw markdown will be rendered by Jinja to html.
     @staticmethod
     def on_changed_body(target, value, old_value, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        if value == old_value and target.body_html is not None:
+            return
+        target.bump_version(value, old_value)
+        target.body_html = render_markdown(value)
 
     @staticmethod
     def on_changed_title(target, value, old_value, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.title_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True)).capitalize()
+        if value == old_value and target.title_html is not None:
+            return
+        target.bump_version(value, old_value)
+        title_html = render_markdown(value)
+        target.title_html = title_html.capitalize() if title_html is not None else None
+
+    # Called when the title or body is set. Only edits of a saved post count; setting them on a new post doesn't.
+    def bump_version(self, value, old_value) -> None:
+        if self.id is not None and value != old_value:
+            self.version = (self.version or 1) + 1
 
     def create_comment(self, author: User, body: str):
         if body == "":
@@ -437,6 +815,116 @@ class Post(db.Model):
         db.session.add(comment)
         db.session.commit()
     
+    # The columns of a post sent to the API, checked. Raises ValidationError if it isn't a valid post.
+    @staticmethod
+    def fields_from_json(json_post) -> dict:
+        if not isinstance(json_post, dict):
+            raise ValidationError('Post is not a JSON object')
+        body = json_post.get('body')
+        if body is None or body == '':
+            raise ValidationError('Post does not have a body')
+        title = json_post.get('title')
+        if not isinstance(body, str) or not isinstance(title, (str, type(None))):
+            raise ValidationError('The body and title of a post must be text')
+        return {"body": body, "title": title}
+
+    @staticmethod
+    def from_json(json_post):
+        return Post(**Post.fields_from_json(json_post))
+
+    # Insert many new posts of author at once, e.g. for an import: fields is a list of dicts as returned by
+    # fields_from_json(). Returns their ids, in the same order. The caller commits.
+    # Creating Post objects one by one would render each one's markdown in the body/title listeners, and flush them
+    # with the whole unit of work machinery. Instead:
+    #   - the HTML of all bodies and titles is rendered first, in one go (render_markdown caches repeated texts),
+    #     or, with render = False, not at all: body_html/title_html are left empty (the templates show the
+    #     escaped markdown meanwhile) for render_pending() to fill in later
+    #   - the rows are inserted with Core INSERTs, without the ORM's unit of work, and the id of each is taken from
+    #     its own INSERT. Where the database can return the ids of an executemany (INSERT ... RETURNING, e.g.
+    #     PostgreSQL) that is one executemany per chunk_size rows; elsewhere (SQLite, MySQL) it is one INSERT per row,
+    #     since looking the rows up again afterwards can't tell them apart from another import of the same author
+    #     (and MySQL rounds the timestamps to the second)
+    #   - what the mapper events of a single post would do is done for the whole batch: INSERT ... SELECTs for the
+    #     followers' timelines, one executemany for the search index and one invalidation of the cached pages
+    @staticmethod
+    def bulk_insert(author, fields: list, render: bool = True, chunk_size: int = 1000) -> list:
+        from .page_cache import collect_tags
+        from .search import index_rows
+        if not fields:
+            return []
+        timestamp = datetime.utcnow()
+        rows = []
+        for item in fields:
+            row = {"body": item["body"], "title": item.get("title"), "body_html": None, "title_html": None,
+                   "author_id": author.id, "timestamp": timestamp, "version": 1, "upvote_count": 0, "downvote_count": 0}
+            if render:
+                row.update(Post.rendered(row["body"], row["title"]))
+            rows.append(row)
+        posts = Post.__table__
+        connection = db.session.connection()
+        if connection.dialect.insert_executemany_returning:
+            insert = posts.insert().return_defaults(posts.c.id)
+            for chunk in range(0, len(rows), chunk_size):
+                result = connection.execute(insert, rows[chunk:chunk + chunk_size])
+                for row, primary_key in zip(rows[chunk:chunk + chunk_size], result.inserted_primary_key_rows):
+                    row["id"] = primary_key[0]
+        else:
+            insert = posts.insert()
+            for row in rows:
+                row["id"] = connection.execute(insert, row).inserted_primary_key[0]
+        ids = [row["id"] for row in rows]
+        TimelineEntry.fan_out_many(author, ids, chunk_size = chunk_size)
+        index_rows(db.session.connection(), Post, rows)
+        change_user_counts(db.session.connection(), author.id, post_count = len(ids))
+        collect_tags(db.session(), "posts", f"posts-by:{author.id}", *[f"post:{id}" for id in ids])
+        return ids
+
+    # body_html and title_html for a body and title, as the listeners below set them
+    @staticmethod
+    def rendered(body: str, title: str) -> dict:
+        title_html = render_markdown(title)
+        return {"body_html": render_markdown(body),
+                "title_html": title_html.capitalize() if title_html is not None else None}
+
+    # Render the posts inserted by bulk_insert(render = False), chunk_size at a time with a commit per chunk; only
+    # those among ids if given, otherwise all of them. The version of each is bumped, so the fragment and page caches
+    # drop the unrendered copies. Returns the number of posts rendered.
+    @staticmethod
+    def render_pending(chunk_size: int = 500, ids: list = None) -> int:
+        from .page_cache import collect_tags
+        posts = Post.__table__
+        pending = sorted(ids) if ids is not None else None
+        rendered = 0
+        last_id = 0
+        while True:
+            query = sqlalchemy.select(posts.c.id, posts.c.body, posts.c.title)\
+                        .where(posts.c.body_html == None, posts.c.body != None, posts.c.id > last_id)\
+                        .order_by(posts.c.id)
+            if pending is not None:
+                chunk, pending = pending[:chunk_size], pending[chunk_size:]
+                if not chunk:
+                    break
+                last_id = chunk[-1]
+                rows = db.session.execute(query.where(posts.c.id.in_(chunk))).all()
+            else:
+                rows = db.session.execute(query.limit(chunk_size)).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+            if not rows:
+                continue
+            updates = [dict(Post.rendered(row.body, row.title), post_id = row.id) for row in rows]
+            db.session.execute(posts.update()
+                               .where(posts.c.id == sqlalchemy.bindparam("post_id"), posts.c.body_html == None)
+                               .values(body_html = sqlalchemy.bindparam("body_html"),
+                                       title_html = sqlalchemy.bindparam("title_html"),
+                                       version = posts.c.version + 1),
+                               updates)
+            collect_tags(db.session(), *[f"post:{row.id}" for row in rows])
+            db.session.commit()
+            rendered += len(rows)
+        return rendered
+
     def to_json(self):
         json_post = {
             "body": self.body,
@@ -444,7 +932,8 @@ class Post(db.Model):
             "timestamp": self.timestamp,
             "author_url": url_for("api.get_user", id=self.author_id),
             "comments_url": url_for("api.get_post_comments", id = self.id),
-            "comment_count": self.comments.count(),
+            "comment_count": self.comment_count or 0,
+            "last_comment_at": self.last_comment_at,
             "url": url_for('api.get_post', id=self.id)
         }
         return json_post
@@ -452,3 +941,129 @@ class Post(db.Model):
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
 db.event.listen(Post.title, 'set', Post.on_changed_title)
+
+# Keeping posts.comment_count and posts.last_comment_at in step with the visible comments of each post.
+# They run in the same flush as the change to the comment, and the counts are changed by the database
+# (comment_count = comment_count + 1), so concurrent comments can't overwrite each other.
+def comment_shown(connection, post_id: int, timestamp: datetime) -> None:
+    posts = Post.__table__
+    connection.execute(posts.update().where(posts.c.id == post_id).values(
+        comment_count = posts.c.comment_count + 1,
+        last_comment_at = sqlalchemy.case((sqlalchemy.or_(posts.c.last_comment_at == None,
+                                                          posts.c.last_comment_at < timestamp), timestamp),
+                                          else_ = posts.c.last_comment_at)))
+
+# The comment is already gone (or disabled) in the database, so the newest remaining one can be looked up
+def comment_hidden(connection, post_id: int) -> None:
+    posts, comments = Post.__table__, Comment.__table__
+    newest = sqlalchemy.select(sqlalchemy.func.max(comments.c.timestamp))\
+                .where(comments.c.post_id == post_id, Comment.visible())\
+                .scalar_subquery()
+    connection.execute(posts.update().where(posts.c.id == post_id).values(
+        comment_count = posts.c.comment_count - 1, last_comment_at = newest))
+
+@db.event.listens_for(Comment, 'after_insert')
+def count_inserted_comment(mapper, connection, target):
+    if target.post_id is not None and not target.disabled:
+        comment_shown(connection, target.post_id, target.timestamp or datetime.utcnow())
+
+@db.event.listens_for(Comment, 'after_update')
+def count_moderated_comment(mapper, connection, target):
+    history = sqlalchemy.inspect(target).attrs.disabled.history
+    if target.post_id is None or not history.has_changes():
+        return
+    was_disabled = bool(history.deleted[0]) if history.deleted else False
+    if was_disabled and not target.disabled:
+        comment_shown(connection, target.post_id, target.timestamp)
+    elif not was_disabled and target.disabled:
+        comment_hidden(connection, target.post_id)
+
+@db.event.listens_for(Comment, 'after_delete')
+def count_deleted_comment(mapper, connection, target):
+    if target.post_id is not None and not target.disabled:
+        comment_hidden(connection, target.post_id)
+
+# Keeping posts.upvote_count and downvote_count in step with the votes table, the same way as the comment counts
+# above. The increment is done by the database (i.e. UPDATE posts SET upvote_count = upvote_count + 1) instead of in
+# Python, so two votes arriving at the same time cannot overwrite each other, and it is committed with the vote.
+def change_vote_counts(connection, post_id: int, upvotes: int = 0, downvotes: int = 0) -> None:
+    posts = Post.__table__
+    connection.execute(posts.update().where(posts.c.id == post_id).values(
+        upvote_count = posts.c.upvote_count + upvotes, downvote_count = posts.c.downvote_count + downvotes))
+
+def vote_amounts(vote_type, sign: int) -> dict:
+    return {"upvotes": sign} if vote_type else {"downvotes": sign}
+
+@db.event.listens_for(Vote, 'after_insert')
+def count_inserted_vote(mapper, connection, target):
+    if target.vote_type is not None:
+        change_vote_counts(connection, target.post_id, **vote_amounts(target.vote_type, 1))
+
+@db.event.listens_for(Vote, 'after_update')
+def count_changed_vote(mapper, connection, target):
+    history = sqlalchemy.inspect(target).attrs.vote_type.history
+    if not history.has_changes():
+        return
+    for vote_type in history.deleted:
+        if vote_type is not None:
+            change_vote_counts(connection, target.post_id, **vote_amounts(vote_type, -1))
+    if target.vote_type is not None:
+        change_vote_counts(connection, target.post_id, **vote_amounts(target.vote_type, 1))
+
+# Also run for the votes deleted with their post or voter
+@db.event.listens_for(Vote, 'after_delete')
+def count_deleted_vote(mapper, connection, target):
+    if target.vote_type is not None:
+        change_vote_counts(connection, target.post_id, **vote_amounts(target.vote_type, -1))
+
+# Keeping users.post_count, follower_count and following_count in step with the posts and follows tables, the same
+# way as the comment counts above.
+def change_user_counts(connection, user_id: int, **amounts) -> None:
+    users = User.__table__
+    connection.execute(users.update().where(users.c.id == user_id).values(
+        {users.c[name]: users.c[name] + amount for name, amount in amounts.items()}))
+
+@db.event.listens_for(Post, 'after_insert')
+def count_inserted_post(mapper, connection, target):
+    if target.author_id is not None:
+        change_user_counts(connection, target.author_id, post_count = 1)
+
+# Deleting a user sets author_id of their posts to NULL
+@db.event.listens_for(Post, 'after_update')
+def count_moved_post(mapper, connection, target):
+    history = sqlalchemy.inspect(target).attrs.author_id.history
+    if not history.has_changes():
+        return
+    for author_id in history.deleted:
+        if author_id is not None:
+            change_user_counts(connection, author_id, post_count = -1)
+    if target.author_id is not None:
+        change_user_counts(connection, target.author_id, post_count = 1)
+
+@db.event.listens_for(Post, 'after_delete')
+def count_deleted_post(mapper, connection, target):
+    if target.author_id is not None:
+        change_user_counts(connection, target.author_id, post_count = -1)
+
+@db.event.listens_for(Follow, 'after_insert')
+def count_inserted_follow(mapper, connection, target):
+    change_user_counts(connection, target.follower_id, following_count = 1)
+    change_user_counts(connection, target.following_id, follower_count = 1)
+
+@db.event.listens_for(Follow, 'after_delete')
+def count_deleted_follow(mapper, connection, target):
+    change_user_counts(connection, target.follower_id, following_count = -1)
+    change_user_counts(connection, target.following_id, follower_count = -1)
+
+# Timeline entries are not a relationship of Post or User (loading thousands of them just to delete them would defeat
+# the point), so delete them directly when their post, follower or author is deleted. Before it, since the foreign
+# keys of timelines have no ON DELETE and databases that enforce them (e.g. MySQL) would refuse to delete the parent.
+@db.event.listens_for(Post, 'before_delete')
+def delete_post_timeline_entries(mapper, connection, target):
+    connection.execute(TimelineEntry.__table__.delete().where(TimelineEntry.__table__.c.post_id == target.id))
+
+@db.event.listens_for(User, 'before_delete', propagate = True)
+def delete_user_timeline_entries(mapper, connection, target):
+    timelines = TimelineEntry.__table__
+    connection.execute(timelines.delete().where(sqlalchemy.or_(timelines.c.user_id == target.id,
+                                                                timelines.c.author_id == target.id)))
@@ -0,0 +1,164 @@
+# Cache of whole pages for visitors who are not logged in.
+#
+# Most requests are logged-out readers of the index, post and user pages, which look the same for all of them.
+# So the first request renders the page as usual, and the response (body, status and headers) is kept in an LRUCache
+# of the worker, keyed by (endpoint, path, query string). The next anonymous request for the same page is answered
+# from it by a before_request function of the app, before any view or blueprint before_request function, so a hit
+# doesn't touch the database at all. Responses have an X-Page-Cache: hit/miss header.
+#
+# Only requests that can't be personal are served or stored:
+#   - GET requests to the endpoints in CACHED_ENDPOINTS
+#   - without a logged-in user, i.e. no user id in the session and no remember-me cookie (checked on the session
+#     cookie itself, since loading current_user could query the database)
+#   - without flash messages waiting in the session, since the page would show (and consume) them
+# and only 200 responses that set no cookie, didn't change the session (e.g. by flashing a message) and rendered no form
+# with a CSRF token are stored.
+#
+# Invalidation is by tags. The view names what a page shows with tag_page(), e.g. "post:12" for a post (its text,
+# votes and comments), "user:3" for a profile, "posts" for the list of all posts, "active" for the list of posts by
+# latest comment and "posts-by:3" for the list of posts of user 3. When a post, comment, vote, follow or user is
+# written, the mapper events at the bottom of this file collect the tags it affects, and after the transaction commits those tags are marked as invalidated now.
+# A cached page is dropped when it is served if any of its tags was invalidated after it started rendering.
+# The time each tag was last invalidated is shared by all workers as the modification time of a file per tag in
+# BLOGGING_PAGE_CACHE_TAG_DIR, so a write in one worker invalidates the pages of all of them. With the directory
+# set to None (e.g. in the tests) it is kept in memory, for this process only.
+#
+# Things not written through the ORM (e.g. last_seen, see last_seen.py, or flask seed) don't invalidate anything;
+# BLOGGING_PAGE_CACHE_TTL bounds how long a page can show them outdated.
+
+import os, threading, time
+from collections import namedtuple
+from flask import current_app, g, has_app_context, request, session
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from .cache import LRUCache
+from .models import Comment, Follow, Post, User, Vote
+
+CACHED_ENDPOINTS = ("main.index", "main.active", "main.post", "main.user")
+
+CachedPage = namedtuple("CachedPage", ["rendered_at", "tags", "status", "headers", "body"])
+
+# When each tag was last invalidated, in nanoseconds since the epoch (0 if never)
+class TagVersions:
+    def __init__(self, directory: str = None):
+        self.directory = directory
+        self._times = {}
+        self._lock = threading.Lock()
+
+    def _path(self, tag: str) -> str:
+        return os.path.join(self.directory, tag.replace(":", "-").replace("/", "-"))
+
+    # Returns the time the tags were invalidated at
+    def invalidate(self, tags) -> int:
+        now = time.time_ns()
+        if self.directory is None:
+            with self._lock:
+                self._times.update(dict.fromkeys(tags, now))
+            return now
+        os.makedirs(self.directory, exist_ok = True)
+        for tag in tags:
+            path = self._path(tag)
+            with open(path, "a"):
+                pass
+            os.utime(path, ns = (now, now))
+        return now
+
+    def invalidated_at(self, tag: str) -> int:
+        if self.directory is None:
+            return self._times.get(tag, 0)
+        try:
+            return os.stat(self._path(tag)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def stale(self, tags, since: int) -> bool:
+        return any(self.invalidated_at(tag) >= since for tag in tags)
+
+class PageCache:
+    def __init__(self, maxsize: int = 512, ttl: float = 60, tag_directory: str = None):
+        self.pages = LRUCache(maxsize, ttl = ttl)
+        self.tags = TagVersions(tag_directory)
+
+    def init_app(self, app) -> None:
+        app.extensions["page_cache"] = self
+
+        @app.before_request
+        def serve_cached_page():
+            if not app.config["BLOGGING_PAGE_CACHE"] or not cacheable_request(app):
+                return None
+            key = (request.endpoint, request.path, request.query_string)
+            page = self.pages.get(key)
+            if page is not None and not self.tags.stale(page.tags, page.rendered_at):
+                response = app.response_class(page.body, status = page.status, headers = page.headers)
+                response.headers["X-Page-Cache"] = "hit"
+                return response
+            if page is not None:
+                self.pages.delete(key)
+            g.page_cache_key = key
+            g.page_rendered_at = time.time_ns()
+            g.page_tags = set()
+            return None
+
+        @app.after_request
+        def store_page(response):
+            key = g.pop("page_cache_key", None)
+            if key is None:
+                return response
+            response.headers["X-Page-Cache"] = "miss"
+            tags = g.pop("page_tags", set())
+            if response.status_code != 200 or response.direct_passthrough or "Set-Cookie" in response.headers \
+                    or session.modified or "csrf_token" in g or not tags:
+                return response
+            headers = [(name, value) for name, value in response.headers.items() if name != "X-Page-Cache"]
+            self.pages.set(key, CachedPage(g.page_rendered_at, frozenset(tags), response.status_code, headers,
+                                           response.get_data()))
+            return response
+
+# Whether the request is a GET of a cached endpoint by someone not logged in, with nothing to flash
+def cacheable_request(app) -> bool:
+    return request.method == "GET" and request.endpoint in CACHED_ENDPOINTS \
+        and "_user_id" not in session \
+        and app.config.get("REMEMBER_COOKIE_NAME", "remember_token") not in request.cookies \
+        and not session.get("_flashes")
+
+# Called by the views: the page being rendered shows what these tags stand for (see the top of this file)
+def tag_page(*tags) -> None:
+    if "page_tags" in g:
+        g.page_tags.update(tags)
+
+# The tags of a list of posts: each post and its author
+def post_tags(posts) -> list:
+    return [f"post:{post.id}" for post in posts] + [f"user:{post.author_id}" for post in posts]
+
+# Invalidation. The tags are collected per session while flushing, and invalidated once the transaction commits,
+# so that a page rendered in between can't be cached with the old data and survive.
+
+# Also for writes that bypass the mapper events (e.g. Post.bulk_insert())
+def collect_tags(session, *tags) -> None:
+    session.info.setdefault("page_cache_tags", set()).update(tags)
+
+def _collect(target, *tags) -> None:
+    session = object_session(target)
+    if session is not None:
+        collect_tags(session, *tags)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    tags = session.info.pop("page_cache_tags", None)
+    if tags and has_app_context() and "page_cache" in current_app.extensions:
+        current_app.extensions["page_cache"].tags.invalidate(tags)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(session):
+    session.info.pop("page_cache_tags", None)
+
+def _listen(model, tags_of, events = ("after_insert", "after_update", "after_delete")):
+    for name in events:
+        event.listen(model, name, lambda mapper, connection, target: _collect(target, *tags_of(target)), propagate = True)
+
+_listen(Post, lambda post: (f"post:{post.id}", "posts", f"posts-by:{post.author_id}"), ("after_insert", "after_delete"))
+_listen(Post, lambda post: (f"post:{post.id}",), ("after_update",))
+_listen(Comment, lambda comment: (f"post:{comment.post_id}", "active"))
+_listen(Vote, lambda vote: (f"post:{vote.post_id}",))
+_listen(User, lambda user: (f"user:{user.id}",), ("after_update", "after_delete"))
+_listen(Follow, lambda follow: (f"user:{follow.follower_id}", f"user:{follow.following_id}"))
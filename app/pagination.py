@@ -0,0 +1,94 @@
+# Keyset (a.k.a. cursor) pagination.
+#
+# Flask-SQLAlchemy's paginate() uses LIMIT/OFFSET plus a COUNT(*) of the whole query. The database has to
+# walk past all OFFSET rows to get to a page, so page 10,000 is far slower than page 1, and the COUNT is
+# paid on every page.
+# Keyset pagination instead remembers where the previous page ended, i.e. the (timestamp, id) of its last
+# row, and asks for the rows that come after it:
+#   WHERE timestamp < :ts OR (timestamp = :ts AND id < :id) ORDER BY timestamp DESC, id DESC LIMIT :per_page
+# which is an index range scan of per_page rows no matter how deep the page is. The id is there to break
+# ties between rows with the same timestamp. No total is computed; one extra row is fetched instead to
+# know whether there is a next page.
+#
+# The position is handed to the client as an opaque ?cursor= token, see encode_cursor() below.
+
+import base64, binascii, json
+from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.types import DateTime
+from app.exceptions import ValidationError
+
+# Returned by keyset_paginate(). Has the same items/has_next/has_prev attributes as
+# Flask-SQLAlchemy's Pagination, but instead of page numbers it has the cursors
+# of the pages before and after it (None if there is no such page).
+class KeysetPagination:
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+# A cursor is the direction to go ("n" for the next, i.e. older, page and "p" for the previous, i.e. newer, page)
+# plus the key of the row to start from, JSON-encoded and then base64-encoded so it is safe to put in a URL.
+# Clients should treat it as opaque; its content may change.
+def encode_cursor(direction: str, key) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    data = json.dumps([direction, values], separators = (",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, columns):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, values = json.loads(data)
+        if direction not in ("n", "p") or len(values) != len(columns):
+            raise ValueError
+        key = tuple(datetime.fromisoformat(value) if isinstance(column.type, DateTime) else value
+                    for column, value in zip(columns, values))
+    except (binascii.Error, ValueError, TypeError):
+        raise ValidationError("Invalid cursor")
+    return direction, key
+
+# Rows whose key comes strictly after key (older == True) or before it (older == False),
+# in an order where the columns are all descending.
+def _beyond(columns, key, older: bool):
+    (first, *rest), (first_value, *rest_values) = columns, key
+    if not rest:
+        return first < first_value if older else first > first_value
+    return or_(first < first_value if older else first > first_value,
+               and_(first == first_value, _beyond(rest, rest_values, older)))
+
+# Paginate query, ordered by columns, all descending (newest first), e.g. (Post.timestamp, Post.id).
+# The last column must be unique. cursor is the ?cursor= token of the page to get, or None for the first page.
+# The items have to have the columns as attributes with the same name (e.g. a Post has post.timestamp and post.id),
+# so their keys can be turned into the cursors of the neighbouring pages.
+# Raises ValidationError if the cursor is not a valid token.
+def keyset_paginate(query, columns, cursor: str = None, per_page: int = 20) -> KeysetPagination:
+    columns = list(columns)
+    direction, key = decode_cursor(cursor, columns) if cursor else ("n", None)
+    older = direction == "n"
+    if key is not None:
+        query = query.filter(_beyond(columns, key, older))
+    if older:
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.order_by(*[column.asc() for column in columns])
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    items = rows[:per_page]
+    if not older:
+        items.reverse()
+    if not items:
+        return KeysetPagination(items, None, None)
+    has_next = more if older else True
+    has_prev = (key is not None) if older else more
+    item_key = lambda item: tuple(getattr(item, column.key) for column in columns)
+    return KeysetPagination(items,
+                            encode_cursor("n", item_key(items[-1])) if has_next else None,
+                            encode_cursor("p", item_key(items[0])) if has_prev else None)
@@ -0,0 +1,116 @@
+# Counting and timing the SQL statements of every request.
+#
+# A lazy load in a loop (e.g. post.author in a template) doesn't show up anywhere, the page is just slower.
+# So every statement executed while handling a request is counted and timed, using SQLAlchemy's
+# before_cursor_execute/after_cursor_execute events, and at the end of the request:
+#   - the totals are added to the response as a Server-Timing header, e.g. Server-Timing: db;dur=12.5;desc="7 queries",
+#     which browsers show in the network tab of their developer tools
+#   - the request is logged with them (app.logger, at INFO), e.g. "GET /moderate 200 7 queries 12.5ms", so they
+#     end up next to the access log
+#   - statements of the same shape (the SQL without its parameters) executed BLOGGING_N_PLUS_ONE_THRESHOLD times or
+#     more are logged as a warning: that is almost always a query per item of a list, i.e. an N+1 that should be a
+#     join, selectinload() or a single IN query
+# Set BLOGGING_QUERY_STATS to False to turn it all off.
+#
+# capture_queries() and query_budget() do the same counting around any block of code, for tests, e.g.
+#   with query_budget(8):
+#       self.client.get("/")
+# fails the test if the page takes more than 8 statements.
+
+import re, threading
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The statements of one request or capture_queries() block
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = []
+        self.shapes = Counter()
+
+    def record(self, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.statements.append(statement)
+        self.shapes[shape_of(statement)] += 1
+
+    # The shapes executed at least threshold times, most repeated first
+    def repeated(self, threshold: int) -> list:
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+# The statement with whitespace collapsed, and lists of placeholders (e.g. of an IN) shortened to one,
+# so that the same query for different items has the same shape
+_whitespace = re.compile(r"\s+")
+_placeholder_list = re.compile(r"\(\s*(\?|%s|:\w+)(\s*,\s*(\?|%s|:\w+))+\s*\)")
+def shape_of(statement: str) -> str:
+    return _placeholder_list.sub(r"(\1)", _whitespace.sub(" ", statement).strip())
+
+# The capture_queries() blocks running in each thread
+_captures = threading.local()
+
+def _active_captures() -> list:
+    if not hasattr(_captures, "stack"):
+        _captures.stack = []
+    return _captures.stack
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_times", []).append(perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get("query_start_times")
+    if not start_times:
+        return
+    seconds = perf_counter() - start_times.pop()
+    if has_request_context():
+        stats = g.get("query_stats")
+        if stats is not None:
+            stats.record(statement, seconds)
+    for stats in _active_captures():
+        stats.record(statement, seconds)
+
+@contextmanager
+def capture_queries():
+    stats = QueryStats()
+    _active_captures().append(stats)
+    try:
+        yield stats
+    finally:
+        _active_captures().remove(stats)
+
+# Fail (with AssertionError, so unittest reports it as a failure) if the block executes more than max_queries
+# statements, listing them.
+@contextmanager
+def query_budget(max_queries: int):
+    with capture_queries() as stats:
+        yield stats
+    if stats.count > max_queries:
+        listing = "\n".join(f"  {statement}" for statement in stats.statements)
+        raise AssertionError(f"{stats.count} queries executed, the budget is {max_queries}:\n{listing}")
+
+def init_app(app) -> None:
+    if not app.config["BLOGGING_QUERY_STATS"]:
+        return
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.pop("query_stats", None)
+        if stats is None:
+            return response
+        milliseconds = stats.seconds * 1000
+        response.headers.add("Server-Timing", f'db;dur={milliseconds:.1f};desc="{stats.count} queries"')
+        app.logger.info("%s %s %s %d queries %.1fms", request.method, request.full_path.rstrip("?"),
+                        response.status_code, stats.count, milliseconds)
+        for shape, count in stats.repeated(app.config["BLOGGING_N_PLUS_ONE_THRESHOLD"]):
+            app.logger.warning("Probable N+1 in %s %s: %d x %s", request.method, request.path, count, shape)
+        return response
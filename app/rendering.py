@@ -0,0 +1,57 @@
+# Turns the markdown that users write in posts, titles and comments into HTML that is safe to show.
+#
+# The markdown input field can be dangerous; attackers can write markdown that generates html that attacks
+# the readers (e.g. <script> tags). So the output of markdown is filtered:
+# First, the markdown input is turned to html by markdown
+# Second, bleach's Cleaner removes any html tags not in ALLOWED_TAGS
+# Third, bleach's Linker is not a security feature; it's there to convert any URL into clickable
+# format (i.e. add <a> tags to them)
+#
+# Building the Markdown, Cleaner and Linker objects is a good part of the cost of a conversion, so they are
+# created once per thread and reused (markdown.markdown(), bleach.clean() and bleach.linkify() create new ones each
+# call). None of them is thread-safe (they keep parser state while converting), hence one set per thread.
+# On top of that, the results are kept in an LRU cache keyed by a hash of the input, so converting the same
+# text again (e.g. a post edited without changing its body, or the same short comment posted many times)
+# costs a hash and a dict lookup.
+# benchmarks/bench_rendering.py compares the cost per call of this with the previous way.
+
+import hashlib
+from threading import local
+from bleach.linkifier import Linker
+from bleach.sanitizer import Cleaner
+from markdown import Markdown
+from .cache import LRUCache
+
+ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                'h1', 'h2', 'h3', 'p']
+
+class MarkdownRenderer:
+    def __init__(self, cache_size: int = 4096):
+        # The Markdown, Cleaner and Linker of each thread, see the top of this file
+        self._local = local()
+        self.cache = LRUCache(cache_size)
+
+    def render(self, text: str) -> str:
+        if text is None:
+            return None
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size = 16).digest()
+        return self.cache.get_or_create(key, lambda: self._render(text))
+
+    def _converters(self):
+        converters = getattr(self._local, "converters", None)
+        if converters is None:
+            converters = self._local.converters = (Markdown(output_format = 'html'),
+                                                   Cleaner(tags = ALLOWED_TAGS, strip = True),
+                                                   Linker())
+        return converters
+
+    def _render(self, text: str) -> str:
+        markdown, cleaner, linker = self._converters()
+        return linker.linkify(cleaner.clean(markdown.reset().convert(text)))
+
+renderer = MarkdownRenderer()
+
+# Markdown text -> safe HTML. Use this instead of calling markdown/bleach directly.
+def render_markdown(text: str) -> str:
+    return renderer.render(text)
@@ -0,0 +1,156 @@
+# Full-text search over posts and comments.
+#
+# Searching with LIKE '%term%' has to read every row of the table, since an index can't be used for a pattern
+# that starts with a wildcard, and it can't rank the results. So the search is backed by an inverted index
+# (word -> rows containing it) instead, which the database provides:
+#   - SQLite: FTS5 virtual tables posts_fts(title, body) and comments_fts(body), whose rowid is the id of the
+#     post/comment. They hold a copy of the text, and are kept in sync by the mapper events at the bottom of
+#     this file, in the same flush as the change to the post/comment. Results are ranked by bm25().
+#   - MySQL (the docker-compose deployment): FULLTEXT indexes on posts(title, body) and comments(body), which
+#     MySQL keeps in sync itself. Results are ranked by MATCH() ... AGAINST() in natural language mode.
+#   - Anything else: LIKE on every word, unranked (newest first). Only meant to keep the search working.
+# The tables/indexes are created together with the posts and comments tables (see the DDL events below) and by
+# the migration that adds them. flask rebuildsearchindex refills the SQLite tables.
+#
+# Results are paginated with keyset pagination (see pagination.py) on (score, id), the score being higher for
+# better matches.
+
+import re
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import match
+from . import db
+from .models import Comment, Post
+from .pagination import KeysetPagination, keyset_paginate
+
+SQLITE_DDL = {
+    "posts": ["CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, body, tokenize = 'porter unicode61')"],
+    "comments": ["CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(body, tokenize = 'porter unicode61')"],
+}
+SQLITE_DROP = {
+    "posts": ["DROP TABLE IF EXISTS posts_fts"],
+    "comments": ["DROP TABLE IF EXISTS comments_fts"],
+}
+MYSQL_DDL = {
+    "posts": ["ALTER TABLE posts ADD FULLTEXT INDEX ix_posts_fulltext (title, body)"],
+    "comments": ["ALTER TABLE comments ADD FULLTEXT INDEX ix_comments_fulltext (body)"],
+}
+
+for model in (Post, Comment):
+    table = model.__table__
+    for statement in SQLITE_DDL[table.name]:
+        sa.event.listen(table, "after_create", sa.DDL(statement).execute_if(dialect = "sqlite"))
+    for statement in SQLITE_DROP[table.name]:
+        sa.event.listen(table, "before_drop", sa.DDL(statement).execute_if(dialect = "sqlite"))
+    for statement in MYSQL_DDL[table.name]:
+        sa.event.listen(table, "after_create", sa.DDL(statement).execute_if(dialect = "mysql"))
+
+# The FTS5 tables, to build queries with. They are not part of db.metadata, so create_all() and the migrations'
+# autogenerate leave them alone.
+fts_metadata = sa.MetaData()
+posts_fts = sa.Table("posts_fts", fts_metadata,
+                     sa.Column("rowid", sa.Integer, primary_key = True), sa.Column("title", sa.Text), sa.Column("body", sa.Text))
+comments_fts = sa.Table("comments_fts", fts_metadata,
+                        sa.Column("rowid", sa.Integer, primary_key = True), sa.Column("body", sa.Text))
+FTS_TABLES = {Post: posts_fts, Comment: comments_fts}
+SEARCHED_COLUMNS = {Post: ("title", "body"), Comment: ("body",)}
+
+def words_of(query: str) -> list:
+    return re.findall(r"\w+", query or "")
+
+# A subquery of the ids of model's rows matching query, with their score
+def _hits(model, query: str):
+    dialect = db.engine.dialect.name
+    columns = [getattr(model, name) for name in SEARCHED_COLUMNS[model]]
+    if dialect == "sqlite":
+        fts = FTS_TABLES[model]
+        # Quote every word, so nothing the user types is taken as FTS5 query syntax; the words are ANDed
+        fts_query = " ".join('"%s"' % word for word in words_of(query))
+        hits = sa.select(fts.c.rowid.label("id"), (-sa.func.bm25(sa.literal_column(fts.name))).label("score"))\
+                 .where(sa.literal_column(fts.name).op("MATCH")(fts_query))
+    elif dialect == "mysql":
+        relevance = match(*columns, against = query)
+        hits = sa.select(model.id.label("id"), relevance.label("score")).where(relevance > 0)
+    else:
+        matches = [sa.or_(*[column.ilike(f"%{word}%") for column in columns]) for word in words_of(query)]
+        hits = sa.select(model.id.label("id"), sa.literal(0.0).label("score")).where(sa.and_(*matches))
+    return hits.subquery()
+
+# Search model (Post or Comment) for query. Returns a KeysetPagination of the matching posts/comments,
+# best matches first. base_query can add options or filters to the query loading them (e.g. feed_query()).
+def search(model, query: str, cursor: str = None, per_page: int = 20, base_query = None):
+    if not words_of(query):
+        return KeysetPagination([], None, None)
+    hits = _hits(model, query)
+    ranked = db.session.query(hits.c.score, hits.c.id)
+    if model is Comment:
+        # Disabled comments are hidden everywhere, so don't find them either
+        ranked = ranked.join(Comment, Comment.id == hits.c.id).filter(Comment.visible())
+    pagination = keyset_paginate(ranked, (hits.c.score, hits.c.id), cursor = cursor, per_page = per_page)
+    ids = [row.id for row in pagination.items]
+    base_query = base_query if base_query is not None else model.query
+    found = {item.id: item for item in base_query.filter(model.id.in_(ids))} if ids else {}
+    pagination.items = [found[id] for id in ids if id in found]
+    return pagination
+
+# Keeping the SQLite tables in sync. MySQL's FULLTEXT indexes need nothing of this.
+
+def _index(connection, model, target) -> None:
+    fts = FTS_TABLES[model]
+    connection.execute(fts.delete().where(fts.c.rowid == target.id))
+    connection.execute(fts.insert().values(rowid = target.id,
+                                           **{name: getattr(target, name) for name in SEARCHED_COLUMNS[model]}))
+
+# Index rows inserted without the ORM (e.g. by Post.bulk_insert()): dicts with the id and the searched columns
+def index_rows(connection, model, rows) -> None:
+    if connection.dialect.name != "sqlite" or not rows:
+        return
+    columns = SEARCHED_COLUMNS[model]
+    connection.execute(FTS_TABLES[model].insert(),
+                       [dict(rowid = row["id"], **{name: row.get(name) for name in columns}) for row in rows])
+
+def _changed(model, target) -> bool:
+    state = sa.inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in SEARCHED_COLUMNS[model])
+
+def _listen(model):
+    @sa.event.listens_for(model, "after_insert")
+    def index_inserted(mapper, connection, target):
+        if connection.dialect.name == "sqlite":
+            _index(connection, model, target)
+
+    @sa.event.listens_for(model, "after_update")
+    def index_updated(mapper, connection, target):
+        if connection.dialect.name == "sqlite" and _changed(model, target):
+            _index(connection, model, target)
+
+    @sa.event.listens_for(model, "after_delete")
+    def unindex_deleted(mapper, connection, target):
+        if connection.dialect.name == "sqlite":
+            fts = FTS_TABLES[model]
+            connection.execute(fts.delete().where(fts.c.rowid == target.id))
+
+_listen(Post)
+_listen(Comment)
+
+# Refill the SQLite tables from the posts and comments tables, chunk_size rows per transaction.
+# Returns the number of rows indexed. Does nothing on other databases, which maintain their indexes themselves.
+def rebuild_index(chunk_size: int = 1000) -> int:
+    if db.engine.dialect.name != "sqlite":
+        return 0
+    indexed = 0
+    for model, fts in FTS_TABLES.items():
+        table = model.__table__
+        columns = SEARCHED_COLUMNS[model]
+        with db.engine.begin() as connection:
+            connection.execute(fts.delete())
+        last_id = 0
+        while True:
+            with db.engine.begin() as connection:
+                rows = connection.execute(sa.select(table.c.id, *[table.c[name] for name in columns])
+                                            .where(table.c.id > last_id).order_by(table.c.id).limit(chunk_size)).all()
+                if not rows:
+                    break
+                connection.execute(fts.insert(), [dict(zip(("rowid",) + columns, row)) for row in rows])
+            indexed += len(rows)
+            last_id = rows[-1].id
+    return indexed
@@ -0,0 +1,214 @@
+# Generator of large, realistic looking datasets, for load testing and for looking at query plans at production scale.
+#
+# developmentHelper.users()/posts() go through the ORM and commit row by row, which is fine for a hundred rows but
+# takes hours for a hundred thousand. This instead builds plain rows in Python and writes them with executemany
+# INSERTs (one per table per chunk of chunk_size rows), with the ids assigned here so that rows can refer to each
+# other without reading anything back. Millions of rows take minutes, on SQLite as well as MySQL.
+#
+# The shape of the data follows what social sites look like, i.e. a few users/posts get most of the attention:
+#   - who is followed, who posts, and which posts get votes and comments follow a Zipf distribution
+#     (the k-th most popular gets 1/k of the attention of the most popular)
+#   - how many users someone follows, and how many votes and comments a post gets, follow a Pareto distribution
+#     with the given means
+#   - post bodies have a log-normal number of words (a median of about 90), split in paragraphs
+# Everything is drawn from one random.Random(seed), so the same arguments always give the same rows (apart from
+# the timestamps, which are relative to now).
+#
+# Since the ORM is bypassed, so are its listeners. This does their work itself:
+#   - body_html/title_html are built directly; the generated text has no markdown syntax, so its HTML is just
+#     paragraphs (the same as render_markdown() would give, see the unit test)
+#   - the vote tallies and comment counts of the posts are counted while generating the votes and comments
+#   - authors with more than BLOGGING_TIMELINE_FANOUT_LIMIT followers are switched to timeline_pull, and the
+#     timelines, search index and post/follow counts of the users are rebuilt at the end (TimelineEntry.rebuild(),
+#     search.rebuild_index(), User.reconcile_social_counts())
+#
+# Use it with flask seed, see blogging.py.
+
+import hashlib, itertools, random
+from datetime import datetime, timedelta
+from flask import current_app
+import sqlalchemy
+from werkzeug.security import generate_password_hash
+from . import db
+from .models import Comment, Follow, Post, TimelineEntry, User, Vote, role_cache
+from .search import rebuild_index
+
+WORDS = ("the of and to in is you that it he was for on are as with his they at be this have from or one had by "
+         "word but not what all were we when your can said there use an each which she do how their if will up other "
+         "about out many then them these so some her would make like him into time has look two more write go see "
+         "number no way could people my than first water been call who oil its now find long down day did get come "
+         "made may part over new sound take only little work know place year live me back give most very after thing "
+         "our just name good sentence man think say great where help through much before line right too mean old any "
+         "same tell boy follow came want show also around form three small set put end does another well large must "
+         "big even such because turn here why ask went men read need land different home us move try kind hand "
+         "picture again change off play spell air away animal house point page letter mother answer found study still "
+         "learn should america world flask python database query index cache server request blog post comment vote").split()
+FIRST_NAMES = "james mary john patricia robert jennifer michael linda william elizabeth david barbara richard susan aldo maria wei yuki ahmed fatima".split()
+LAST_NAMES = "smith johnson williams brown jones garcia miller davis rodriguez martinez sebastian tanaka chen kumar ali novak".split()
+CITIES = "jakarta amsterdam delft tokyo london paris berlin lagos lima toronto sydney mumbai seoul nairobi oslo".split()
+
+def zipf_cum_weights(count: int, exponent: float = 1.0) -> list:
+    return list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(count)))
+
+# An integer drawn from a Pareto distribution with the given mean (shape 2, so the mean is twice the minimum),
+# at most cap
+def pareto_count(rng: random.Random, mean: float, cap: int) -> int:
+    if mean <= 0:
+        return 0
+    return min(int(mean / 2 * rng.paretovariate(2)), cap)
+
+# Up to k distinct ids drawn from ids with the given cumulative weights, none of them in exclude
+def distinct_choices(rng: random.Random, ids: list, cum_weights: list, k: int, exclude = ()) -> set:
+    chosen = set()
+    for _ in range(4):
+        chosen.update(rng.choices(ids, cum_weights = cum_weights, k = k - len(chosen)))
+        chosen.difference_update(exclude)
+        if len(chosen) >= k:
+            break
+    return chosen
+
+def words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choices(WORDS, cum_weights = WORD_CUM_WEIGHTS, k = count))
+WORD_CUM_WEIGHTS = zipf_cum_weights(len(WORDS))
+
+# Returns (text, html) for a body of about word_count words
+def paragraphs(rng: random.Random, word_count: int):
+    parts = []
+    while word_count > 0:
+        length = min(word_count, rng.randint(30, 90))
+        parts.append(words(rng, length).capitalize() + ".")
+        word_count -= length
+    return "\n\n".join(parts), "\n".join(f"<p>{part}</p>" for part in parts)
+
+def random_time(rng: random.Random, start: datetime, end: datetime) -> datetime:
+    return start + timedelta(seconds = rng.uniform(0, max((end - start).total_seconds(), 0)))
+
+def next_id(table) -> int:
+    return (db.session.query(sqlalchemy.func.max(table.c.id)).scalar() or 0) + 1
+
+def insert(table, rows: list) -> None:
+    if rows:
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), rows)
+
+# Generate the dataset, see the top of this file. The rows are added to what is already in the database.
+# echo is called with a line of progress now and then. Returns the number of rows written per table.
+def generate(users: int = 1000, posts: int = 10000, follows_per_user: float = 20, votes_per_post: float = 5,
+             comments_per_post: float = 2, days: int = 365, seed: int = 1, chunk_size: int = 5000,
+             echo = lambda line: None) -> dict:
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    start = now - timedelta(days = days)
+    written = dict.fromkeys(["users", "follows", "posts", "votes", "comments"], 0)
+    # Hashing is slow on purpose, so every generated user gets the same hash of "password"
+    password_hash = generate_password_hash("password")
+    default_role = role_cache.default()
+    role_id = default_role.id if default_role is not None else None
+
+    first_user_id = next_id(User.__table__)
+    user_ids = list(range(first_user_id, first_user_id + users))
+    member_since = {}
+    for chunk in range(0, users, chunk_size):
+        rows = []
+        for user_id in user_ids[chunk:chunk + chunk_size]:
+            joined = random_time(rng, start, now)
+            member_since[user_id] = joined
+            username = f"seed{user_id}"
+            email = f"{username}@example.com"
+            rows.append({"id": user_id, "type": "user", "email": email, "username": username, "role_id": role_id,
+                         "password_hash": password_hash, "confirmed": True,
+                         "name": f"{rng.choice(FIRST_NAMES).title()} {rng.choice(LAST_NAMES).title()}",
+                         "location": rng.choice(CITIES).title(), "about_me": words(rng, rng.randint(5, 30)),
+                         "member_since": joined, "last_seen": random_time(rng, joined, now),
+                         "avatar_hash": hashlib.md5(email.encode("utf-8")).hexdigest(), "timeline_pull": False})
+        insert(User.__table__, rows)
+        written["users"] += len(rows)
+    echo(f"{written['users']} users")
+    if not user_ids:
+        return written
+
+    # Who gets followed, who posts and who votes and comments are each a differently shuffled Zipf ranking
+    def ranking():
+        ranked = user_ids[:]
+        rng.shuffle(ranked)
+        return ranked
+    followed_ranking, author_ranking, reader_ranking = ranking(), ranking(), ranking()
+    user_weights = zipf_cum_weights(len(user_ids))
+
+    follower_counts = dict.fromkeys(user_ids, 0)
+    rows = []
+    for follower_id in user_ids:
+        following = distinct_choices(rng, followed_ranking, user_weights,
+                                     pareto_count(rng, follows_per_user, len(user_ids) - 1), exclude = (follower_id,))
+        for following_id in following:
+            follower_counts[following_id] += 1
+            rows.append({"follower_id": follower_id, "following_id": following_id,
+                         "timestamp": random_time(rng, max(member_since[follower_id], member_since[following_id]), now)})
+        if len(rows) >= chunk_size:
+            insert(Follow.__table__, rows)
+            written["follows"] += len(rows)
+            rows = []
+    insert(Follow.__table__, rows)
+    written["follows"] += len(rows)
+    echo(f"{written['follows']} follows")
+
+    first_post_id = next_id(Post.__table__)
+    first_comment_id = next_id(Comment.__table__)
+    # The Zipf rank of every post for getting votes and comments, shuffled so the popular ones are spread
+    # over the whole time range
+    post_ranks = list(range(posts))
+    rng.shuffle(post_ranks)
+    harmonic = sum(1 / (rank + 1) for rank in range(posts))
+    post_rows, vote_rows, comment_rows = [], [], []
+    for index in range(posts):
+        post_id = first_post_id + index
+        author_id = rng.choices(author_ranking, cum_weights = user_weights)[0]
+        timestamp = random_time(rng, member_since[author_id], now)
+        body, body_html = paragraphs(rng, max(1, int(rng.lognormvariate(4.5, 0.8))))
+        title = words(rng, rng.randint(3, 8)).capitalize()
+        # Its share of all votes and comments, relative to an equal share: the top posts get far more than the
+        # mean, most get fewer
+        boost = posts / (harmonic * (post_ranks[index] + 1))
+        upvotes = downvotes = 0
+        for voter_id in distinct_choices(rng, reader_ranking, user_weights,
+                                         pareto_count(rng, votes_per_post * boost, len(user_ids))):
+            upvote = rng.random() < 0.8
+            upvotes += upvote
+            downvotes += not upvote
+            vote_rows.append({"voter_id": voter_id, "post_id": post_id, "vote_type": upvote,
+                              "timestamp": random_time(rng, timestamp, now)})
+        comment_count, last_comment_at = 0, None
+        for _ in range(pareto_count(rng, comments_per_post * boost, 10 * len(user_ids))):
+            comment_body, comment_html = paragraphs(rng, max(1, int(rng.lognormvariate(3, 0.7))))
+            comment_time = random_time(rng, timestamp, now)
+            comment_rows.append({"id": first_comment_id + written["comments"] + len(comment_rows),
+                                 "author_id": rng.choices(reader_ranking, cum_weights = user_weights)[0],
+                                 "post_id": post_id, "body": comment_body, "body_html": comment_html,
+                                 "timestamp": comment_time, "disabled": 0})
+            comment_count += 1
+            last_comment_at = max(last_comment_at or comment_time, comment_time)
+        post_rows.append({"id": post_id, "title": title, "title_html": f"<p>{title}</p>".capitalize(),
+                          "body": body, "body_html": body_html, "timestamp": timestamp, "author_id": author_id,
+                          "upvote_count": upvotes, "downvote_count": downvotes, "version": 1,
+                          "comment_count": comment_count, "last_comment_at": last_comment_at})
+        if len(post_rows) >= chunk_size or index == posts - 1:
+            insert(Post.__table__, post_rows)
+            insert(Vote.__table__, vote_rows)
+            insert(Comment.__table__, comment_rows)
+            written["posts"] += len(post_rows)
+            written["votes"] += len(vote_rows)
+            written["comments"] += len(comment_rows)
+            post_rows, vote_rows, comment_rows = [], [], []
+            echo(f"{written['posts']} posts, {written['votes']} votes, {written['comments']} comments")
+
+    # Same as TimelineEntry.fan_out() would have decided for these authors
+    limit = current_app.config["BLOGGING_TIMELINE_FANOUT_LIMIT"]
+    pulled = [user_id for user_id, count in follower_counts.items() if count > limit]
+    for chunk in range(0, len(pulled), chunk_size):
+        with db.engine.begin() as connection:
+            connection.execute(User.__table__.update().where(User.__table__.c.id.in_(pulled[chunk:chunk + chunk_size]))
+                                                      .values(timeline_pull = True))
+    echo(f"{TimelineEntry.rebuild(chunk_size = chunk_size)} timeline entries")
+    echo(f"{rebuild_index(chunk_size = chunk_size)} posts and comments in the search index")
+    echo(f"{User.reconcile_social_counts(chunk_size = chunk_size)} users with post and follow counts")
+    return written
@@ -0,0 +1,112 @@
+# In-process index of who follows whom, so User.is_following() and is_followed_by() don't need a query.
+#
+# A profile page asks whether the current user follows the user shown and the other way round, and the follow and
+# unfollow views ask again before writing. Each of those was a query on the follows table. Instead, every worker
+# keeps the ids of the users each user follows, sorted, in an array of 32-bit ints (4 bytes per follow, the size of
+# the id columns), and answers with a binary search:
+#   - the array of a user is loaded with one query, in primary key order, the first time it is needed
+#   - at most BLOGGING_SOCIAL_GRAPH_SIZE users are kept, the least recently used dropped first, and for users who
+#     follow more than BLOGGING_SOCIAL_GRAPH_MAX_FOLLOWING others only that is kept (they are asked about with a
+#     query), so the index takes at most SIZE * MAX_FOLLOWING * 4 bytes per worker
+#   - follows and unfollows written through the ORM are collected by the mapper events at the bottom of this file.
+#     Until the transaction commits only the session that wrote them sees them; then the array of the follower is
+#     dropped, to be loaded again when next needed
+#   - other workers learn about them from the modification time of a file per follower in
+#     BLOGGING_SOCIAL_GRAPH_TAG_DIR, which is touched on commit (with TagVersions, like the page cache, see
+#     page_cache.py). An array loaded before its file was touched is loaded again. With the directory set to None
+#     (e.g. in the tests) the times are kept in memory, for this process only.
+# Follows written without the ORM (e.g. by flask seed) are seen when the arrays expire, after
+# BLOGGING_SOCIAL_GRAPH_TTL seconds.
+#
+# Nothing is stored: after a restart each worker starts with an empty index, which fills up again from the follows
+# table as users are asked about. Restarting the workers is also how to rebuild it by hand, e.g. after restoring a
+# backup. The follower and following counts are columns of users (see User.follower_count), so they need nothing here.
+
+import time
+from array import array
+from bisect import bisect_left
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from . import db
+from .cache import LRUCache
+from .models import Follow
+from .page_cache import TagVersions
+
+def _tag(follower_id: int) -> str:
+    return f"following:{follower_id}"
+
+class SocialGraph:
+    def __init__(self, maxsize: int = 10000, ttl: float = 300, max_following: int = 1000, tag_directory: str = None):
+        # follower id -> (time loaded at, in nanoseconds since the epoch; sorted array of the ids they follow)
+        self.following_ids = LRUCache(maxsize, ttl = ttl)
+        self.max_following = max_following
+        self.tags = TagVersions(tag_directory)
+
+    def init_app(self, app) -> None:
+        app.extensions["social_graph"] = self
+
+    # The sorted ids of the users follower_id follows, or None if they follow too many to keep
+    def following(self, follower_id: int):
+        entry = self.following_ids.get(follower_id)
+        if entry is not None and entry[0] > self.tags.invalidated_at(_tag(follower_id)):
+            return entry[1]
+        loaded_at = time.time_ns()
+        rows = db.session.query(Follow.following_id).filter(Follow.follower_id == follower_id)\
+                .order_by(Follow.following_id).limit(self.max_following + 1).all()
+        # Users who follow too many are remembered as such, so they cost one query per check like before, not two
+        ids = array("i", [following_id for (following_id,) in rows]) if len(rows) <= self.max_following else None
+        self.following_ids.set(follower_id, (loaded_at, ids))
+        return ids
+
+    def follows(self, follower_id: int, following_id: int):
+        ids = self.following(follower_id)
+        if ids is None:
+            return None
+        index = bisect_left(ids, following_id)
+        return index < len(ids) and ids[index] == following_id
+
+    # Forget the arrays of the followers of committed follows and unfollows, {(follower_id, following_id): followed},
+    # here and in the other workers. They are loaded again when next needed. Patching them instead could keep an
+    # array that a write of another worker at the same time made stale, since their tag would only show the later
+    # of the two writes.
+    def apply(self, changes: dict) -> None:
+        followers = {follower_id for follower_id, _ in changes}
+        self.tags.invalidate([_tag(follower_id) for follower_id in followers])
+        for follower_id in followers:
+            self.following_ids.delete(follower_id)
+
+# Whether follower_id follows following_id, including what the current session wrote but hasn't committed
+def follows(follower_id: int, following_id: int) -> bool:
+    session = db.session()
+    # What a query would autoflush
+    if any(isinstance(instance, Follow) for instance in session.new) or \
+            any(isinstance(instance, Follow) for instance in session.deleted):
+        session.flush()
+    pending = session.info.get("social_graph_changes", {}).get((follower_id, following_id))
+    if pending is not None:
+        return pending
+    if has_app_context() and current_app.config["BLOGGING_SOCIAL_GRAPH"] and "social_graph" in current_app.extensions:
+        followed = current_app.extensions["social_graph"].follows(follower_id, following_id)
+        if followed is not None:
+            return followed
+    return db.session.query(Follow.follower_id)\
+            .filter(Follow.follower_id == follower_id, Follow.following_id == following_id).first() is not None
+
+def _record(target, followed: bool) -> None:
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("social_graph_changes", {})[(target.follower_id, target.following_id)] = followed
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed(session):
+    changes = session.info.pop("social_graph_changes", None)
+    if changes and has_app_context() and "social_graph" in current_app.extensions:
+        current_app.extensions["social_graph"].apply(changes)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back(session):
+    session.info.pop("social_graph_changes", None)
+
+event.listen(Follow, "after_insert", lambda mapper, connection, target: _record(target, True))
+event.listen(Follow, "after_delete", lambda mapper, connection, target: _record(target, False))
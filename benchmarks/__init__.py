@@ -0,0 +1,3 @@
+# Benchmarks of the hot paths of the app. These are not unit tests; they measure how long things take,
+# so we can see if a change made something faster or slower. Run a benchmark module with python -m, e.g.
+#   python -m benchmarks.bench_rendering
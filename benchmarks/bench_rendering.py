@@ -0,0 +1,60 @@
+# Micro-benchmark of turning markdown into safe HTML, per call, before and after app/rendering.py:
+#   before:      what the Post/Comment listeners used to do, i.e. markdown() + bleach.clean() + bleach.linkify(),
+#                which build new Markdown/Cleaner/Linker objects on every call
+#   after, cold: MarkdownRenderer on text it hasn't seen yet (reused objects, cache misses)
+#   after, warm: MarkdownRenderer on text it has already rendered (cache hits)
+#
+# Usage: python -m benchmarks.bench_rendering [--calls 2000]
+
+import argparse, random
+from timeit import default_timer as timer
+import bleach
+from markdown import markdown
+from app.rendering import ALLOWED_TAGS, MarkdownRenderer
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua flask python sqlalchemy jinja gunicorn").split()
+
+def make_text(rng: random.Random) -> str:
+    paragraphs = []
+    for _ in range(rng.randint(1, 4)):
+        words = rng.choices(WORDS, k = rng.randint(20, 80))
+        words[rng.randrange(len(words))] = f"**{words[0]}**"
+        paragraphs.append(" ".join(words))
+    paragraphs.append(f"See https://example.com/{rng.randint(0, 10**6)} and `code`")
+    return "\n\n".join(paragraphs)
+
+def render_before(text: str) -> str:
+    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                    'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                    'h1', 'h2', 'h3', 'p']
+    return bleach.linkify(bleach.clean(
+        markdown(text, output_format='html'),
+        tags=allowed_tags, strip=True))
+
+def per_call_microseconds(render, texts) -> float:
+    start = timer()
+    for text in texts:
+        render(text)
+    return (timer() - start) / len(texts) * 1e6
+
+def run(calls: int = 2000, seed: int = 1) -> dict:
+    rng = random.Random(seed)
+    texts = [make_text(rng) for _ in range(calls)]
+    renderer = MarkdownRenderer(cache_size = calls)
+    # Both ways have to give the same HTML, otherwise the comparison is meaningless
+    for text in texts[:50]:
+        assert render_before(text) == renderer._render(text)
+    return {"before_us": per_call_microseconds(render_before, texts),
+            "after_cold_us": per_call_microseconds(renderer.render, texts),
+            "after_warm_us": per_call_microseconds(renderer.render, texts)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--calls", type = int, default = 2000)
+    args = parser.parse_args()
+    results = run(args.calls)
+    print(f"markdown -> safe HTML, per call over {args.calls} texts")
+    print(f"  before (markdown + bleach.clean + bleach.linkify): {results['before_us']:9.1f} us")
+    print(f"  after, cache miss:                                  {results['after_cold_us']:9.1f} us")
+    print(f"  after, cache hit:                                   {results['after_warm_us']:9.1f} us")
@@ -0,0 +1,74 @@
+# Benchmark of searching posts with the full-text index of app/search.py against LIKE '%term%'.
+#
+# Builds a SQLite database of --posts random posts in a temporary file (this takes a while for the default
+# million posts), indexes them the way app/search.py does, then times getting the first page of 20 results
+# for a rare, a medium and a common word:
+#   like: SELECT id FROM posts WHERE title LIKE '%w %' OR body LIKE '%w %' ORDER BY id DESC LIMIT 20
+#         (the space keeps e.g. w1 from matching w10)
+#   fts:  SELECT rowid FROM posts_fts WHERE posts_fts MATCH 'w' ORDER BY bm25(posts_fts) LIMIT 20
+# LIKE has to scan every post that doesn't match, so it is slowest for the rare words; FTS5 reads only the rows
+# containing the word from the index, but has to rank all of them, so it is slowest for the common words.
+#
+# Usage: python -m benchmarks.bench_search [--posts 1000000] [--repeat 5]
+
+import argparse, os, random, sqlite3, tempfile
+from timeit import default_timer as timer
+from app.search import SQLITE_DDL
+
+# Word frequencies follow a power law, like in real text, so there are both very common and very rare words
+VOCABULARY = [f"w{i}" for i in range(20000)]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+def build(path: str, posts: int, seed: int) -> None:
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE posts (id INTEGER PRIMARY KEY, title TEXT, body TEXT)")
+    for statement in SQLITE_DDL["posts"]:
+        connection.execute(statement)
+    chunk = 10000
+    for start in range(0, posts, chunk):
+        rows = [(start + i + 1,
+                 " ".join(rng.choices(VOCABULARY, WEIGHTS, k = 5)),
+                 " ".join(rng.choices(VOCABULARY, WEIGHTS, k = rng.randint(20, 120))))
+                for i in range(min(chunk, posts - start))]
+        connection.executemany("INSERT INTO posts (id, title, body) VALUES (?, ?, ?)", rows)
+        connection.executemany("INSERT INTO posts_fts (rowid, title, body) VALUES (?, ?, ?)", rows)
+        connection.commit()
+    connection.close()
+
+def best_milliseconds(connection, sql: str, parameters, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        connection.execute(sql, parameters).fetchall()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+def run(posts: int = 1000000, repeat: int = 5, seed: int = 1) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "search.sqlite")
+        build(path, posts, seed)
+        connection = sqlite3.connect(path)
+        results = {}
+        for label, word in (("rare", VOCABULARY[-1]), ("medium", VOCABULARY[200]), ("common", VOCABULARY[0])):
+            like = best_milliseconds(connection,
+                                     "SELECT id FROM posts WHERE title LIKE ? OR body LIKE ? ORDER BY id DESC LIMIT 20",
+                                     (f"%{word} %", f"%{word} %"), repeat)
+            fts = best_milliseconds(connection,
+                                    "SELECT rowid FROM posts_fts WHERE posts_fts MATCH ? ORDER BY bm25(posts_fts) LIMIT 20",
+                                    (f'"{word}"',), repeat)
+            matches = connection.execute("SELECT count(*) FROM posts_fts WHERE posts_fts MATCH ?", (f'"{word}"',)).fetchone()[0]
+            results[label] = {"word": word, "matches": matches, "like_ms": like, "fts_ms": fts}
+        connection.close()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--posts", type = int, default = 1000000)
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+    results = run(args.posts, args.repeat)
+    print(f"first page of 20 search results over {args.posts} posts (best of {args.repeat})")
+    for label, result in results.items():
+        print(f"  {label:6} word ({result['matches']:8} matches): LIKE {result['like_ms']:9.2f} ms   FTS5 {result['fts_ms']:9.2f} ms")
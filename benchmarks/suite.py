@@ -0,0 +1,156 @@
+# Micro-benchmarks of the hot paths of the app, run with flask bench (see blogging.py).
+#
+# Every run builds a fresh in-memory SQLite database with the testing config, fills it with
+# app/seeding.generate() (--users/--posts), then times each benchmark below. A benchmark is a function
+# called over and over in rounds; the result is the time per call, in microseconds, of the fastest round
+# (the least disturbed by everything else going on on the machine) and of the median round.
+#
+# The results can be written as JSON (--output) and compared with the JSON of an earlier run (--baseline),
+# e.g. one stored per commit. A benchmark whose fastest round is more than --tolerance slower than in the
+# baseline is reported as a regression, and flask bench then exits with 1.
+#
+# The absolute numbers depend on the machine; only compare runs made on the same one.
+
+import json, platform, statistics, subprocess
+from datetime import datetime
+from itertools import count, cycle
+from timeit import default_timer as timer
+
+# name -> function(context) returning the callable to time. context has the app, a few loaded posts and users,
+# and the size of the rendered page, see run().
+BENCHMARKS = {}
+
+def benchmark(name):
+    def decorator(f):
+        BENCHMARKS[name] = f
+        return f
+    return decorator
+
+@benchmark("post_net_votes")
+def post_net_votes(context):
+    posts = context["posts"]
+    return lambda: [post.net_votes for post in posts]
+
+@benchmark("user_upvoted_posts")
+def user_upvoted_posts(context):
+    users = cycle(context["users"])
+    return lambda: next(users).upvoted_posts
+
+@benchmark("post_to_json")
+def post_to_json(context):
+    posts = context["posts"]
+    return lambda: [post.to_json() for post in posts]
+
+@benchmark("user_to_json")
+def user_to_json(context):
+    users = context["users"]
+    return lambda: [user.to_json() for user in users]
+
+# The body listener, on text it hasn't rendered before (a rendered text would be a cache hit of rendering.py)
+@benchmark("post_on_changed_body")
+def post_on_changed_body(context):
+    from app.models import Post
+    body = context["posts"][0].body
+    texts = (f"{body}\n\nEdit number {n}" for n in count())
+    post = Post()
+    return lambda: setattr(post, "body", next(texts))
+
+@benchmark("posts_template")
+def posts_template(context):
+    from flask import render_template
+    posts = context["page"]
+    return lambda: render_template("_posts.html", posts = posts, vote_states = {})
+
+@benchmark("verify_password")
+def verify_password(context):
+    user = context["users"][0]
+    return lambda: user.verify_password("password")
+
+# A whole request to /vote, through the test client. Every call flips the vote, so it alternates
+# between inserting and deleting it.
+# Keep this last: the requests end by removing the database session, which detaches the posts and users
+# the other benchmarks use.
+@benchmark("vote_handler")
+def vote_handler(context):
+    client = context["app"].test_client()
+    payload = {"post_id": context["posts"][0].id, "voter_id": context["users"][0].id, "iter": 1}
+    return lambda: client.put("/vote", json = payload)
+
+def time_calls(function, rounds: int, calls: int) -> dict:
+    function()  # warm up
+    per_call = []
+    for _ in range(rounds):
+        start = timer()
+        for _ in range(calls):
+            function()
+        per_call.append((timer() - start) / calls * 1e6)
+    return {"min_us": min(per_call), "median_us": statistics.median(per_call), "rounds": rounds, "calls": calls}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                              check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Run the benchmarks whose name contains one of only (all if not given) and return the results.
+def run(users: int = 200, posts: int = 1000, page_size: int = 20, rounds: int = 5, calls: int = 50,
+        seed: int = 1, only = None, echo = lambda line: None) -> dict:
+    from app import create_app, db
+    from app.models import Post, Role, User
+    from app.seeding import generate
+    app = create_app("testing")
+    results = {}
+    with app.app_context():
+        db.create_all()
+        Role.insert_roles()
+        generate(users = users, posts = posts, seed = seed)
+        with app.test_request_context():
+            context = {"app": app,
+                       "posts": Post.query.order_by(Post.id).limit(20).all(),
+                       "users": User.query.order_by(User.id).limit(20).all(),
+                       "page": Post.query.order_by(Post.timestamp.desc()).limit(page_size).all()}
+            for name, make in BENCHMARKS.items():
+                if only and not any(part in name for part in only):
+                    continue
+                # Hashing a password is slow on purpose, so it gets fewer calls
+                results[name] = time_calls(make(context), rounds, 3 if name == "verify_password" else calls)
+                echo(f"{name:24} {results[name]['min_us']:12.1f} us")
+        db.session.remove()
+        db.drop_all()
+    return {"commit": git_commit(),
+            "date": datetime.utcnow().isoformat(timespec = "seconds"),
+            "python": platform.python_version(),
+            "machine": platform.node(),
+            "dataset": {"users": users, "posts": posts, "page_size": page_size, "seed": seed},
+            "results": results}
+
+# Compare results with a baseline (both as returned by run()). Returns the lines to print and the names of
+# the benchmarks that got more than tolerance (e.g. 0.2 for 20%) slower.
+def compare(results: dict, baseline: dict, tolerance: float = 0.2):
+    lines = [f"{'benchmark':24} {'baseline us':>12} {'now us':>12} {'change':>8}",
+             f"(baseline of commit {baseline.get('commit')}, {baseline.get('date')})"]
+    regressions = []
+    for name, result in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            lines.append(f"{name:24} {'-':>12} {result['min_us']:12.1f}      new")
+            continue
+        change = result["min_us"] / before["min_us"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        lines.append(f"{name:24} {before['min_us']:12.1f} {result['min_us']:12.1f} {change:+8.1%}{flag}")
+    if results.get("dataset") != baseline.get("dataset"):
+        lines.append("Warning: the baseline was run on a different dataset, the numbers may not be comparable")
+    return lines, regressions
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+def save(results: dict, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent = 2)
+        f.write("\n")
@@ -26,7 +26,7 @@ if (sys.gettrace() is None and (usedConfiguration in ['testing', 'development',
 
 # The following import imports from __init__.py of app folder
 from app import create_app, db
-from app.models import Permission, User, Role, Follow, Post
+from app.models import Permission, User, Role, Follow, Post, TimelineEntry
 from app.factories import GenericUser, ModeratorUser, AdminUser
 from flask_migrate import Migrate, upgrade
 from config import config
@@ -77,6 +77,32 @@ def test():
     else:
         exit(1)
     
+# Micro-benchmarks of the hot paths (see benchmarks/suite.py), on a generated in-memory database. E.g.
+#   flask bench --output bench.json                       to store the results of this commit
+#   flask bench --baseline bench.json                     to compare with them later; exits with 1 on a regression
+@app.cli.command()
+@click.option("--users", default = 200, show_default = True, help = "Number of users in the generated database")
+@click.option("--posts", default = 1000, show_default = True, help = "Number of posts in the generated database")
+@click.option("--page-size", default = 20, show_default = True, help = "Number of posts in the rendered _posts.html")
+@click.option("--rounds", default = 5, show_default = True, help = "Number of rounds to time each benchmark")
+@click.option("--calls", default = 50, show_default = True, help = "Number of calls per round")
+@click.option("--seed", default = 1, show_default = True, help = "Seed of the generated database")
+@click.option("--only", multiple = True, help = "Only run the benchmarks whose name contains this")
+@click.option("--output", type = click.Path(), help = "Write the results as JSON to this file")
+@click.option("--baseline", type = click.Path(exists = True), help = "Compare with the results in this JSON file")
+@click.option("--tolerance", default = 0.2, show_default = True, help = "Slowdown compared to the baseline that is a regression")
+def bench(output, baseline, tolerance, **kwargs):
+    from benchmarks import suite
+    results = suite.run(echo = print, **kwargs)
+    if output:
+        suite.save(results, output)
+    if baseline:
+        lines, regressions = suite.compare(results, suite.load(baseline), tolerance)
+        print("\n".join(lines))
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            exit(1)
+
 @app.cli.command()
 def deploy():
     # Alembic to migrate the new database to latest version
@@ -84,6 +110,90 @@ def deploy():
     # Create user roles in the roles table in the database, if not yet configured
     Role.insert_roles()
 
+# Fill in (or repair) the upvote_count/downvote_count columns of the posts table from the votes table.
+# Run this once after the migration that adds the columns, and any time the tallies are suspected to
+# have drifted (e.g. after votes were deleted by hand). Safe to run on a live database; it commits per chunk.
+@app.cli.command("reconcilevotes")
+@click.option("--chunk-size", default = 1000, show_default = True, help = "Number of posts to recount per transaction")
+def reconcilevotes(chunk_size):
+    corrected = Post.reconcile_vote_counts(chunk_size = chunk_size)
+    print(f"Vote tallies corrected for {corrected} post(s)")
+
+# Fill in (or repair) the comment_count/last_comment_at columns of the posts table from the visible comments.
+# Run this once after the migration that adds the columns, and any time they are suspected to have drifted.
+@app.cli.command("reconcilecomments")
+@click.option("--chunk-size", default = 1000, show_default = True, help = "Number of posts to recount per transaction")
+def reconcilecomments(chunk_size):
+    corrected = Post.reconcile_comment_counts(chunk_size = chunk_size)
+    print(f"Comment counts corrected for {corrected} post(s)")
+
+# Fill in (or repair) the post_count/follower_count/following_count columns of the users table from the posts and
+# follows tables. Run this once after the migration that adds the columns, and any time they are suspected to have drifted.
+@app.cli.command("reconcileusers")
+@click.option("--chunk-size", default = 1000, show_default = True, help = "Number of users to recount per transaction")
+def reconcileusers(chunk_size):
+    corrected = User.reconcile_social_counts(chunk_size = chunk_size)
+    print(f"Post and follow counts corrected for {corrected} user(s)")
+
+# Rebuild the materialized following timelines (see TimelineEntry in models.py) from the follows and posts tables.
+# Run this once after the migration that adds the timelines table, or whenever the timelines are out of sync.
+@app.cli.command("rebuildtimelines")
+@click.option("--chunk-size", default = 500, show_default = True, help = "Number of followers to rebuild per transaction")
+def rebuildtimelines(chunk_size):
+    written = TimelineEntry.rebuild(chunk_size = chunk_size)
+    print(f"Timelines rebuilt with {written} entries")
+
+# Refill the full-text search tables (see app/search.py) from the posts and comments tables.
+# Only needed on SQLite, e.g. when the search tables are out of sync; MySQL maintains its FULLTEXT indexes itself.
+@app.cli.command("rebuildsearchindex")
+@click.option("--chunk-size", default = 1000, show_default = True, help = "Number of rows to index per transaction")
+def rebuildsearchindex(chunk_size):
+    from app.search import rebuild_index
+    indexed = rebuild_index(chunk_size = chunk_size)
+    print(f"Search index rebuilt with {indexed} posts and comments")
+
+# Render the markdown of the posts created with /api/v1/posts/bulk?render=deferred that isn't rendered yet,
+# e.g. because the worker was stopped before it got to them
+@app.cli.command("renderposts")
+@click.option("--chunk-size", default = 500, show_default = True, help = "Number of posts to render per transaction")
+def renderposts(chunk_size):
+    rendered = Post.render_pending(chunk_size = chunk_size)
+    print(f"Rendered {rendered} post(s)")
+
+# Fill the database with a generated dataset for load testing (see app/seeding.py), e.g.
+#   flask seed --users 100000 --posts 1000000
+# The same --seed gives the same dataset. The rows are added to what is in the database already, so use an empty one.
+@app.cli.command("seed")
+@click.option("--users", default = 1000, show_default = True, help = "Number of users to generate")
+@click.option("--posts", default = 10000, show_default = True, help = "Number of posts to generate")
+@click.option("--follows-per-user", default = 20.0, show_default = True, help = "Mean number of users a user follows")
+@click.option("--votes-per-post", default = 5.0, show_default = True, help = "Mean number of votes on a post")
+@click.option("--comments-per-post", default = 2.0, show_default = True, help = "Mean number of comments on a post")
+@click.option("--days", default = 365, show_default = True, help = "Spread the timestamps over this many past days")
+@click.option("--seed", default = 1, show_default = True, help = "Seed of the random generator")
+@click.option("--chunk-size", default = 5000, show_default = True, help = "Number of rows to insert per statement")
+def seed(**kwargs):
+    from time import perf_counter
+    from app.seeding import generate
+    start = perf_counter()
+    written = generate(echo = print, **kwargs)
+    print(", ".join(f"{count} {table}" for table, count in written.items()) + f" written in {perf_counter() - start:.1f}s")
+
+# Write all posts, comments or votes as NDJSON (see app/export.py) to a file, or to the standard output, e.g.
+#   flask export posts --since 2024-01-31T00:00:00 --output posts.ndjson.gz
+# The output is gzipped if its name ends with .gz.
+@app.cli.command("export")
+@click.argument("kind", type = click.Choice(["posts", "comments", "votes"]))
+@click.option("--since", type = click.DateTime(formats = ["%Y-%m-%d", "%Y-%m-%dT%H:%M:%S"]), help = "Only the rows from this UTC time on")
+@click.option("--output", type = click.Path(dir_okay = False), help = "File to write to instead of the standard output")
+@click.option("--chunk-size", default = 1000, show_default = True, help = "Number of rows to fetch at a time")
+def export(kind, since, output, chunk_size):
+    from app.export import export_ndjson
+    compress = output is not None and output.endswith(".gz")
+    with click.open_file(output or "-", "wb") as f:
+        for block in export_ndjson(kind, since, compress = compress, chunk_size = chunk_size):
+            f.write(block)
+
 # My own helper command to update a new sqlite database based on current model of db.
 # Similar to flask db init, but make our own so we don't depend on that framework!
 @app.cli.command("createdatabase")
@@ -8,6 +8,8 @@ while true; do
     echo Deploy command failed, retrying in 5 secs...
     sleep 5
 done
+# Start the request metrics (see app/metrics.py) from zero, without the files of the previous run's workers
+rm -rf "${BLOGGING_METRICS_DIR:-/tmp/blogging-metrics}"
 # --access-logfile -: write access logs to console
 # --error-logfile logs.log --capture-output: write print statements and errors in app to logs.log
 exec gunicorn -b :5000 --access-logfile - --error-logfile logs.log --capture-output blogging:app
\ No newline at end of file
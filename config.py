@@ -15,6 +15,58 @@ class Config:
     BLOGGING_ADMIN = os.environ.get('BLOGGING_ADMIN') or "aldohasibuan1@gmail.com"
     SQLALCHEMY_TRACK_MODIFICATIONS = True 
     BLOGGING_POSTS_PER_PAGE = 5
+    # Authors with more followers than this are not fanned out to their followers' timelines, but pulled when reading
+    BLOGGING_TIMELINE_FANOUT_LIMIT = int(os.environ.get('BLOGGING_TIMELINE_FANOUT_LIMIT', '5000'))
+    # Number of recent posts copied into a follower's timeline when they start following someone
+    BLOGGING_TIMELINE_BACKFILL = 500
+    # Maximum number of rendered posts kept in the fragment cache of each worker (see app/main/fragments.py)
+    BLOGGING_FRAGMENT_CACHE_SIZE = int(os.environ.get('BLOGGING_FRAGMENT_CACHE_SIZE', '2048'))
+    # users.last_seen is only updated if it is more than this many seconds old, and the updates are
+    # written in batches at most every BLOGGING_LAST_SEEN_FLUSH_INTERVAL seconds (see app/last_seen.py)
+    BLOGGING_LAST_SEEN_GRANULARITY = 60
+    BLOGGING_LAST_SEEN_FLUSH_INTERVAL = 10
+    # Successful API email/password checks are remembered for this many seconds, by up to this many
+    # credentials per worker, to skip the slow password hash (see app/api/authentication.py)
+    BLOGGING_CREDENTIAL_CACHE_TTL = 300
+    BLOGGING_CREDENTIAL_CACHE_SIZE = 1024
+    # Logged-in users are served from a snapshot of their id, username, permissions, confirmed and avatar hash
+    # for this many seconds, by up to this many users per worker (see app/identity.py). Changes to them are announced
+    # to the other workers through files in this directory.
+    BLOGGING_IDENTITY_CACHE_TTL = 60
+    BLOGGING_IDENTITY_CACHE_SIZE = 4096
+    BLOGGING_IDENTITY_TAG_DIR = os.environ.get('BLOGGING_IDENTITY_TAG_DIR', '/tmp/blogging-identities')
+    # Count and time the SQL statements of every request, report them in a Server-Timing header and the log, and
+    # warn about statements repeated this many times in one request, i.e. a probable N+1 (see app/query_stats.py)
+    BLOGGING_QUERY_STATS = True
+    BLOGGING_N_PLUS_ONE_THRESHOLD = 5
+    # Request counts, latencies, SQL time and response sizes per endpoint, served at /metrics in the Prometheus
+    # format. Every worker writes its numbers to a file in this directory at most every
+    # BLOGGING_METRICS_FLUSH_INTERVAL seconds, and /metrics adds them up (see app/metrics.py).
+    # /metrics is for admins, or for a scraper sending "Authorization: Bearer <BLOGGING_METRICS_TOKEN>".
+    BLOGGING_METRICS_DIR = os.environ.get('BLOGGING_METRICS_DIR', '/tmp/blogging-metrics')
+    BLOGGING_METRICS_FLUSH_INTERVAL = 1
+    BLOGGING_METRICS_TOKEN = os.environ.get('BLOGGING_METRICS_TOKEN')
+    # The index, post and user pages are cached whole for visitors who are not logged in, up to this many pages for
+    # this many seconds per worker. Writes invalidate them through tag files in this directory (see app/page_cache.py).
+    BLOGGING_PAGE_CACHE = True
+    BLOGGING_PAGE_CACHE_SIZE = int(os.environ.get('BLOGGING_PAGE_CACHE_SIZE', '512'))
+    BLOGGING_PAGE_CACHE_TTL = 60
+    BLOGGING_PAGE_CACHE_TAG_DIR = os.environ.get('BLOGGING_PAGE_CACHE_TAG_DIR', '/tmp/blogging-page-cache')
+    # Who each user follows is kept in memory by every worker, for up to this many users for this many seconds, to
+    # answer "does A follow B" without a query. Users following more than BLOGGING_SOCIAL_GRAPH_MAX_FOLLOWING others
+    # are not kept. Follows are announced to the other workers through files in this directory
+    # (see app/social_graph.py).
+    BLOGGING_SOCIAL_GRAPH = True
+    BLOGGING_SOCIAL_GRAPH_SIZE = int(os.environ.get('BLOGGING_SOCIAL_GRAPH_SIZE', '10000'))
+    BLOGGING_SOCIAL_GRAPH_TTL = 300
+    BLOGGING_SOCIAL_GRAPH_MAX_FOLLOWING = 1000
+    BLOGGING_SOCIAL_GRAPH_TAG_DIR = os.environ.get('BLOGGING_SOCIAL_GRAPH_TAG_DIR', '/tmp/blogging-social-graph')
+    # Most ids one request to /api/v1/posts?ids= or /api/v1/users?ids= can fetch
+    BLOGGING_API_BATCH_LIMIT = 100
+    # Most posts one request to /api/v1/posts/bulk can create
+    BLOGGING_API_BULK_LIMIT = 10000
+    # Largest request body accepted, in bytes (bigger ones get 413), e.g. for /api/v1/posts/bulk
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', str(16 * 1024 * 1024)))
     NAMING_CONVENTION = {
     "ix": 'ix_%(column_0_label)s',
     "uq": "uq_%(table_name)s_%(column_0_name)s",
@@ -45,6 +97,18 @@ class TestingConfig(Config):
     # Disable csrf check at every post request to the endpoint
     #https://stackoverflow.com/questions/38624060/flask-disable-csrf-in-unittest
     WTF_CSRF_METHODS= []
+    # Write last_seen at the end of every request, so tests can see it
+    BLOGGING_LAST_SEEN_FLUSH_INTERVAL = 0
+    # Keep the metrics of each test app in memory
+    BLOGGING_METRICS_DIR = None
+    # The tests recreate the database between tests, which the page cache can't see; tests of it turn it on
+    BLOGGING_PAGE_CACHE = False
+    BLOGGING_PAGE_CACHE_TAG_DIR = None
+    # Same for the index of follows; tests of it turn it on
+    BLOGGING_SOCIAL_GRAPH = False
+    BLOGGING_SOCIAL_GRAPH_TAG_DIR = None
+    # Keep the times the identities were forgotten in memory
+    BLOGGING_IDENTITY_TAG_DIR = None
 
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
@@ -68,6 +132,8 @@ class DockerConfig(ProductionConfig):
         file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
         file_handler.setLevel(logging.INFO)
         app.logger.addHandler(file_handler)
+        # The per request query counts of query_stats.py are logged at INFO
+        app.logger.setLevel(logging.INFO)
 
 config = {
     'development': DevelopmentConfig,
@@ -86,6 +86,16 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # The full-text search tables and indexes (see app/search.py) are not in the models' metadata,
+    # so stop autogenerate from dropping them
+    def include_object(object, name, type_, reflected, compare_to):
+        if reflected and compare_to is None:
+            if type_ == "table" and "_fts" in name:
+                return False
+            if type_ == "index" and name.endswith("_fulltext"):
+                return False
+        return True
+
     connectable = current_app.extensions['migrate'].db.get_engine()
 
     with connectable.connect() as connection:
@@ -93,6 +103,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata, 
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
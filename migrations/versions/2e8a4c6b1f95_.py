@@ -0,0 +1,28 @@
+"""add indexes for the lists of followers and followings
+
+Revision ID: 2e8a4c6b1f95
+Revises: 9c3e6f1a8d27
+Create Date: 2026-10-18 19:07:35.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e8a4c6b1f95'
+down_revision = '9c3e6f1a8d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('follows', schema=None) as batch_op:
+        batch_op.create_index('ix_follows_following_id_timestamp', ['following_id', 'timestamp', 'follower_id'], unique=False)
+        batch_op.create_index('ix_follows_follower_id_timestamp', ['follower_id', 'timestamp', 'following_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('follows', schema=None) as batch_op:
+        batch_op.drop_index('ix_follows_follower_id_timestamp')
+        batch_op.drop_index('ix_follows_following_id_timestamp')
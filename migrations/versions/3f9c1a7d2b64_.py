@@ -0,0 +1,30 @@
+"""add denormalized vote tallies to posts
+
+Revision ID: 3f9c1a7d2b64
+Revises: 779318bcd6c1
+Create Date: 2026-10-18 09:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c1a7d2b64'
+down_revision = '779318bcd6c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The tallies start at 0 for existing posts; run flask reconcilevotes afterwards
+    # to fill them in from the votes table.
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('upvote_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('downvote_count', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_column('downvote_count')
+        batch_op.drop_column('upvote_count')
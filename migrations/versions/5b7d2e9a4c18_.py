@@ -0,0 +1,32 @@
+"""add denormalized comment counts to posts
+
+Revision ID: 5b7d2e9a4c18
+Revises: e7a3d95c0b16
+Create Date: 2026-10-18 17:02:13.650271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7d2e9a4c18'
+down_revision = 'e7a3d95c0b16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The counts start at 0 (and last_comment_at at NULL) for existing posts; run flask reconcilecomments
+    # afterwards to fill them in from the comments table.
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('last_comment_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_posts_last_comment_at'), ['last_comment_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_posts_last_comment_at'))
+        batch_op.drop_column('last_comment_at')
+        batch_op.drop_column('comment_count')
@@ -0,0 +1,47 @@
+"""add materialized following timelines
+
+Revision ID: 8d2e4b6a1c93
+Revises: 3f9c1a7d2b64
+Create Date: 2026-10-18 11:40:05.918223
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4b6a1c93'
+down_revision = '3f9c1a7d2b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The timelines start empty; run flask rebuildtimelines afterwards to fill them in from the follows table.
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], name=op.f('fk_timelines_author_id_users')),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], name=op.f('fk_timelines_post_id_posts')),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], name=op.f('fk_timelines_user_id_users')),
+    sa.PrimaryKeyConstraint('user_id', 'post_id', name=op.f('pk_timelines'))
+    )
+    with op.batch_alter_table('timelines', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_timelines_author_id'), ['author_id'], unique=False)
+        batch_op.create_index('ix_timelines_user_id_timestamp', ['user_id', 'timestamp', 'post_id'], unique=False)
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('timeline_pull', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('timeline_pull')
+
+    with op.batch_alter_table('timelines', schema=None) as batch_op:
+        batch_op.drop_index('ix_timelines_user_id_timestamp')
+        batch_op.drop_index(batch_op.f('ix_timelines_author_id'))
+
+    op.drop_table('timelines')
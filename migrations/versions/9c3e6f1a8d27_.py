@@ -0,0 +1,32 @@
+"""add denormalized post and follow counts to users
+
+Revision ID: 9c3e6f1a8d27
+Revises: 5b7d2e9a4c18
+Create Date: 2026-10-18 18:24:51.903114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3e6f1a8d27'
+down_revision = '5b7d2e9a4c18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The counts start at 0 for existing users; run flask reconcileusers afterwards
+    # to fill them in from the posts and follows tables.
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('post_count')
@@ -0,0 +1,26 @@
+"""add version to posts
+
+Revision ID: c41b7e05f2a8
+Revises: 8d2e4b6a1c93
+Create Date: 2026-10-18 13:02:57.330194
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41b7e05f2a8'
+down_revision = '8d2e4b6a1c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_column('version')
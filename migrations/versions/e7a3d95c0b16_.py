@@ -0,0 +1,39 @@
+"""add full-text search indexes
+
+Revision ID: e7a3d95c0b16
+Revises: c41b7e05f2a8
+Create Date: 2026-10-18 15:20:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a3d95c0b16'
+down_revision = 'c41b7e05f2a8'
+branch_labels = None
+depends_on = None
+
+
+# See app/search.py: FTS5 tables on SQLite, FULLTEXT indexes on MySQL
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, body, tokenize = 'porter unicode61')")
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(body, tokenize = 'porter unicode61')")
+        op.execute("INSERT INTO posts_fts(rowid, title, body) SELECT id, title, body FROM posts")
+        op.execute("INSERT INTO comments_fts(rowid, body) SELECT id, body FROM comments")
+    elif dialect == 'mysql':
+        op.execute("ALTER TABLE posts ADD FULLTEXT INDEX ix_posts_fulltext (title, body)")
+        op.execute("ALTER TABLE comments ADD FULLTEXT INDEX ix_comments_fulltext (body)")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TABLE IF EXISTS comments_fts")
+        op.execute("DROP TABLE IF EXISTS posts_fts")
+    elif dialect == 'mysql':
+        op.drop_index('ix_comments_fulltext', table_name='comments')
+        op.drop_index('ix_posts_fulltext', table_name='posts')
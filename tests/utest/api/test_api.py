@@ -0,0 +1,303 @@
+from base64 import b64encode
+from datetime import datetime
+import gzip, json
+from unittest import mock
+import unittest
+
+from app import create_app, db
+from app.models import *
+from app.factories.user_factory import user_factory
+from app.export import export_ndjson
+from app.main.fragments import render_post_fragment
+from app.query_stats import query_budget
+
+class APITestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(self) -> None:
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    @classmethod
+    def tearDownClass(self) -> None:
+        self.app_context.pop()
+
+    def setUp(self):
+        db.create_all()
+        Role.insert_roles()
+        self.genericUser = user_factory("User")
+        self.client = self.app.test_client()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+
+    # The API uses HTTP Basic auth; the factories give every user the password "password"
+    def get_api_headers(self, email, password = "password"):
+        return {
+            "Authorization": "Basic " + b64encode(f"{email}:{password}".encode("utf-8")).decode("utf-8"),
+            "Accept": "application/json",
+            "Content-Type": "application/json"
+        }
+
+    def test_no_auth(self):
+        resp = self.client.get("/api/v1/posts/")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_posts_cursor_pagination(self):
+        for i in range(12):
+            db.session.add(Post(body = f"body{i}", author = self.genericUser))
+        db.session.commit()
+        headers = self.get_api_headers(self.genericUser.email)
+        # Walk forward through all the pages following url_next
+        bodies = []
+        url = "/api/v1/posts/"
+        pages = []
+        while url:
+            resp = self.client.get(url, headers = headers)
+            self.assertEqual(resp.status_code, 200)
+            json_resp = resp.get_json()
+            pages.append(json_resp)
+            bodies.extend(post["body"] for post in json_resp["posts"])
+            url = json_resp["url_next"]
+        self.assertEqual(bodies, [f"body{i}" for i in reversed(range(12))])
+        self.assertEqual(len(pages), 3)
+        self.assertIsNone(pages[0]["url_prev"])
+        # And back again from the last page
+        resp = self.client.get(pages[-1]["url_prev"], headers = headers)
+        self.assertEqual(resp.get_json()["posts"], pages[1]["posts"])
+
+    def test_posts_invalid_cursor(self):
+        resp = self.client.get("/api/v1/posts/?cursor=notacursor", headers = self.get_api_headers(self.genericUser.email))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_user_posts_cursor_pagination(self):
+        for i in range(7):
+            db.session.add(Post(body = f"body{i}", author = self.genericUser))
+        db.session.commit()
+        headers = self.get_api_headers(self.genericUser.email)
+        resp = self.client.get(f"/api/v1/users/{self.genericUser.id}/posts/", headers = headers)
+        json_resp = resp.get_json()
+        self.assertEqual(len(json_resp["posts"]), 5)
+        resp = self.client.get(json_resp["url_next"], headers = headers)
+        self.assertEqual([post["body"] for post in resp.get_json()["posts"]], ["body1", "body0"])
+        self.assertIsNone(resp.get_json()["url_next"])
+
+    def test_credentials_are_cached(self):
+        credentials = self.app.extensions["caches"]["credentials"]
+        headers = self.get_api_headers(self.genericUser.email)
+        with mock.patch.object(User, "verify_password", autospec=True, side_effect=User.verify_password) as verify:
+            for _ in range(3):
+                self.assertEqual(self.client.get("/api/v1/posts/", headers = headers).status_code, 200)
+            # Only the first request checked the password hash
+            self.assertEqual(verify.call_count, 1)
+            # A wrong password is never let in by the cache
+            resp = self.client.get("/api/v1/posts/", headers = self.get_api_headers(self.genericUser.email, "wrong"))
+            self.assertEqual(resp.status_code, 401)
+            # Changing the password makes the old one miss the cache
+            self.genericUser.password = "newpassword"
+            db.session.commit()
+            self.assertEqual(self.client.get("/api/v1/posts/", headers = headers).status_code, 401)
+            # And unconfirming the account does too
+            headers = self.get_api_headers(self.genericUser.email, "newpassword")
+            self.assertEqual(self.client.get("/api/v1/posts/", headers = headers).status_code, 200)
+            self.genericUser.confirmed = False
+            db.session.commit()
+            self.assertEqual(self.client.get("/api/v1/posts/", headers = headers).status_code, 403)
+        self.assertGreaterEqual(credentials.stats()["hits"], 2)
+
+    def test_edit_post(self):
+        post = Post(body = "before", author = self.genericUser)
+        db.session.add(post)
+        db.session.commit()
+        cache = self.app.extensions["caches"]["post_fragments"]
+        with self.app.test_request_context():
+            self.assertIn("before", render_post_fragment(post).body)
+        other = user_factory("User")
+        resp = self.client.put(f"/api/v1/posts/{post.id}", headers = self.get_api_headers(other.email),
+                               json = {"body": "not yours"})
+        self.assertEqual(resp.status_code, 403)
+        resp = self.client.put(f"/api/v1/posts/{post.id}", headers = self.get_api_headers(self.genericUser.email),
+                               json = {"body": "*after*"})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.get_json()["body_html"], "<p><em>after</em></p>")
+        # The edit bumped the version of the post, so its fragment is rendered again
+        misses = cache.misses
+        post = db.session.get(Post, post.id)
+        with self.app.test_request_context():
+            body = render_post_fragment(post).body
+        self.assertIn("<em>after</em>", body)
+        self.assertEqual(cache.misses, misses + 1)
+
+    def test_search(self):
+        db.session.add_all([Post(body = "searchable words", author = self.genericUser),
+                            Post(body = "something else", author = self.genericUser)])
+        db.session.commit()
+        headers = self.get_api_headers(self.genericUser.email)
+        resp = self.client.get("/api/v1/search?q=searchable", headers = headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([post["body"] for post in resp.get_json()["posts"]], ["searchable words"])
+        self.assertEqual(self.client.get("/api/v1/search?q=", headers = headers).status_code, 400)
+
+    def test_conditional_get(self):
+        post = Post(body = "body", author = self.genericUser)
+        db.session.add(post)
+        db.session.commit()
+        headers = self.get_api_headers(self.genericUser.email)
+        for url in ["/api/v1/posts/", f"/api/v1/posts/{post.id}", f"/api/v1/users/{self.genericUser.id}",
+                    f"/api/v1/users/{self.genericUser.id}/posts/"]:
+            resp = self.client.get(url, headers = headers)
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers["ETag"]
+            resp = self.client.get(url, headers = dict(headers, **{"If-None-Match": etag}))
+            self.assertEqual(resp.status_code, 304, url)
+            self.assertEqual(resp.get_data(), b"")
+            self.assertEqual(resp.headers["ETag"], etag)
+        # A 304 costs the authentication and the validator's queries only
+        etag = self.client.get("/api/v1/posts/", headers = headers).headers["ETag"]
+        with query_budget(3):
+            self.client.get("/api/v1/posts/", headers = dict(headers, **{"If-None-Match": etag}))
+        # Editing the post, or commenting on it, changes its ETag
+        url = f"/api/v1/posts/{post.id}"
+        etag = self.client.get(url, headers = headers).headers["ETag"]
+        post.body = "edited"
+        db.session.commit()
+        resp = self.client.get(url, headers = dict(headers, **{"If-None-Match": etag}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()["body"], "edited")
+        etag = resp.headers["ETag"]
+        post.create_comment(self.genericUser, "comment")
+        resp = self.client.get(url, headers = dict(headers, **{"If-None-Match": etag}))
+        self.assertEqual(resp.get_json()["comment_count"], 1)
+        # A new post changes the ETag of the lists
+        etag = self.client.get("/api/v1/posts/", headers = headers).headers["ETag"]
+        db.session.add(Post(body = "new", author = self.genericUser))
+        db.session.commit()
+        self.assertEqual(self.client.get("/api/v1/posts/", headers = dict(headers, **{"If-None-Match": etag})).status_code, 200)
+        # Missing resources are still 404
+        self.assertEqual(self.client.get("/api/v1/posts/12345", headers = headers).status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/users/12345/posts/", headers = headers).status_code, 404)
+
+    def test_batch_fetch(self):
+        posts = [Post(body = f"body{i}", author = self.genericUser) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        posts[0].create_comment(self.genericUser, "comment")
+        headers = self.get_api_headers(self.genericUser.email)
+        ids = [posts[2].id, 12345, posts[0].id]
+        with query_budget(4):
+            resp = self.client.get(f"/api/v1/posts?ids={','.join(map(str, ids))}", headers = headers)
+        self.assertEqual(resp.status_code, 200)
+        items = resp.get_json()["posts"]
+        self.assertEqual([item["id"] for item in items], ids)
+        self.assertEqual(items[0]["body"], "body2")
+        self.assertEqual(items[1], {"id": 12345, "error": "not found"})
+        self.assertEqual(items[2]["comment_count"], 1)
+        resp = self.client.get(f"/api/v1/users?ids={self.genericUser.id},999", headers = headers)
+        items = resp.get_json()["users"]
+        self.assertEqual(items[0]["post_count"], 3)
+        self.assertEqual(items[0]["role"], "User")
+        self.assertEqual(items[1]["error"], "not found")
+        self.assertEqual(self.client.get("/api/v1/posts?ids=1,x", headers = headers).status_code, 400)
+        # Without ids it is the list of all posts, as before
+        resp = self.client.get("/api/v1/posts?cursor=abc", headers = headers)
+        self.assertEqual(resp.status_code, 308)
+        self.assertTrue(resp.headers["Location"].endswith("/api/v1/posts/?cursor=abc"))
+        resp = self.client.get("/api/v1/posts", headers = headers, follow_redirects = True)
+        self.assertEqual(len(resp.get_json()["posts"]), 3)
+        self.app.config["BLOGGING_API_BATCH_LIMIT"] = 2
+        try:
+            self.assertEqual(self.client.get("/api/v1/users?ids=1,2,3", headers = headers).status_code, 400)
+        finally:
+            self.app.config["BLOGGING_API_BATCH_LIMIT"] = 100
+
+    def test_export(self):
+        admin = user_factory("Administrator")
+        old = Post(body = "old", author = self.genericUser, timestamp = datetime(2020, 1, 1))
+        new = Post(body = "new", author = self.genericUser, timestamp = datetime(2024, 1, 1))
+        db.session.add_all([old, new])
+        db.session.commit()
+        db.session.add(Vote(post_id = new.id, voter_id = admin.id, vote_type = True))
+        db.session.commit()
+        headers = self.get_api_headers(admin.email)
+        resp = self.client.get("/api/v1/export/posts", headers = headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.get_data(as_text = True).splitlines()]
+        self.assertEqual([row["body"] for row in rows], ["old", "new"])
+        self.assertEqual(rows[1]["timestamp"], "2024-01-01T00:00:00")
+        resp = self.client.get("/api/v1/export/posts?since=2023-01-01", headers = headers)
+        self.assertEqual([json.loads(line)["body"] for line in resp.get_data(as_text = True).splitlines()], ["new"])
+        # Gzipped for clients that accept it
+        resp = self.client.get("/api/v1/export/votes", headers = dict(headers, **{"Accept-Encoding": "gzip"}))
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        rows = [json.loads(line) for line in gzip.decompress(resp.get_data()).splitlines()]
+        self.assertEqual(rows, [{"post_id": new.id, "voter_id": admin.id, "vote_type": True, "timestamp": rows[0]["timestamp"]}])
+        self.assertEqual(self.client.get("/api/v1/export/users", headers = headers).status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/export/posts?since=yesterday", headers = headers).status_code, 400)
+        resp = self.client.get("/api/v1/export/posts", headers = self.get_api_headers(self.genericUser.email))
+        self.assertEqual(resp.status_code, 403)
+
+    def test_export_blocks(self):
+        db.session.add_all([Post(body = "x" * 1000, author = self.genericUser) for _ in range(100)])
+        db.session.commit()
+        with mock.patch("app.export.BLOCK_SIZE", 10000):
+            blocks = list(export_ndjson("posts", chunk_size = 7))
+            self.assertGreater(len(blocks), 5)
+            self.assertEqual(len(b"".join(blocks).splitlines()), 100)
+            compressed = b"".join(export_ndjson("posts", compress = True))
+            self.assertEqual(gzip.decompress(compressed), b"".join(blocks))
+
+    def test_bulk_create(self):
+        follower = user_factory("User")
+        follower.follow(self.genericUser)
+        db.session.commit()
+        headers = self.get_api_headers(self.genericUser.email)
+        posts = [{"body": f"*bulk* {i}", "title": f"title {i}"} for i in range(50)]
+        posts.insert(3, {"title": "no body"})
+        resp = self.client.post("/api/v1/posts/bulk", headers = headers, json = posts)
+        self.assertEqual(resp.status_code, 201)
+        json_resp = resp.get_json()
+        self.assertEqual((json_resp["created"], json_resp["rejected"]), (50, 1))
+        self.assertEqual(json_resp["posts"][3], {"error": "Post does not have a body"})
+        post = db.session.get(Post, json_resp["posts"][4]["id"])
+        self.assertEqual((post.body, post.body_html, post.author_id), ("*bulk* 3", "<p><em>bulk</em> 3</p>", self.genericUser.id))
+        # The new posts are in the follower's timeline and in the search index
+        self.assertEqual(TimelineEntry.query.filter_by(user_id = follower.id).count(), 50)
+        resp = self.client.get("/api/v1/search?q=bulk", headers = headers)
+        self.assertEqual(len(resp.get_json()["posts"]), self.app.config["BLOGGING_POSTS_PER_PAGE"])
+        # NDJSON works too
+        lines = '{"body": "from ndjson"}\nnot json\n'
+        resp = self.client.post("/api/v1/posts/bulk", headers = dict(headers, **{"Content-Type": "application/x-ndjson"}),
+                                data = lines)
+        self.assertEqual([item.get("error") for item in resp.get_json()["posts"]], [None, "Invalid JSON"])
+        self.assertEqual(self.client.post("/api/v1/posts/bulk", headers = headers, json = {"body": "x"}).status_code, 400)
+        # Too many posts, or too big a body, are refused before anything is inserted
+        ndjson = dict(headers, **{"Content-Type": "application/x-ndjson"})
+        self.app.config["BLOGGING_API_BULK_LIMIT"] = 2
+        self.app.config["MAX_CONTENT_LENGTH"] = 100
+        try:
+            count = Post.query.count()
+            self.assertEqual(self.client.post("/api/v1/posts/bulk", headers = headers,
+                                              json = [{"body": "x"}] * 3).status_code, 413)
+            self.assertEqual(self.client.post("/api/v1/posts/bulk", headers = ndjson,
+                                              data = '{"body": "x"}\n' * 3).status_code, 413)
+            self.assertEqual(self.client.post("/api/v1/posts/bulk", headers = ndjson,
+                                              data = '{"body": "%s"}' % ("x" * 100)).status_code, 413)
+            self.assertEqual(Post.query.count(), count)
+        finally:
+            self.app.config["BLOGGING_API_BULK_LIMIT"] = 10000
+            self.app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+        # With deferred rendering, the posts are rendered once the response is closed
+        other = self.client.post("/api/v1/posts/bulk?render=deferred", headers = headers, json = [{"body": "*other*"}])
+        resp = self.client.post("/api/v1/posts/bulk?render=deferred", headers = headers, json = [{"body": "*later*"}])
+        post_id = resp.get_json()["posts"][0]["id"]
+        post = db.session.get(Post, post_id)
+        self.assertIsNone(post.body_html)
+        resp.close()
+        post = db.session.get(Post, post_id)
+        self.assertEqual((post.body_html, post.version), ("<p><em>later</em></p>", 2))
+        # Only the posts of that request were rendered
+        self.assertIsNone(db.session.get(Post, other.get_json()["posts"][0]["id"]).body_html)
+        self.assertEqual(Post.render_pending(chunk_size = 1), 1)
+        self.assertEqual(Post.render_pending(), 0)
@@ -2,7 +2,9 @@ from datetime import datetime
 import unittest, logging,sys
 
 from flask import url_for
+from sqlalchemy import event
 from app import create_app, db
+from app.last_seen import LastSeenBuffer
 from app.main.views import follow
 from app.models import User, Role
 
@@ -106,3 +108,76 @@ class AuthTestCase(unittest.TestCase):
         # Assert
         self.assertTrue("Register here" in resp.get_data(as_text=True))
 
+
+    def test_last_seen_is_buffered(self):
+        # A user of its own, so other tests logging in don't affect what is buffered
+        long_ago = datetime(2000, 1, 1)
+        seen_user = User(username="lastSeen", password=self.password, email="seen@test.com", last_seen=long_ago)
+        db.session.add(seen_user)
+        db.session.commit()
+        # Count the UPDATEs of users.last_seen made while requesting pages
+        updates = []
+        def count_updates(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("UPDATE users SET last_seen"):
+                updates.append(statement)
+        event.listen(db.engine, "before_cursor_execute", count_updates)
+        try:
+            self.client.post('/auth/login', data = {"email": "seen@test.com", "password": self.password})
+            for _ in range(3):
+                self.client.get('/')
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_updates)
+            self.client.get('/auth/logout')
+        # Seen several times within the granularity, but written only once
+        self.assertEqual(len(updates), 1)
+        db.session.expire_all()
+        self.assertGreater(db.session.get(User, seen_user.id).last_seen, long_ago)
+        # An older time never overwrites a newer one, e.g. when flushed later by another worker
+        newer = db.session.get(User, seen_user.id).last_seen
+        other_worker = LastSeenBuffer()
+        other_worker.record(seen_user.id, now = long_ago)
+        self.assertEqual(other_worker.flush(db.engine), 1)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, seen_user.id).last_seen, newer)
+
+    def test_failed_last_seen_flush_is_kept(self):
+        seen_user = User(username="failedSeen", password=self.password, email="failed@test.com",
+                         last_seen=datetime(2000, 1, 1))
+        db.session.add(seen_user)
+        db.session.commit()
+        buffer = LastSeenBuffer(flush_interval = 60)
+        buffer.record(seen_user.id)
+        def fail(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("UPDATE users SET last_seen"):
+                raise RuntimeError("database is down")
+        event.listen(db.engine, "before_cursor_execute", fail)
+        try:
+            with self.assertLogs(self.app.logger, "ERROR"):
+                buffer._flush_or_log(self.app, db)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", fail)
+        # Still pending, and a retry is planned
+        self.assertIn(seen_user.id, buffer._pending)
+        self.assertIsNotNone(buffer._timer)
+        buffer._timer.cancel()
+        self.assertEqual(buffer.flush(db.engine), 1)
+        db.session.expire_all()
+        self.assertGreater(db.session.get(User, seen_user.id).last_seen, datetime(2000, 1, 1))
+
+    def test_last_seen_is_flushed_without_requests(self):
+        seen_user = User(username="idleSeen", password=self.password, email="idle@test.com",
+                         last_seen=datetime(2000, 1, 1))
+        db.session.add(seen_user)
+        db.session.commit()
+        idle_worker = LastSeenBuffer(flush_interval = 0.05)
+        idle_worker.record(seen_user.id)
+        self.assertFalse(idle_worker.flush_due())
+        idle_worker.flush_later(self.app, db)
+        timer = idle_worker._timer
+        # Only one timer at a time
+        idle_worker.flush_later(self.app, db)
+        self.assertIs(idle_worker._timer, timer)
+        timer.join(5)
+        self.assertEqual(idle_worker._pending, {})
+        db.session.expire_all()
+        self.assertGreater(db.session.get(User, seen_user.id).last_seen, datetime(2000, 1, 1))
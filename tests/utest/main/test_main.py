@@ -1,9 +1,12 @@
 from functools import wraps
-import unittest, logging, sys
+import re, shutil, tempfile, unittest, logging, sys
 
 from app import create_app, db
 from app.models import *
+from sqlalchemy import text
 from app.factories.user_factory import user_factory
+from app.page_cache import TagVersions
+from app.query_stats import capture_queries, query_budget
 
 logging.basicConfig( stream=sys.stdout )
 logging.getLogger(__name__).setLevel( logging.DEBUG )
@@ -353,6 +356,32 @@ class MainTestCase(unittest.TestCase):
          self.assertTrue(f"{self.moderatorUser.username}" in resp.get_data(as_text=True))
          self.assertTrue(f"{self.administratorUser.username}" in resp.get_data(as_text=True))
 
+    def test_follower_list_pages(self):
+        users = [User(email = f"f{i}@test.com", username = f"follower{i}", password = "password",
+                      about_me = "x" * 500) for i in range(7)]
+        db.session.add_all(users)
+        db.session.commit()
+        for i, user in enumerate(users):
+            db.session.add(Follow(follower = user, following = self.genericUser, timestamp = datetime(2020, 1, 1, i)))
+        db.session.commit()
+        page = self.client.get(f"/followers/{self.genericUser.username}").get_data(as_text = True)
+        self.assertTrue("follower6" in page and "follower2" in page and "follower1" not in page)
+        # Only the start of about_me is read
+        self.assertTrue("x" * Follow.ABOUT_ME_EXCERPT in page and "x" * (Follow.ABOUT_ME_EXCERPT + 1) not in page)
+        self.assertTrue(users[6].gravatar(size = 40).replace("&", "&amp;") in page)
+        next_url = re.search(r'href="(/followers/[^"?]+\?cursor=[^"]+)"', page).group(1)
+        page = self.client.get(next_url).get_data(as_text = True)
+        self.assertTrue("follower1" in page and "follower0" in page and "follower2" not in page)
+        page = self.client.get(f"/followings/{users[0].username}").get_data(as_text = True)
+        self.assertTrue(self.genericUser.username in page)
+        self.assertEqual(self.client.get("/followers/nobody").status_code, 404)
+        # A page of the list is a range scan of the index, not a sort of all the followers
+        query, order = Follow.listing(self.genericUser.id)
+        statement = str(query.order_by(*[column.desc() for column in order])
+                        .statement.compile(db.engine, compile_kwargs = {"literal_binds": True}))
+        plan = " ".join(str(row) for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {statement}")))
+        self.assertTrue("ix_follows_following_id_timestamp" in plan and "TEMP B-TREE" not in plan)
+
     @log_in_and_out("moderatorUser")
     def test_moderate_success(self):
         resp = self.client.get(f"/moderate")
@@ -379,4 +408,258 @@ class MainTestCase(unittest.TestCase):
         resp3 = self.client.get(f"/moderate/enable/1")
         self.assertEqual(db.session.query(Comment).get(1).disabled, 0)
         resp4 = self.client.get(f"/moderate")
-        self.assertTrue("testComment" in resp4.get_data(as_text=True))
\ No newline at end of file
+        self.assertTrue("testComment" in resp4.get_data(as_text=True))
+    @post_something("genericUser", "testPost")
+    def test_vote_updates_post_tallies(self):
+        def cast(iter):
+            return self.client.put("/vote", json = {"post_id": 1,
+                                                    "voter_id": self.moderatorUser.id,
+                                                    "iter": iter})
+        # A new upvote
+        resp = cast(1)
+        self.assertEqual(resp.get_json()["votes"], 1)
+        post = db.session.get(Post, 1)
+        self.assertEqual((post.upvote_count, post.downvote_count), (1, 0))
+        # Switching to a downvote moves the vote over
+        resp = cast(-1)
+        self.assertEqual(resp.get_json()["votes"], -1)
+        db.session.refresh(post)
+        self.assertEqual((post.upvote_count, post.downvote_count), (0, 1))
+        # Downvoting again takes the vote back
+        resp = cast(-1)
+        self.assertEqual(resp.get_json()["votes"], 0)
+        db.session.refresh(post)
+        self.assertEqual((post.upvote_count, post.downvote_count), (0, 0))
+        self.assertEqual(db.session.query(Vote).count(), 0)
+
+    @post_something("genericUser", "testPost")
+    @log_in_and_out("moderatorUser")
+    def test_feed_highlights_current_user_votes(self):
+        resp = self.client.get("/")
+        self.assertFalse("vote-up on" in resp.get_data(as_text=True))
+        self.client.put("/vote", json = {"post_id": 1, "voter_id": self.moderatorUser.id, "iter": 1})
+        for url in ["/", "/post/1", f"/user/{self.genericUser.username}"]:
+            resp = self.client.get(url)
+            self.assertTrue("vote-up on" in resp.get_data(as_text=True))
+            self.assertFalse("vote-down on" in resp.get_data(as_text=True))
+
+    def test_index_query_count_does_not_grow_with_page_size(self):
+        authors = [self.genericUser, self.moderatorUser, self.administratorUser]
+        for i in range(12):
+            db.session.add(Post(title = f"title{i}", body = f"body{i}", author = authors[i % 3]))
+        db.session.commit()
+        try:
+            counts = []
+            for per_page in (2, 12):
+                self.app.config["BLOGGING_POSTS_PER_PAGE"] = per_page
+                with capture_queries() as queries:
+                    resp = self.client.get("/")
+                self.assertEqual(resp.status_code, 200)
+                counts.append(queries.count)
+        finally:
+            self.app.config["BLOGGING_POSTS_PER_PAGE"] = 5
+        self.assertEqual(counts[0], counts[1])
+
+    def test_index_cursor_pagination(self):
+        for i in range(7):
+            db.session.add(Post(title = f"title{i}", body = f"postbody{i}", author = self.genericUser))
+        db.session.commit()
+        resp = self.client.get("/")
+        page = resp.get_data(as_text = True)
+        self.assertTrue("postbody6" in page and "postbody2" in page and "postbody1" not in page)
+        next_url = re.search(r'href="(/\?cursor=[^"]+)"', page).group(1)
+        resp = self.client.get(next_url)
+        page = resp.get_data(as_text = True)
+        self.assertTrue("postbody1" in page and "postbody0" in page and "postbody2" not in page)
+        # An invalid cursor starts over from the first page
+        resp = self.client.get("/?cursor=garbage", follow_redirects = True)
+        self.assertEqual(resp.request.path, "/")
+        self.assertTrue("Invalid cursor" in resp.get_data(as_text = True))
+
+    def test_recently_active_feed(self):
+        posts = [Post(title = f"title{i}", body = f"postbody{i}", author = self.genericUser) for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        # Only commented posts are listed, the most recently commented first
+        for hour, i in enumerate((0, 3, 1, 4, 2, 5)):
+            db.session.add(Comment(body = "comment", author = self.moderatorUser, post = posts[i],
+                                   timestamp = datetime(2020, 1, 1, hour)))
+        db.session.commit()
+        page = self.client.get("/active").get_data(as_text = True)
+        self.assertTrue(page.index("postbody5") < page.index("postbody2") < page.index("postbody4"))
+        self.assertTrue("postbody6" not in page and "postbody0" not in page)
+        next_url = re.search(r'href="(/active\?cursor=[^"]+)"', page).group(1)
+        page = self.client.get(next_url).get_data(as_text = True)
+        self.assertTrue("postbody0" in page and "postbody5" not in page)
+
+    def following_feed_of(self, user):
+        self.client.post('/auth/login', data = {"email": user.email, "password": "password"})
+        self.client.get('/following')
+        page = self.client.get('/').get_data(as_text = True)
+        self.client.get('/auth/logout')
+        return page
+
+    def create_post_as(self, user, body):
+        self.client.post('/auth/login', data = {"email": user.email, "password": "password"})
+        self.client.post('/', data = {"title": "title", "text": body})
+        self.client.get('/auth/logout')
+
+    def test_following_feed_fan_out_backfill_and_prune(self):
+        self.create_post_as(self.moderatorUser, "postBeforeFollowing")
+        self.genericUser.follow(self.moderatorUser)
+        db.session.commit()
+        # Following backfills the posts made before
+        self.assertTrue("postBeforeFollowing" in self.following_feed_of(self.genericUser))
+        # New posts are fanned out to the followers
+        self.create_post_as(self.moderatorUser, "postAfterFollowing")
+        self.assertEqual(db.session.query(TimelineEntry).filter_by(user_id = self.genericUser.id).count(), 2)
+        page = self.following_feed_of(self.genericUser)
+        self.assertTrue("postAfterFollowing" in page)
+        # Posts of users that are not followed are not in the feed
+        self.create_post_as(self.administratorUser, "postNotFollowed")
+        self.assertFalse("postNotFollowed" in self.following_feed_of(self.genericUser))
+        # Unfollowing prunes the timeline
+        self.genericUser.unfollow(self.moderatorUser)
+        db.session.commit()
+        self.assertEqual(db.session.query(TimelineEntry).filter_by(user_id = self.genericUser.id).count(), 0)
+        self.assertFalse("postAfterFollowing" in self.following_feed_of(self.genericUser))
+
+    def test_following_feed_pulls_authors_with_many_followers(self):
+        self.genericUser.follow(self.moderatorUser)
+        self.administratorUser.follow(self.moderatorUser)
+        db.session.commit()
+        self.create_post_as(self.moderatorUser, "postFannedOut")
+        self.app.config["BLOGGING_TIMELINE_FANOUT_LIMIT"] = 1
+        try:
+            self.create_post_as(self.moderatorUser, "postPulled")
+        finally:
+            self.app.config["BLOGGING_TIMELINE_FANOUT_LIMIT"] = 5000
+        self.assertTrue(db.session.get(User, self.moderatorUser.id).timeline_pull)
+        self.assertEqual(db.session.query(TimelineEntry).filter_by(user_id = self.genericUser.id).count(), 1)
+        page = self.following_feed_of(self.genericUser)
+        self.assertTrue("postFannedOut" in page and "postPulled" in page)
+        self.assertEqual(page.count("postFannedOut"), 1)
+
+    @post_something("genericUser", "MyNewPost")
+    @log_in_and_out("genericUser")
+    def test_post_fragments_are_cached_until_edited(self):
+        cache = self.app.extensions["caches"]["post_fragments"]
+        # Logging in already rendered the index page once, so the fragment is cached
+        misses, hits = cache.misses, cache.hits
+        self.client.get("/")
+        self.client.get("/post/1")
+        self.assertEqual((cache.misses, cache.hits), (misses, hits + 2))
+        # The viewer dependent parts are still rendered for the current user
+        self.assertTrue("Edit</span>" in self.client.get("/post/1").get_data(as_text = True))
+        self.client.post("/edit/1", data = {"title": "newTitle", "text": "editedBody"})
+        page = self.client.get("/").get_data(as_text = True)
+        self.assertTrue("editedBody" in page and "MyNewPost" not in page)
+        self.assertEqual(cache.misses, misses + 1)
+
+    @log_in_and_out("administratorUser")
+    def test_cache_stats(self):
+        resp = self.client.get("/admin/cache")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue("post_fragments" in resp.get_json())
+
+    @log_in_and_out("genericUser")
+    def test_metrics_is_for_admins(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+    @log_in_and_out("administratorUser")
+    def test_metrics(self):
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('blogging_http_requests_total{endpoint="auth.login",method="POST"' in resp.get_data(as_text = True))
+
+    @log_in_and_out("genericUser")
+    def test_current_user_is_served_from_identity_cache(self):
+        identities = self.app.extensions["caches"]["identities"]
+        hits = identities.hits
+        self.assertEqual(self.client.get("/moderate").status_code, 403)
+        self.assertEqual(self.client.get("/moderate").status_code, 403)
+        self.assertEqual(identities.hits, hits + 2)
+        # An admin making the user a moderator drops the user's cached identity, so it applies right away
+        admin = self.app.test_client(use_cookies = True)
+        admin.post('/auth/login', data = {"email": self.administratorUser.email, "password": "password"})
+        admin.post(f'/edit_profile/{self.genericUser.id}', data = {
+            "name": "name",
+            "location": "location",
+            "about_me": "about me",
+            "username": self.genericUser.username,
+            "email": self.genericUser.email,
+            "confirmed": "y",
+            "role": str(Role.query.filter_by(name = "Moderator").first().id)
+        })
+        self.assertEqual(self.client.get("/moderate").status_code, 200)
+
+    @log_in_and_out("genericUser")
+    def test_identity_forgotten_by_another_worker(self):
+        directory = tempfile.mkdtemp()
+        tags = self.app.extensions["identity_tags"]
+        try:
+            self.app.extensions["identity_tags"] = TagVersions(directory)
+            self.assertEqual(self.client.get("/moderate").status_code, 403)
+            # Another worker makes the user a moderator and announces it through the shared directory
+            db.session.execute(User.__table__.update().where(User.__table__.c.id == self.genericUser.id)
+                               .values(role_id = Role.query.filter_by(name = "Moderator").first().id))
+            db.session.commit()
+            self.assertEqual(self.client.get("/moderate").status_code, 403)
+            TagVersions(directory).invalidate([f"user:{self.genericUser.id}"])
+            self.assertEqual(self.client.get("/moderate").status_code, 200)
+        finally:
+            self.app.extensions["identity_tags"] = tags
+            shutil.rmtree(directory)
+
+    @log_in_and_out("moderatorUser")
+    def test_moderation_page_reads_roles_at_most_once(self):
+        post = Post(body = "commented", author = self.genericUser)
+        db.session.add(post)
+        for i in range(50):
+            db.session.add(Comment(body = f"comment{i}", post = post, author = self.genericUser))
+        db.session.commit()
+        with capture_queries() as queries:
+            resp = self.client.get("/moderate")
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len([s for s in queries.statements if "FROM roles" in s]), 1)
+
+    @post_something("genericUser", "findMeInTheSearch")
+    def test_search_page(self):
+        page = self.client.get("/search?q=findMeInTheSearch").get_data(as_text = True)
+        self.assertTrue("findMeInTheSearch" in page)
+        page = self.client.get("/search?q=nothingLikeThis").get_data(as_text = True)
+        self.assertTrue('Nothing found for "nothingLikeThis"' in page)
+
+    # The query budgets of the main pages; they must not grow with the number of posts, comments or followers shown
+    def test_query_budgets(self):
+        post = Post(body = "commented", author = self.genericUser)
+        db.session.add(post)
+        for i in range(10):
+            db.session.add(Post(body = f"post{i}", author = self.moderatorUser))
+            db.session.add(Comment(body = f"comment{i}", post = post, author = self.administratorUser))
+        self.moderatorUser.follow(self.genericUser)
+        self.administratorUser.follow(self.genericUser)
+        db.session.commit()
+        budgets = {"/": 4,
+                   f"/user/{self.genericUser.username}": 3,
+                   f"/post/{post.id}": 5,
+                   f"/followers/{self.genericUser.username}": 3,
+                   f"/search?q=post0": 5}
+        for path, budget in budgets.items():
+            with query_budget(budget):
+                self.assertEqual(self.client.get(path).status_code, 200)
+
+    # Profiles read the post and follow counts from the users table instead of counting
+    def test_profile_does_not_count(self):
+        self.moderatorUser.follow(self.genericUser)
+        db.session.add(Post(body = "post", author = self.genericUser))
+        db.session.commit()
+        with capture_queries() as stats:
+            page = self.client.get(f"/user/{self.genericUser.username}").get_data(as_text = True)
+        self.assertTrue(re.search(r'Followers: <span class="badge">\s*1\s*</span>', page))
+        self.assertTrue(re.search(r'Following: <span class="badge">\s*0\s*</span>', page))
+        self.assertFalse(any("count(" in statement.lower() for statement in stats.statements))
+
+    def test_server_timing_header(self):
+        resp = self.client.get("/")
+        self.assertRegex(resp.headers["Server-Timing"], r'^db;dur=[0-9.]+;desc="[0-9]+ queries"$')
@@ -0,0 +1,16 @@
+import unittest
+from benchmarks import suite
+
+class BenchmarkSuiteTestCase(unittest.TestCase):
+    def test_all_benchmarks_run(self):
+        results = suite.run(users=5, posts=10, page_size=5, rounds=1, calls=1)
+        self.assertEqual(set(results["results"]), set(suite.BENCHMARKS))
+        self.assertTrue(all(result["min_us"] > 0 for result in results["results"].values()))
+
+    def test_compare_flags_regressions(self):
+        baseline = {"results": {"fast": {"min_us": 100.0}, "slow": {"min_us": 100.0}}, "dataset": {}}
+        results = {"results": {"fast": {"min_us": 110.0}, "slow": {"min_us": 130.0}, "added": {"min_us": 5.0}},
+                   "dataset": {}}
+        lines, regressions = suite.compare(results, baseline, tolerance=0.2)
+        self.assertEqual(regressions, ["slow"])
+        self.assertTrue(any("added" in line and "new" in line for line in lines))
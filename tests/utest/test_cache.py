@@ -0,0 +1,38 @@
+import unittest
+from unittest import mock
+from app.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Using "a" makes "b" the least recently used
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_get_or_create_counts_hits_and_misses(self):
+        cache = LRUCache()
+        calls = []
+        creator = lambda: calls.append(1) or "value"
+        self.assertEqual(cache.get_or_create("key", creator), "value")
+        self.assertEqual(cache.get_or_create("key", creator), "value")
+        self.assertEqual(len(calls), 1)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(ttl=60)
+        with mock.patch("app.cache.monotonic", return_value=1000.0):
+            cache.set("key", "value")
+        with mock.patch("app.cache.monotonic", return_value=1059.0):
+            self.assertEqual(cache.get("key"), "value")
+        with mock.patch("app.cache.monotonic", return_value=1060.0):
+            self.assertIsNone(cache.get("key"))
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,71 @@
+import os, shutil, tempfile, unittest
+from app import create_app, db
+from app.metrics import Registry
+from app.models import Role
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_exposition_format(self):
+        registry = Registry()
+        labels = (("endpoint", "main.index"),)
+        registry.inc("blogging_http_requests_total", labels + (("method", "GET"), ("status", "200")))
+        registry.observe("blogging_http_request_duration_seconds", labels, 0.02)
+        registry.observe("blogging_http_request_duration_seconds", labels, 3)
+        text = registry.exposition()
+        self.assertIn("# TYPE blogging_http_request_duration_seconds histogram", text)
+        self.assertIn('blogging_http_requests_total{endpoint="main.index",method="GET",status="200"} 1', text)
+        # Bucket counts are cumulative
+        self.assertIn('blogging_http_request_duration_seconds_bucket{endpoint="main.index",le="0.01"} 0', text)
+        self.assertIn('blogging_http_request_duration_seconds_bucket{endpoint="main.index",le="0.025"} 1', text)
+        self.assertIn('blogging_http_request_duration_seconds_bucket{endpoint="main.index",le="+Inf"} 2', text)
+        self.assertIn('blogging_http_request_duration_seconds_sum{endpoint="main.index"} 3.02', text)
+        self.assertIn('blogging_http_request_duration_seconds_count{endpoint="main.index"} 2', text)
+
+    def test_workers_are_added_up(self):
+        labels = (("endpoint", "main.index"), ("method", "GET"), ("status", "200"))
+        other_worker = Registry(self.directory)
+        other_worker.inc("blogging_http_requests_total", labels, 2)
+        other_worker.observe("blogging_http_response_size_bytes", (("endpoint", "main.index"),), 100)
+        # Another process, as far as the files are concerned
+        other_worker.flush()
+        os.rename(os.path.join(self.directory, f"{os.getpid()}.json"), os.path.join(self.directory, "1.json"))
+        registry = Registry(self.directory)
+        registry.inc("blogging_http_requests_total", labels, 3)
+        registry.observe("blogging_http_response_size_bytes", (("endpoint", "main.index"),), 5000)
+        text = registry.exposition()
+        self.assertIn('blogging_http_requests_total{endpoint="main.index",method="GET",status="200"} 5', text)
+        self.assertIn('blogging_http_response_size_bytes_bucket{endpoint="main.index",le="256"} 1', text)
+        self.assertIn('blogging_http_response_size_bytes_count{endpoint="main.index"} 2', text)
+
+    def test_requests_are_recorded(self):
+        client = self.app.test_client()
+        client.get("/")
+        client.get("/no/such/page")
+        text = self.app.extensions["metrics"].exposition()
+        self.assertIn('blogging_http_requests_total{endpoint="main.index",method="GET",status="200"} 1', text)
+        self.assertIn('blogging_http_requests_total{endpoint="unmatched",method="GET",status="404"} 1', text)
+        self.assertIn('blogging_http_db_duration_seconds_count{endpoint="main.index"} 1', text)
+        self.assertIn('blogging_http_response_size_bytes_count{endpoint="main.index"} 1', text)
+
+    def test_metrics_needs_an_admin_or_the_token(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get("/metrics").status_code, 401)
+        self.app.config["BLOGGING_METRICS_TOKEN"] = "secret"
+        self.assertEqual(client.get("/metrics", headers = {"Authorization": "Bearer wrong"}).status_code, 401)
+        resp = client.get("/metrics", headers = {"Authorization": "Bearer secret"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn("# TYPE blogging_http_requests_total counter", resp.get_data(as_text = True))
@@ -1,7 +1,9 @@
 from datetime import datetime
-from app.models import AnonymousUser, Permission, User, Role, Follow
-import unittest
+from sqlalchemy import event, text
+from app.models import AnonymousUser, Permission, User, Role, Follow, Post, Comment, Vote, TimelineEntry, role_cache
+import shutil, tempfile, unittest
 from app import db, create_app
+from app.page_cache import TagVersions
 from faker import Faker
 
 class UserModelsTestCase(unittest.TestCase):
@@ -50,6 +52,44 @@ class UserModelsTestCase(unittest.TestCase):
         self.assertTrue(user.can(Permission.ADMIN))
         self.assertTrue(user.is_administrator())
 
+    def test_roles_are_cached(self):
+        statements = []
+        def count_statement(*args):
+            statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            users = [User(email=f"user{i}@test.com", username=f"user{i}") for i in range(10)]
+            db.session.add_all(users)
+            db.session.commit()
+            self.assertTrue(all(user.can(Permission.WRITE) and not user.can(Permission.MODERATE) for user in users))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+        self.assertLessEqual(len([s for s in statements if "FROM roles" in s]), 1)
+        # Changing a role drops the cached copy
+        role = Role.query.filter_by(name="User").first()
+        role.add_permission(Permission.MODERATE)
+        db.session.commit()
+        self.assertTrue(db.session.get(User, users[0].id).can(Permission.MODERATE))
+        self.assertEqual(role_cache.default().permissions, role.permissions)
+
+    def test_role_cache_follows_other_workers(self):
+        directory = tempfile.mkdtemp()
+        tags = self.app.extensions["identity_tags"]
+        try:
+            self.app.extensions["identity_tags"] = TagVersions(directory)
+            role = Role.query.filter_by(name="User").first()
+            permissions = role_cache.default().permissions
+            # Another worker takes a permission away; this one only learns about it from the "roles" tag
+            db.session.execute(Role.__table__.update().where(Role.__table__.c.id == role.id)
+                               .values(permissions=permissions & ~Permission.WRITE))
+            db.session.commit()
+            self.assertEqual(role_cache.default().permissions, permissions)
+            TagVersions(directory).invalidate(["roles"])
+            self.assertEqual(role_cache.default().permissions, permissions & ~Permission.WRITE)
+        finally:
+            self.app.extensions["identity_tags"] = tags
+            shutil.rmtree(directory)
+
     def test_moderator_role(self):
         user = User(role = Role.query.filter_by(name="Moderator").first())
         self.assertTrue(user.can(Permission.COMMENT))
@@ -118,4 +158,188 @@ class UserModelsTestCase(unittest.TestCase):
         db.session.delete(u2)
         db.session.commit()
         # Test if the association table removes all relationships for users that are deleted (i.e. the delete-orphan option)
-        self.assertTrue(Follow.query.count() == 0)
\ No newline at end of file
+        self.assertTrue(Follow.query.count() == 0)
+
+    def test_social_counts(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        u2 = User(email="b@test.com", username="b", password="dog")
+        u3 = User(email="c@test.com", username="c", password="cow")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u3.follow(u2)
+        u2.follow(u1)
+        db.session.add_all([Post(body="one", author=u2), Post(body="two", author=u2)])
+        db.session.commit()
+        self.assertEqual((u2.post_count, u2.follower_count, u2.following_count), (2, 2, 1))
+        self.assertEqual((u1.follower_count, u1.following_count), (1, 1))
+        u3.unfollow(u2)
+        db.session.delete(db.session.query(Post).filter_by(body="one").one())
+        db.session.commit()
+        self.assertEqual((u2.post_count, u2.follower_count), (1, 1))
+        Post.bulk_insert(u1, [{"body": "three"}, {"body": "four"}], render=False)
+        db.session.commit()
+        self.assertEqual(u1.post_count, 2)
+        # Deleting a user takes their follows with them
+        db.session.delete(u2)
+        db.session.commit()
+        self.assertEqual((u1.follower_count, u1.following_count), (0, 0))
+        self.assertEqual(User.reconcile_social_counts(), 0)
+
+    def test_bulk_insert_ids(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        u2 = User(email="b@test.com", username="b", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        # Posts of the same author with the same timestamp, as MySQL would store two imports within a second
+        db.session.execute(Post.__table__.insert(), [{"body": "before", "author_id": u1.id,
+                                                      "timestamp": datetime(2024, 1, 1)}])
+        first = Post.bulk_insert(u1, [{"body": f"first {i}"} for i in range(30)], render=False, chunk_size=10)
+        other = Post.bulk_insert(u2, [{"body": "other"}], render=False)
+        second = Post.bulk_insert(u1, [{"body": f"second {i}"} for i in range(5)], render=False, chunk_size=10)
+        db.session.execute(Post.__table__.update().values(timestamp=datetime(2024, 1, 1)))
+        db.session.commit()
+        self.assertEqual(len(set(first + other + second)), 36)
+        self.assertEqual([db.session.get(Post, id).body for id in first], [f"first {i}" for i in range(30)])
+        self.assertEqual([db.session.get(Post, id).body for id in second], [f"second {i}" for i in range(5)])
+        self.assertEqual(db.session.get(Post, other[0]).author_id, u2.id)
+
+    def test_reconcile_social_counts(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        u2 = User(email="b@test.com", username="b", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        # Rows written without the ORM leave the counts out of date
+        db.session.execute(Follow.__table__.insert(), [{"follower_id": u1.id, "following_id": u2.id}])
+        db.session.execute(Post.__table__.insert(), [{"body": "test", "author_id": u2.id}])
+        db.session.commit()
+        self.assertEqual(u2.follower_count, 0)
+        self.assertEqual(User.reconcile_social_counts(chunk_size=1), 2)
+        db.session.refresh(u1)
+        db.session.refresh(u2)
+        self.assertEqual((u1.post_count, u1.follower_count, u1.following_count), (0, 0, 1))
+        self.assertEqual((u2.post_count, u2.follower_count, u2.following_count), (1, 1, 0))
+        self.assertEqual(User.reconcile_social_counts(chunk_size=1), 0)
+
+    def test_reconcile_vote_counts(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        u2 = User(email="b@test.com", username="b", password="dog")
+        post = Post(body="test", author=u1)
+        db.session.add_all([u1, u2, post])
+        db.session.commit()
+        # Votes written without the ORM (e.g. by flask seed) leave the tallies out of date
+        db.session.execute(Vote.__table__.insert(), [{"post_id": post.id, "voter_id": u1.id, "vote_type": True},
+                                                     {"post_id": post.id, "voter_id": u2.id, "vote_type": False}])
+        db.session.commit()
+        self.assertEqual(post.net_votes, 0)
+        self.assertEqual(post.upvotes, 0)
+        self.assertEqual(Post.reconcile_vote_counts(chunk_size=1), 1)
+        db.session.refresh(post)
+        self.assertEqual((post.upvotes, post.downvotes), (1, 1))
+        # Running it again finds nothing to fix
+        self.assertEqual(Post.reconcile_vote_counts(chunk_size=1), 0)
+
+    def test_vote_counts(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        u2 = User(email="b@test.com", username="b", password="dog")
+        post = Post(body="test", author=u1)
+        db.session.add_all([u1, u2, post])
+        db.session.commit()
+        db.session.add_all([Vote(post_id=post.id, voter_id=u1.id, vote_type=True),
+                            Vote(post_id=post.id, voter_id=u2.id, vote_type=True)])
+        db.session.commit()
+        self.assertEqual((post.upvotes, post.downvotes), (2, 0))
+        db.session.get(Vote, (u2.id, post.id)).vote_type = False
+        db.session.commit()
+        self.assertEqual((post.upvotes, post.downvotes), (1, 1))
+        # Deleting a user deletes their votes
+        db.session.delete(u2)
+        db.session.commit()
+        self.assertEqual((post.upvotes, post.downvotes), (1, 0))
+        self.assertEqual(Post.reconcile_vote_counts(), 0)
+
+    def test_comment_counts(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        post = Post(body="test", author=u1)
+        db.session.add_all([u1, post])
+        db.session.commit()
+        self.assertEqual((post.comment_count, post.last_comment_at), (0, None))
+        post.create_comment(u1, "first")
+        post.create_comment(u1, "second")
+        first, second = db.session.query(Comment).order_by(Comment.id).all()
+        self.assertEqual((post.comment_count, post.last_comment_at), (2, second.timestamp))
+        # Disabling the newest comment moves last_comment_at back to the one before it, enabling it moves it forward
+        second.disabled = 1
+        db.session.commit()
+        self.assertEqual((post.comment_count, post.last_comment_at), (1, first.timestamp))
+        second.disabled = 0
+        db.session.commit()
+        self.assertEqual((post.comment_count, post.last_comment_at), (2, second.timestamp))
+        # Deleting a disabled comment doesn't count it twice
+        first.disabled = 1
+        db.session.commit()
+        db.session.delete(first)
+        db.session.delete(second)
+        db.session.commit()
+        self.assertEqual((post.comment_count, post.last_comment_at), (0, None))
+
+    def test_reconcile_comment_counts(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        post = Post(body="test", author=u1)
+        db.session.add_all([u1, post])
+        db.session.commit()
+        post.create_comment(u1, "shown")
+        # Comments written without the ORM leave the counts out of date
+        db.session.execute(Comment.__table__.insert(), [{"post_id": post.id, "author_id": u1.id, "body": "hidden",
+                                                         "disabled": 1, "timestamp": datetime(2000, 1, 1)}])
+        db.session.execute(Post.__table__.update().values(comment_count=0, last_comment_at=None))
+        db.session.commit()
+        self.assertEqual(Post.reconcile_comment_counts(chunk_size=1), 1)
+        db.session.refresh(post)
+        self.assertEqual(post.comment_count, 1)
+        self.assertEqual(post.last_comment_at, db.session.query(Comment).filter_by(body="shown").one().timestamp)
+        self.assertEqual(Post.reconcile_comment_counts(chunk_size=1), 0)
+
+    def test_rebuild_timelines(self):
+        u1 = User(email="a@test.com", username="a", password="cat")
+        u2 = User(email="b@test.com", username="b", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.add_all([Post(body="one", author=u2), Post(body="two", author=u2), Post(body="mine", author=u1)])
+        db.session.commit()
+        # The posts were not fanned out, since they weren't made through the views
+        self.assertEqual(u1.following_posts.count(), 0)
+        self.assertEqual(TimelineEntry.rebuild(chunk_size=1), 2)
+        self.assertEqual(sorted(post.body for post in u1.following_posts), ["one", "two"])
+        self.assertEqual(u2.following_posts.count(), 0)
+        # Deleting a post removes it from the timelines
+        db.session.delete(db.session.query(Post).filter_by(body="one").first())
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.count(), 1)
+
+    def test_timeline_entries_are_deleted_first(self):
+        # SQLite only enforces foreign keys when asked to, like MySQL always does
+        db.session.execute(text("PRAGMA foreign_keys=ON"))
+        try:
+            u1 = User(email="a@test.com", username="a", password="cat")
+            u2 = User(email="b@test.com", username="b", password="dog")
+            u3 = User(email="c@test.com", username="c", password="fish")
+            db.session.add_all([u1, u2, u3])
+            db.session.commit()
+            u1.follow(u2)
+            u3.follow(u2)
+            u2.follow(u3)
+            db.session.add_all([Post(body="one", author=u2), Post(body="two", author=u2), Post(body="three", author=u3)])
+            db.session.commit()
+            self.assertEqual(TimelineEntry.rebuild(), 5)
+            db.session.delete(db.session.query(Post).filter_by(body="one").first())
+            db.session.commit()
+            self.assertEqual(TimelineEntry.query.count(), 3)
+            # As the author of the posts in u1's and u3's timelines, and as the follower with u3's post in theirs
+            db.session.delete(u2)
+            db.session.commit()
+            self.assertEqual(TimelineEntry.query.count(), 0)
+        finally:
+            db.session.rollback()
+            db.session.execute(text("PRAGMA foreign_keys=OFF"))
@@ -0,0 +1,90 @@
+import os, shutil, tempfile, unittest
+from app import create_app, db
+from app.factories.user_factory import user_factory
+from app.models import Comment, Post, Role
+from app.page_cache import TagVersions
+from app.query_stats import capture_queries
+
+class PageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config["BLOGGING_PAGE_CACHE"] = True
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.author = user_factory("User")
+        self.post = Post(body = "first post", author = self.author)
+        db.session.add(self.post)
+        db.session.commit()
+        self.client = self.app.test_client(use_cookies = True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_anonymous_pages_are_cached(self):
+        for url in ["/", f"/post/{self.post.id}", f"/user/{self.author.username}"]:
+            self.assertEqual(self.client.get(url).headers["X-Page-Cache"], "miss")
+            with capture_queries() as queries:
+                resp = self.client.get(url)
+            self.assertEqual(resp.headers["X-Page-Cache"], "hit")
+            self.assertIn("first post", resp.get_data(as_text = True))
+            self.assertEqual(queries.count, 0)
+        # The query string is part of the key
+        self.assertEqual(self.client.get("/?other=1").headers["X-Page-Cache"], "miss")
+
+    def test_writes_invalidate_pages(self):
+        url = f"/post/{self.post.id}"
+        self.client.get("/")
+        self.client.get(url)
+        self.post.body = "edited post"
+        db.session.commit()
+        resp = self.client.get(url)
+        self.assertEqual(resp.headers["X-Page-Cache"], "miss")
+        self.assertIn("edited post", resp.get_data(as_text = True))
+        # A comment is on the post page
+        self.client.get(url)
+        db.session.add(Comment(body = "a comment", post = self.post, author = self.author))
+        db.session.commit()
+        self.assertIn("a comment", self.client.get(url).get_data(as_text = True))
+        # A new post is on the index
+        self.assertEqual(self.client.get("/").headers["X-Page-Cache"], "miss")
+        self.assertEqual(self.client.get("/").headers["X-Page-Cache"], "hit")
+        db.session.add(Post(body = "second post", author = self.author))
+        db.session.commit()
+        self.assertIn("second post", self.client.get("/").get_data(as_text = True))
+        # A profile edit invalidates the pages with the user's posts
+        self.client.get("/")
+        self.author.about_me = "new about me"
+        db.session.commit()
+        self.assertEqual(self.client.get("/").headers["X-Page-Cache"], "miss")
+        # Something rolled back doesn't
+        self.client.get("/")
+        self.author.about_me = "rolled back"
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.client.get("/").headers["X-Page-Cache"], "hit")
+
+    def test_logged_in_users_and_flashes_are_not_cached(self):
+        self.client.get("/")
+        self.client.post('/auth/login', data = {"email": self.author.email, "password": "password"})
+        self.assertNotIn("X-Page-Cache", self.client.get("/").headers)
+        # Logging out flashes a message, which the next page shows
+        self.client.get('/auth/logout')
+        resp = self.client.get("/")
+        self.assertNotIn("X-Page-Cache", resp.headers)
+        self.assertIn("Logged out successfully", resp.get_data(as_text = True))
+        self.assertEqual(self.client.get("/").headers["X-Page-Cache"], "hit")
+
+    def test_tag_files_are_shared(self):
+        directory = tempfile.mkdtemp()
+        try:
+            worker, other_worker = TagVersions(directory), TagVersions(directory)
+            self.assertEqual(worker.invalidated_at("post:1"), 0)
+            other_worker.invalidate(["post:1"])
+            self.assertTrue(worker.stale(["post:1", "posts"], 1))
+            self.assertTrue(os.path.exists(os.path.join(directory, "post-1")))
+        finally:
+            shutil.rmtree(directory)
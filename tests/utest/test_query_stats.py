@@ -0,0 +1,49 @@
+import unittest
+from app import create_app, db
+from app.models import Post, Role, User
+from app.query_stats import QueryStats, capture_queries, query_budget, shape_of
+
+class QueryStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_shapes_ignore_parameters_and_in_list_lengths(self):
+        self.assertEqual(shape_of("SELECT *\n  FROM posts WHERE id IN (?, ?, ?)"), "SELECT * FROM posts WHERE id IN (?)")
+        self.assertEqual(shape_of("SELECT * FROM posts WHERE id IN (%s, %s)"), "SELECT * FROM posts WHERE id IN (%s)")
+        stats = QueryStats()
+        for _ in range(5):
+            stats.record("SELECT * FROM users WHERE id = ?", 0.001)
+        stats.record("SELECT * FROM posts", 0.001)
+        self.assertEqual(stats.repeated(5), [("SELECT * FROM users WHERE id = ?", 5)])
+
+    def test_query_budget(self):
+        user = User(email="a@test.com", username="a", password="cat")
+        db.session.add(user)
+        db.session.commit()
+        with capture_queries() as queries:
+            for _ in range(3):
+                db.session.execute(db.select(Post.id)).all()
+        self.assertEqual(queries.count, 3)
+        with self.assertRaises(AssertionError):
+            with query_budget(2):
+                for _ in range(3):
+                    db.session.execute(db.select(Post.id)).all()
+
+    def test_n_plus_one_is_logged(self):
+        @self.app.route("/n_plus_one")
+        def n_plus_one():
+            for _ in range(5):
+                db.session.execute(db.select(Post.id).where(Post.id == 1)).all()
+            return "done"
+        with self.assertLogs(self.app.logger, level="WARNING") as logs:
+            self.app.test_client().get("/n_plus_one")
+        self.assertTrue(any("Probable N+1" in line and "5 x" in line for line in logs.output))
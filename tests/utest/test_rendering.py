@@ -0,0 +1,37 @@
+import threading, unittest
+from app.rendering import MarkdownRenderer
+
+
+class MarkdownRendererTestCase(unittest.TestCase):
+    def setUp(self):
+        self.renderer = MarkdownRenderer(cache_size=10)
+
+    def test_markdown_is_rendered_and_cleaned(self):
+        html = self.renderer.render("**bold** <script>alert('xss')</script> https://example.com")
+        self.assertTrue("<strong>bold</strong>" in html)
+        self.assertFalse("<script>" in html)
+        self.assertTrue('<a href="https://example.com" rel="nofollow">' in html)
+
+    def test_same_text_is_rendered_once(self):
+        first = self.renderer.render("some *text*")
+        second = self.renderer.render("some *text*")
+        self.assertEqual(first, second)
+        self.assertEqual((self.renderer.cache.misses, self.renderer.cache.hits), (1, 1))
+
+    def test_none(self):
+        self.assertIsNone(self.renderer.render(None))
+
+    # Every thread has its own Markdown, Cleaner and Linker, so concurrent renders don't mix up their output
+    def test_threads(self):
+        texts = [f"**post {i}** <script>x</script> https://example.com/{i}" for i in range(200)]
+        expected = {text: MarkdownRenderer(cache_size=1).render(text) for text in texts}
+        results = {}
+        def render(part):
+            for text in part:
+                results[text] = self.renderer.render(text)
+        threads = [threading.Thread(target=render, args=(texts[i::8],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, expected)
@@ -0,0 +1,69 @@
+import unittest
+from app import create_app, db
+from app.models import Comment, Post, Role, User
+from app.search import rebuild_index, search
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email="a@test.com", username="a", password="cat")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def bodies(self, model, query, **kwargs):
+        return [item.body for item in search(model, query, **kwargs).items]
+
+    def test_search_ranks_and_paginates(self):
+        db.session.add_all([Post(title="cats", body="cats and cats and more cats", author=self.user),
+                            Post(title="dogs", body="one cat among dogs", author=self.user),
+                            Post(title="birds", body="no felines here", author=self.user)])
+        db.session.commit()
+        # Words are stemmed, and the better match comes first
+        self.assertEqual(self.bodies(Post, "cat"), ["cats and cats and more cats", "one cat among dogs"])
+        first = search(Post, "cat", per_page=1)
+        self.assertEqual(len(first.items), 1)
+        second = search(Post, "cat", per_page=1, cursor=first.next_cursor)
+        self.assertEqual([post.body for post in second.items], ["one cat among dogs"])
+        self.assertFalse(second.has_next)
+        # FTS5 syntax typed by the user is searched for as words, not taken as a query
+        self.assertEqual(self.bodies(Post, 'cat" OR "birds'), [])
+        self.assertEqual(self.bodies(Post, "  "), [])
+
+    def test_index_follows_edits_and_deletes(self):
+        post = Post(body="original words", author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        post.body = "edited words"
+        db.session.commit()
+        self.assertEqual(self.bodies(Post, "original"), [])
+        self.assertEqual(self.bodies(Post, "edited"), ["edited words"])
+        comment = Comment(body="a comment about words", post=post, author=self.user)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(self.bodies(Comment, "words"), ["a comment about words"])
+        # Disabled comments are not found
+        comment.disabled = 1
+        db.session.commit()
+        self.assertEqual(self.bodies(Comment, "words"), [])
+        db.session.delete(comment)
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.bodies(Post, "words"), [])
+
+    def test_rebuild_index(self):
+        db.session.add_all([Post(body=f"post {i}", author=self.user) for i in range(3)])
+        db.session.commit()
+        db.session.execute("DELETE FROM posts_fts")
+        db.session.commit()
+        self.assertEqual(self.bodies(Post, "post"), [])
+        self.assertEqual(rebuild_index(chunk_size=2), 3)
+        self.assertEqual(len(self.bodies(Post, "post")), 3)
@@ -0,0 +1,45 @@
+import unittest
+from app import create_app, db
+from app.models import Comment, Follow, Post, Role, TimelineEntry, User, Vote
+from app.rendering import render_markdown
+from app.seeding import generate
+
+class SeedingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_generate(self):
+        written = generate(users=30, posts=60, follows_per_user=5, votes_per_post=3, comments_per_post=2, chunk_size=7)
+        self.assertEqual((User.query.count(), Post.query.count()), (30, 60))
+        self.assertEqual(written["follows"], Follow.query.count())
+        self.assertEqual(written["votes"], Vote.query.count())
+        self.assertEqual(written["comments"], Comment.query.count())
+        self.assertGreater(written["follows"], 0)
+        # The denormalized columns are as the listeners would have made them
+        self.assertEqual(Post.reconcile_vote_counts(), 0)
+        post = Post.query.first()
+        self.assertEqual(post.body_html, render_markdown(post.body))
+        self.assertGreater(TimelineEntry.query.count(), 0)
+        # The generated users can log in
+        self.assertTrue(User.query.first().verify_password("password"))
+
+    def test_generate_is_deterministic(self):
+        generate(users=10, posts=20, seed=3)
+        first = [(post.author_id, post.body) for post in Post.query.order_by(Post.id)]
+        follows = sorted((follow.follower_id, follow.following_id) for follow in Follow.query)
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        generate(users=10, posts=20, seed=3)
+        self.assertEqual([(post.author_id, post.body) for post in Post.query.order_by(Post.id)], first)
+        self.assertEqual(sorted((follow.follower_id, follow.following_id) for follow in Follow.query), follows)
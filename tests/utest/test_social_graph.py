@@ -0,0 +1,111 @@
+import shutil, tempfile, unittest
+from app import create_app, db
+from app.factories.user_factory import user_factory
+from app.models import Follow, Role
+from app.query_stats import capture_queries
+from app.social_graph import SocialGraph
+
+class SocialGraphTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config["BLOGGING_SOCIAL_GRAPH"] = True
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.u1, self.u2, self.u3 = user_factory("User"), user_factory("User"), user_factory("User")
+        self.graph = self.app.extensions["social_graph"]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_checks_are_answered_from_the_index(self):
+        self.u1.follow(self.u2)
+        db.session.commit()
+        self.assertTrue(self.u1.is_following(self.u2))
+        # The commit expired the users; load them again outside of the count
+        self.u3.id
+        with capture_queries() as queries:
+            self.assertTrue(self.u1.is_following(self.u2))
+            self.assertTrue(self.u2.is_followed_by(self.u1))
+            self.assertFalse(self.u1.is_following(self.u3))
+            self.assertFalse(self.u1.is_followed_by(self.u2))
+        # Only u2's (empty) list was loaded
+        self.assertEqual(queries.count, 1)
+
+    def test_writes_update_the_index(self):
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.u1.follow(self.u2)
+        # The session that wrote it sees it before it commits
+        self.assertTrue(self.u1.is_following(self.u2))
+        db.session.rollback()
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.u1.follow(self.u3)
+        self.u1.follow(self.u2)
+        db.session.commit()
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertEqual(list(self.graph.following_ids.get(self.u1.id)[1]), sorted([self.u2.id, self.u3.id]))
+        self.u1.unfollow(self.u3)
+        db.session.commit()
+        # The commit dropped u1's list, which is loaded again once
+        self.assertIsNone(self.graph.following_ids.get(self.u1.id))
+        self.u1.id, self.u2.id, self.u3.id
+        with capture_queries() as queries:
+            self.assertFalse(self.u1.is_following(self.u3))
+            self.assertTrue(self.u1.is_following(self.u2))
+        self.assertEqual(queries.count, 1)
+        # Deleting a user deletes their follows
+        db.session.delete(self.u2)
+        db.session.commit()
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.assertEqual(list(self.graph.following_ids.get(self.u1.id)[1]), [])
+
+    def test_other_workers_reload(self):
+        directory = tempfile.mkdtemp()
+        try:
+            mine, other = SocialGraph(tag_directory = directory), SocialGraph(tag_directory = directory)
+            self.assertFalse(other.follows(self.u1.id, self.u2.id))
+            db.session.add(Follow(follower = self.u1, following = self.u2))
+            db.session.commit()
+            mine.apply({(self.u1.id, self.u2.id): True})
+            self.assertTrue(other.follows(self.u1.id, self.u2.id))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_memory_is_bounded(self):
+        graph = SocialGraph(maxsize = 1, max_following = 1)
+        self.u1.follow(self.u2)
+        self.u1.follow(self.u3)
+        self.u2.follow(self.u3)
+        db.session.commit()
+        # u1 follows too many to be kept, so it is looked up with a query
+        self.assertIsNone(graph.follows(self.u1.id, self.u2.id))
+        self.assertTrue(graph.follows(self.u2.id, self.u3.id))
+        self.assertFalse(graph.follows(self.u3.id, self.u1.id))
+        self.assertEqual(len(graph.following_ids), 1)
+        self.app.extensions["social_graph"] = graph
+        self.assertTrue(self.u1.is_following(self.u2))
+        # That it follows too many is kept, so each check is one query, until it follows or unfollows someone
+        self.u1.id, self.u2.id, self.u3.id
+        with capture_queries() as queries:
+            self.assertTrue(self.u1.is_following(self.u2))
+            self.assertFalse(self.u1.is_following(self.u1))
+        self.assertEqual(queries.count, 2)
+        self.assertIsNone(graph.following_ids.get(self.u1.id)[1])
+        self.u1.unfollow(self.u3)
+        db.session.commit()
+        self.assertIsNone(graph.following_ids.get(self.u1.id))
+        self.assertEqual(list(graph.following(self.u1.id)), [self.u2.id])
+
+    def test_profile_page(self):
+        self.u2.follow(self.u1)
+        db.session.commit()
+        client = self.app.test_client(use_cookies = True)
+        client.post("/auth/login", data = {"email": self.u1.email, "password": "password"})
+        client.get(f"/user/{self.u2.username}")
+        with capture_queries() as queries:
+            page = client.get(f"/user/{self.u2.username}").get_data(as_text = True)
+        self.assertIn("Follow", page)
+        self.assertFalse(any("follows" in statement for statement in queries.statements))